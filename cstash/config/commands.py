@@ -17,7 +17,18 @@ def config():
 @click.option('--ask-for-s3-credentials', '-a', is_flag=True, help="Prompt for access key ID and secret to be used with S3 compatible provider")
 @click.option('--key', '-k', default='default', help='Key to use for encryption. For GPG, this is the key ID, for Python native encryption, this is the name of the file in the $HOME/.cstash/keys directory')
 @click.option('--bucket', '-b', help='Bucket name where objects will be stored')
-def write(ctx, cryptographer, storage_provider, s3_endpoint_url, ask_for_s3_credentials, key, bucket):
+@click.option('--max-pool-connections', type=click.IntRange(min=1), help='Connections kept open per S3 endpoint. Should match the number of parallel transfers, defaults to 10')
+@click.option('--daemon-workers', type=click.IntRange(min=1), help='Number of files the daemon uploads at once, defaults to 4')
+@click.option('--daemon-scan-period', type=click.IntRange(min=1), help='Seconds over which the daemon scans every directory once, when not using inotify. Defaults to 60')
+@click.option('--chunked/--whole-files', default=None, help='Whether to store files as content-defined chunks, so that changes only upload the chunks which changed')
+@click.option('--compression', type=click.Choice(['zstd', 'zlib', 'none']), help='Compress files which compress well before encrypting them. zstd needs the zstandard package, and falls back to zlib without it')
+@click.option('--pack/--no-pack', default=None, help='Whether to gather small files into shared pack objects, to save on requests')
+@click.option('--pack-threshold', type=click.IntRange(min=1), help='With --pack, files smaller than this many bytes are packed. Defaults to 16 KiB')
+@click.option('--manifest-max-age', type=click.IntRange(min=1), help="Seconds that the local manifest of a bucket's contents is trusted for after the bucket was last listed in full. Defaults to a day")
+@click.option('--multipart-threshold', type=click.IntRange(min=1), help='Size in bytes from which objects are uploaded in parts. Chosen from the measured latency and throughput of the endpoint if not set')
+@click.option('--part-size', type=click.IntRange(min=5*1024*1024, max=5*1024*1024*1024), help='Size in bytes of each part of a multipart transfer. Chosen from the object size and the measured latency and throughput of the endpoint if not set')
+@click.option('--max-concurrency', type=click.IntRange(min=1), help='Number of parts of a single object transferred at once. Chosen from the object size if not set, up to 10')
+def write(ctx, cryptographer, storage_provider, s3_endpoint_url, ask_for_s3_credentials, key, bucket, max_pool_connections=None, daemon_workers=None, daemon_scan_period=None, chunked=None, compression=None, pack=None, pack_threshold=None, manifest_max_age=None, multipart_threshold=None, part_size=None, max_concurrency=None):
     """
     Set one or more of the options in the config file for [section]. If [section] is not
     given, default to "default". The config file will be created if necessary
@@ -42,4 +53,15 @@ def write(ctx, cryptographer, storage_provider, s3_endpoint_url, ask_for_s3_cred
         "s3_access_key_id": s3_access_key_id,
         "s3_secret_access_key": s3_secret_access_key,
         "key": key,
-        "bucket": bucket})
+        "bucket": bucket,
+        "max_pool_connections": None if max_pool_connections is None else str(max_pool_connections),
+        "daemon_workers": None if daemon_workers is None else str(daemon_workers),
+        "daemon_scan_period": None if daemon_scan_period is None else str(daemon_scan_period),
+        "chunked": None if chunked is None else str(chunked).lower(),
+        "compression": compression,
+        "pack": None if pack is None else str(pack).lower(),
+        "pack_threshold": None if pack_threshold is None else str(pack_threshold),
+        "manifest_max_age": None if manifest_max_age is None else str(manifest_max_age),
+        "multipart_threshold": None if multipart_threshold is None else str(multipart_threshold),
+        "part_size": None if part_size is None else str(part_size),
+        "max_concurrency": None if max_concurrency is None else str(max_concurrency)})
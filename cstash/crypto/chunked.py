@@ -0,0 +1,189 @@
+"""
+Stash files as content-defined chunks, so that a changed file only uploads the chunks which
+changed.
+
+Each chunk is encrypted on its own, and stored as CHUNK_PREFIX followed by its id. Ids are keyed
+hashes of the chunk's plaintext, with a secret kept in the cstash directory, so that the same data
+always gets the same id without the ids giving away what the data is. The cryptographer, key, and
+compression codec are part of the hash, so a chunk is only shared by files encrypted with the same
+key and compressed the same way, which can all decrypt it. A file's entry in the
+filenames database then has an ordered manifest of the chunks making it up, which fetch() uses to
+download and reassemble it, several chunks at once.
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import cstash.libs.exceptions as exceptions
+import cstash.libs.helpers as helpers
+from cstash.crypto import chunker
+
+CHUNK_PREFIX = "chunks/"
+DEFAULT_CHUNK_JOBS = 8
+CHUNK_ID_KEY_FILE = "chunk-id.key"
+
+class ChunkedStorage():
+    """
+    Upload and download chunked files in [storage], encrypted with [encryption], using [jobs]
+    threads for transfers
+    """
+
+    def __init__(self, cstash_directory, encryption, storage, filename_db, jobs=DEFAULT_CHUNK_JOBS):
+        self.cstash_directory = cstash_directory
+        self.encryption = encryption
+        self.storage = storage
+        self.filename_db = filename_db
+        self.jobs = jobs
+        self.id_key = None
+
+    def chunk_id(self, data, cryptographer, key, compression=None):
+        """
+        Return the id for the chunk [data], stored encrypted by [cryptographer] with [key], and
+        compressed with [compression]
+        """
+
+        if self.id_key is None:
+            self.id_key = self.load_id_key()
+
+        chunk_hash = hmac.new(self.id_key, digestmod=hashlib.sha256)
+        # Separated by NUL bytes, which none of them can contain, so that no two differ only in
+        # where one ends and the next begins
+        chunk_hash.update("\0".join((cryptographer, key, compression or "")).encode() + b"\0")
+        chunk_hash.update(data)
+
+        return chunk_hash.hexdigest()
+
+    def load_id_key(self):
+        """
+        Return the secret used for chunk ids, creating it if it doesn't exist. Losing it
+        doesn't lose any data, but chunks stored before are no longer matched by new stashes
+        """
+
+        key_file = f"{self.cstash_directory}/{CHUNK_ID_KEY_FILE}"
+        try:
+            key_fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(key_fd, "wb") as key_file_writer:
+                key_file_writer.write(secrets.token_bytes(32))
+        except FileExistsError:
+            pass
+
+        with open(key_file, "rb") as key_file_reader:
+            return key_file_reader.read()
+
+    def upload(self, path, cryptographer, key, s3_endpoint_url, bucket, compression=None):
+        """
+        Split [path] into chunks, and upload those which aren't already stored in [bucket],
+        [self.jobs] at once, each compressed with [compression] if given and encrypted by
+        [cryptographer] with [key]. At most twice that many chunks are held in memory.
+
+        Return a tuple of the file's manifest, as a list of (chunk_id, size) tuples, its
+        sha256 hash, and the number of chunks uploaded. Raise a CstashUploadError if any chunk
+        couldn't be uploaded
+        """
+
+        manifest = []
+        file_hash = hashlib.sha256()
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+        failed = threading.Event()
+        futures = []
+        pending = set()
+
+        def upload_chunk(chunk_id, data):
+            try:
+                object_name = f"{CHUNK_PREFIX}{chunk_id}"
+                if self.storage.object_exists(bucket, object_name):
+                    return False
+                uploaded = self.storage.upload_stream(
+                    bucket, object_name, [self.encryption.encrypt_bytes(data, key, compression)], size_hint=len(data))
+                if uploaded is not True:
+                    raise exceptions.CstashUploadError(message=f"Couldn't upload chunk {chunk_id} of {path}")
+                return True
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            with open(path, "rb") as source:
+                for data in chunker.split(source):
+                    if failed.is_set():
+                        break
+                    file_hash.update(data)
+                    chunk_id = self.chunk_id(data, cryptographer, key, compression)
+                    manifest.append((chunk_id, len(data)))
+
+                    # Repeated chunks within the file, and chunks already stored, are only referenced
+                    if chunk_id in pending or \
+                       chunk_id in self.filename_db.known_chunks([chunk_id], s3_endpoint_url, bucket):
+                        continue
+                    pending.add(chunk_id)
+
+                    slots.acquire()
+                    futures.append(pool.submit(upload_chunk, chunk_id, data))
+
+            uploaded = sum(1 for future in futures if future.result() is True)
+
+        logging.debug(f"Uploaded {uploaded} of {len(manifest)} chunks of {path}")
+
+        return manifest, file_hash.hexdigest(), uploaded
+
+    def fetch(self, manifest, destination, bucket, key, password=None, compression=None):
+        """
+        Download the chunks in [manifest] from [bucket] [self.jobs] at once, decrypt them,
+        decompress them with [compression] if given, and write them into place in [destination]. As with Encryption.decrypt_stream(), the file
+        is only renamed into place once every chunk has been written.
+
+        Return the complete path for the decrypted file for success, or raise a
+        CstashCriticalException
+        """
+
+        destination = helpers.clear_path(destination)
+        directory, filename = os.path.split(destination)
+        partial_path = f"{directory}/.{filename}.{uuid.uuid4().hex[:8]}.partial"
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+        failed = threading.Event()
+
+        def fetch_chunk(partial_fd, chunk_id, offset, size):
+            try:
+                body = self.storage.download_stream(bucket, f"{CHUNK_PREFIX}{chunk_id}")
+                data = self.encryption.decrypt_bytes(body, key, password, compression)
+                if len(data) != size:
+                    raise ValueError(f"Chunk {chunk_id} is {len(data)} bytes, expected {size}")
+                os.pwrite(partial_fd, data, offset)
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        try:
+            partial_fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                os.ftruncate(partial_fd, sum(size for _, size in manifest))
+                futures = []
+                offset = 0
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    for chunk_id, size in manifest:
+                        if failed.is_set():
+                            break
+                        slots.acquire()
+                        futures.append(pool.submit(fetch_chunk, partial_fd, chunk_id, offset, size))
+                        offset += size
+                    for future in futures:
+                        future.result()
+            finally:
+                os.close(partial_fd)
+            os.replace(partial_path, destination)
+        except (Exception, SystemExit) as e:
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            logging.error("Couldn't fetch the chunks of {}: {}".format(destination, e))
+            raise exceptions.CstashCriticalException(message=f"Couldn't fetch {destination}")
+
+        return destination
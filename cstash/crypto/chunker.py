@@ -0,0 +1,99 @@
+"""
+Content-defined chunking with a Gear rolling hash, as used by FastCDC.
+
+A chunk ends where the hash of the bytes before it matches a mask, so boundaries move along with
+the data when bytes are inserted or removed, and unchanged regions of a file keep producing the
+same chunks. No boundary is looked for in the first [minimum_size] bytes of a chunk, and a chunk
+is cut at [maximum_size] bytes if no boundary was found before then.
+
+The hash is computed with numpy, SCAN_BLOCK bytes at a time, rather than byte by byte. Since each
+byte is shifted one bit further left for every byte after it, the hash after a byte only depends
+on the 64 bytes up to it, and can be found for a whole block at once by summing the block with
+shifted copies of itself, doubling the window each time.
+
+The table and mask must never change, or chunks stashed before the change would no longer be
+matched by later stashes of the same data.
+"""
+
+import hashlib
+import numpy
+
+MINIMUM_CHUNK_SIZE = 512 * 1024
+AVERAGE_CHUNK_SIZE = 2 * 1024 * 1024
+MAXIMUM_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+# One pseudo-random 64 bit value for every byte value, derived so that it's the same everywhere
+GEAR = [ int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256) ]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+# Number of bytes before one that the hash after it depends on
+HASH_WINDOW = 64
+# How many bytes are hashed at a time while looking for a boundary, small enough for the hashes
+# to stay in the CPU's cache
+SCAN_BLOCK = 64 * 1024
+
+def boundary_mask(average_size):
+    """ Return the mask matching once every [average_size] bytes on average, from the hash's top bits """
+
+    bits = max(1, average_size.bit_length() - 1)
+    return ((1 << bits) - 1) << (64 - bits)
+
+def gear_hashes(data, scratch):
+    """
+    Return a uint64 array of the hash after each byte of [data], starting from a hash of 0
+    before the first byte. [scratch] is a uint64 array at least as long as [data] to work in
+    """
+
+    hashes = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    shift = 1
+    while shift < HASH_WINDOW:
+        shifted = scratch[:len(hashes) - shift]
+        numpy.left_shift(hashes[:-shift], numpy.uint64(shift), out=shifted)
+        numpy.add(hashes[shift:], shifted, out=hashes[shift:])
+        shift *= 2
+
+    return hashes
+
+def find_boundary(data, minimum_size, maximum_size, mask):
+    """ Return the length of the first chunk at the start of [data] """
+
+    end = min(len(data), maximum_size)
+    if end <= minimum_size:
+        return end
+
+    mask = numpy.uint64(mask)
+    scratch = numpy.empty(SCAN_BLOCK + HASH_WINDOW, dtype=numpy.uint64)
+    with memoryview(data) as view:
+        for start in range(minimum_size, end, SCAN_BLOCK):
+            # Hash the bytes before the block as well, which the hashes in it depend on
+            context = max(minimum_size, start - HASH_WINDOW + 1)
+            hashes = gear_hashes(view[context:min(end, start + SCAN_BLOCK)], scratch)[start - context:]
+            matches = numpy.flatnonzero((hashes & mask) == 0)
+            if len(matches):
+                return start + int(matches[0]) + 1
+
+    return end
+
+def split(source, minimum_size=MINIMUM_CHUNK_SIZE, average_size=AVERAGE_CHUNK_SIZE,
+          maximum_size=MAXIMUM_CHUNK_SIZE):
+    """
+    Read the binary file object [source] to the end, and yield its contents in content-defined
+    chunks. At most two chunks' worth of data is held in memory
+    """
+
+    mask = boundary_mask(average_size)
+    buffer = bytearray()
+    end_of_file = False
+
+    while True:
+        while not end_of_file and len(buffer) < maximum_size:
+            block = source.read(maximum_size)
+            if not block:
+                end_of_file = True
+            buffer += block
+
+        if not buffer:
+            return
+
+        cut = find_boundary(buffer, minimum_size, maximum_size, mask)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
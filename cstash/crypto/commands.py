@@ -4,6 +4,7 @@ CLI commands for:
   * cstash fetch
   * cstash database
     - search
+    - verify
     - backup
     - restore
 """
@@ -11,7 +12,7 @@ CLI commands for:
 import click
 from cstash.libs import helpers
 import logging
-from sys import exit as sys_exit
+import sys
 
 # TODO: Declick the functions below for re-use
 # https://github.com/pallets/click/issues/40
@@ -25,13 +26,15 @@ from sys import exit as sys_exit
 @click.option('--ask-for-s3-credentials', '-a', is_flag=True, help="Prompt for access key ID and secret to be used with S3 compatible provider")
 @click.option('--bucket', '-b', help='Bucket to push objects to')
 @click.option('--force', '-f', is_flag=True, default=False, help='Force re-upload of already stored file')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Number of parallel workers per stage. More than 1 stashes directories through a parallel pipeline')
+@click.option('--max-in-flight-bytes', default=1024*1024*1024, type=click.IntRange(min=1), help='With --jobs, the most bytes of files being encrypted or uploaded at once. Default is 1 GiB')
+@click.option('--chunked', is_flag=True, default=False, help='Store files as content-defined chunks, so that later changes only upload the chunks which changed. Also set by chunked in the config')
+@click.option('--pack', is_flag=True, default=False, help='Gather small files into shared pack objects, to save on requests. Also set by pack in the config')
 @click.argument('filepath', metavar='filename')
-def stash(ctx, cryptographer, key, storage_provider, s3_endpoint_url, ask_for_s3_credentials, bucket, force, filepath):
+def stash(ctx, cryptographer, key, storage_provider, s3_endpoint_url, ask_for_s3_credentials, bucket, force, filepath, jobs=1, max_in_flight_bytes=1024*1024*1024, chunked=False, pack=False):
     """ Encrypt, and upload objects to remote storage under hashed filenames """
 
-    from cstash.crypto import crypto
-    from cstash.crypto.filenames_database import FilenamesDatabase
-    from cstash.storage.storage import Storage
+    from cstash.crypto.engine import StashEngine
 
     cstash_directory = ctx.obj.get('cstash_directory')
 
@@ -54,47 +57,43 @@ def stash(ctx, cryptographer, key, storage_provider, s3_endpoint_url, ask_for_s3
         "bucket": bucket
     })
 
+    if chunked:
+        config["chunked"] = "true"
+    if pack:
+        config["pack"] = "true"
+
     log_level = ctx.obj.get('log_level')
-    encryption = crypto.Encryption(cstash_directory, config["cryptographer"], log_level)
-    filename_db = FilenamesDatabase(cstash_directory, log_level)
     paths = helpers.get_paths(filepath)
-
-    for this_path in paths:
-        file_stored = filename_db.existing_hash(this_path)
-        # FIXME: There should be an additional AND comparison between the stored file_hash and the current file hash
-        if file_stored and force is not True:
-            print("This version of your file is already uploaded. Use -f to override and upload it again anyway")
-            sys_exit(0)
-        if file_stored and force is True:
-            logging.warning("Re-uploading existing file: {}".format(this_path))
-
-        filename_db_mapping = filename_db.store(
-            obj=this_path,
-            cryptographer=config["cryptographer"],
-            key=config['key'],
-            storage_provider=config["storage_provider"],
-            s3_endpoint_url=config["s3_endpoint_url"],
-            bucket=config["bucket"])
-        logging.debug('Updated the local database with an entry for filename mapped to the obsfucated name')
-
-        encrypted_file_path = encryption.encrypt(
-            source_filepath=this_path, destination_filename=filename_db_mapping['entry'], key=config["key"])
-        logging.debug('Encrypted {} to {}'.format(this_path, filename_db_mapping['entry']))
-
-        storage = Storage(
-            storage_provider=config["storage_provider"],
-            log_level=log_level,
-            s3_endpoint_url=config['s3_endpoint_url'],
-            s3_access_key_id=config['s3_access_key_id'],
-            s3_secret_access_key=config['s3_secret_access_key']
-        )
-        storage.upload(config["bucket"], encrypted_file_path)
-        logging.debug('Uploaded {} to {}'.format(filename_db_mapping['entry'], config["storage_provider"]))
-
-        logging.debug('Everything went fine, closing the DB connection')
-        filename_db.close_db_connection(filename_db_mapping['db_connection'])
-        print(f"File {this_path} successfully uploaded")
-        helpers.delete_file(encrypted_file_path)
+    engine = StashEngine(cstash_directory, config, log_level, jobs=jobs)
+
+    # Chunked files are stashed one at a time, with [jobs] chunks transferred at once instead.
+    # Files small enough to pack go through the engine, and the rest through the pipeline
+    pipeline_paths = []
+    if jobs > 1 and not engine.chunked:
+        pipeline_paths = [ this_path for this_path in paths if not engine.packable(this_path) ]
+        paths = [ this_path for this_path in paths if engine.packable(this_path) ]
+
+    for status, this_path in engine.stash(paths, force=force):
+        if status == 'skipped':
+            print(f"{this_path} is unchanged since it was last stashed, skipping. Use -f to upload it again anyway")
+        elif status == 'uploaded':
+            print(f"File {this_path} successfully uploaded")
+        elif status == 'shared':
+            print(f"File {this_path} is a copy of a stashed file, sharing its stored object")
+    engine.close()
+
+    if pipeline_paths:
+        from cstash.crypto.pipeline import StashPipeline
+        results = {'uploaded': [], 'shared': [], 'skipped': [], 'failed': []}
+        for status, this_path in StashPipeline(cstash_directory, config, log_level, jobs=jobs,
+                                               max_in_flight_bytes=max_in_flight_bytes, force=force).run(pipeline_paths):
+            results[status].append(this_path)
+            if status == 'uploaded':
+                print(f"File {this_path} successfully uploaded")
+            elif status == 'shared':
+                print(f"File {this_path} is a copy of a stashed file, sharing its stored object")
+        print(f"Uploaded {len(results['uploaded'])}, shared {len(results['shared'])} copies, " \
+              f"skipped {len(results['skipped'])} unchanged, failed {len(results['failed'])}")
 
 @click.command()
 @click.pass_context
@@ -102,54 +101,36 @@ def stash(ctx, cryptographer, key, storage_provider, s3_endpoint_url, ask_for_s3
 @click.option('--s3-endpoint-url', '-e', help='Used for other S3 compatible providers — e.g. https://ams3.digitaloceanspaces.com')
 @click.option('--bucket', '-b', help='Override the known bucket for objects to be fetched')
 @click.option('--ask-for-password', '-a', is_flag=True, help='Whether to ask for a password to decrypt the files with')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Number of files, or chunks of a chunked file, to fetch at once, for example when restoring a whole directory')
 @click.argument('original-filepath')
-def fetch(ctx, storage_provider, s3_endpoint_url, bucket, ask_for_password, original_filepath):
-    """ Fetch encrypted files from remote storage and decrypt them """
+def fetch(ctx, storage_provider, s3_endpoint_url, bucket, ask_for_password, original_filepath, jobs=1):
+    """
+    Fetch encrypted files from remote storage and decrypt them. Files which can't be fetched
+    are reported at the end, and the rest are still fetched
+    """
 
-    from cstash.crypto import crypto
-    from cstash.crypto.filenames_database import FilenamesDatabase
-    from cstash.storage.storage import Storage
+    from cstash.crypto.fetcher import Fetcher
 
     password = None
     if ask_for_password:
         password = click.prompt("Password", hide_input=True)
 
-    config = ctx.obj.get('config')
-    s3_access_key_id = config['s3_access_key_id']
-    s3_secret_access_key = config['s3_secret_access_key']
-
     log_level = ctx.obj.get('log_level')
-    cstash_directory = ctx.obj.get('cstash_directory')
-    filename_db = FilenamesDatabase(cstash_directory, log_level)
-    paths = filename_db.search(original_filepath)
-
-    for this_path in paths:
-        filename_hash = this_path[1]['filename_hash']
-        cryptographer = this_path[1]['cryptographer']
-        key = this_path[1]['key']
-        storage_provider = storage_provider or this_path[1]['storage_provider']
-        s3_endpoint_url = this_path[1]['s3_endpoint_url']
-        bucket = this_path[1]['bucket']
-        logging.debug("Fetched {} {} from the database for {}".format(filename_hash, cryptographer, original_filepath))
-
-        temporary_file = "{}/{}".format(cstash_directory, filename_hash)
-
-        storage = Storage(
-            storage_provider,
-            log_level=log_level,
-            s3_endpoint_url=s3_endpoint_url,
-            s3_access_key_id=s3_access_key_id,
-            s3_secret_access_key=s3_secret_access_key
-        )
-        storage.download(bucket, filename_hash, temporary_file)
-        logging.debug('Downloaded {} from {}'.format(filename_hash, storage_provider))
-
-        encryption = crypto.Encryption(
-            cstash_directory=cstash_directory, cryptographer=cryptographer, log_level=log_level)
-        encrypted_file_path = encryption.decrypt(temporary_file, this_path[0], key, password)
-        logging.debug('Decrypted {} to {}'.format(this_path, encrypted_file_path))
-        helpers.delete_file(temporary_file)
-        print(f"Successfully retrieved and decrypted {this_path[0]}")
+    fetcher = Fetcher(ctx.obj.get('cstash_directory'), ctx.obj.get('config'), log_level, jobs=jobs,
+                      storage_provider=storage_provider, s3_endpoint_url=s3_endpoint_url, bucket=bucket,
+                      password=password)
+    results = {'fetched': [], 'failed': []}
+    for status, this_path in fetcher.run(fetcher.filename_db.search(original_filepath)):
+        results[status].append(this_path)
+        if status == 'fetched':
+            print(f"Successfully retrieved and decrypted {this_path}")
+
+    if len(results['fetched']) + len(results['failed']) > 1:
+        print(f"Fetched {len(results['fetched'])}, failed {len(results['failed'])}")
+    for this_path in results['failed']:
+        print(f"Couldn't fetch {this_path}")
+    if results['failed']:
+        sys.exit(1)
 
 @click.group()
 def database():
@@ -158,11 +139,14 @@ def database():
 
 @database.command()
 @click.pass_context
+@click.option('--prefix', is_flag=True, default=False, help='Only match paths starting with [filename], such as everything in a directory')
+@click.option('--limit', '-n', type=click.IntRange(min=1), help='Stop after this many results')
 @click.argument('filename', required=False)
-def search(ctx, filename):
+def search(ctx, filename, prefix=False, limit=None):
     """
-    Search the local database for [filename]. Matches in any path will be returned. All entries
-    in the database will be returned if [filename] is omitted
+    Search the local database for [filename]. Matches in any path will be returned, and
+    [filename] may be a glob such as '*.txt'. All entries in the database will be returned
+    if [filename] is omitted
     """
 
     log_level = ctx.obj.get('log_level')
@@ -170,11 +154,51 @@ def search(ctx, filename):
     from cstash.crypto.filenames_database import FilenamesDatabase
 
     filename_db = FilenamesDatabase(ctx.obj.get('cstash_directory'), log_level)
-    results = filename_db.search(filename)
-    if len(results) == 0:
-        print("No results found")
-    for r in results:
+    found = False
+    for r in filename_db.iter_search(filename, prefix=prefix, limit=limit):
+        found = True
         print("Partial or full match: {}".format(r[0]))
+    if not found:
+        print("No results found")
+
+@database.command()
+@click.pass_context
+@click.option('--jobs', '-j', default=16, type=click.IntRange(min=1), help='Number of partitions listed, or objects looked up, at once. Default is 16')
+@click.option('--orphans/--no-orphans', default=True, help='Whether to look for stored objects no entry needs. Without, buckets needing few objects are checked without listing them')
+@click.option('--json', 'as_json', is_flag=True, default=False, help='Print the full report as JSON, for example for a cron job')
+def verify(ctx, jobs=16, orphans=True, as_json=False):
+    """
+    Check that every object the local database needs is stored, and the size it was uploaded
+    as, and list stored objects no entry needs. Exits with 1 if anything is missing, the wrong
+    size, or couldn't be checked
+    """
+
+    import json
+    from cstash.crypto.verifier import Verifier
+
+    report = Verifier(ctx.obj.get('cstash_directory'), ctx.obj.get('config'), ctx.obj.get('log_level'),
+                      jobs=jobs, orphans=orphans).run()
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        for bucket in report["buckets"]:
+            for problem in bucket["missing"]:
+                print(f"Missing {problem['key']} from {bucket['bucket']}, needed by {', '.join(problem['paths'])}")
+            for problem in bucket["size_mismatched"]:
+                expected = problem.get("expected_size", f"at least {problem.get('minimum_size')}")
+                print(f"{problem['key']} in {bucket['bucket']} is {problem['size']} bytes instead of {expected}, " \
+                      f"needed by {', '.join(problem['paths'])}")
+            for problem in bucket["orphaned"] or []:
+                print(f"Orphaned {problem['key']} in {bucket['bucket']}, {problem['size']} bytes")
+            for error in bucket["errors"]:
+                print(f"Couldn't verify {bucket['bucket']}: {error}")
+            print(f"{bucket['bucket']}: checked {bucket['objects']} objects, {len(bucket['missing'])} missing, " \
+                  f"{len(bucket['size_mismatched'])} the wrong size, " \
+                  f"{'unknown' if bucket['orphaned'] is None else len(bucket['orphaned'])} orphaned")
+
+    if not report["ok"]:
+        sys.exit(1)
 
 @database.command()
 @click.pass_context
@@ -214,7 +238,8 @@ def backup(ctx, cryptographer, key, storage_provider, ask_for_s3_credentials, s3
     log_level = ctx.obj.get('log_level')
     encryption = crypto.Encryption(cstash_directory, config["cryptographer"], log_level)
 
-    this_path = f"{cstash_directory}/filenames.sqlite"
+    from cstash.crypto.filenames_database import FilenamesDatabase
+    this_path = FilenamesDatabase(cstash_directory, log_level).checkpoint()
 
     encrypted_file_path = encryption.encrypt(
         source_filepath=this_path, destination_filename="filenames.sqlite.encrypted", key=config["key"])
@@ -225,7 +250,10 @@ def backup(ctx, cryptographer, key, storage_provider, ask_for_s3_credentials, s3
         log_level=log_level,
         s3_endpoint_url=config['s3_endpoint_url'],
         s3_access_key_id=config['s3_access_key_id'],
-        s3_secret_access_key=config['s3_secret_access_key']
+        s3_secret_access_key=config['s3_secret_access_key'],
+        cstash_directory=cstash_directory,
+        manifest_max_age=config.get('manifest_max_age'),
+        transfer_config=config
     )
 
     storage.upload(config["bucket"], encrypted_file_path)
@@ -267,7 +295,8 @@ def restore(ctx, cryptographer, key, storage_provider, s3_endpoint_url, bucket):
         log_level=log_level,
         s3_endpoint_url=config['s3_endpoint_url'],
         s3_access_key_id=config['s3_access_key_id'],
-        s3_secret_access_key=config['s3_secret_access_key']
+        s3_secret_access_key=config['s3_secret_access_key'],
+        transfer_config=config
     )
 
     storage.download(config['bucket'], remote_filename, temporary_file)
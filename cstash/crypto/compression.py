@@ -0,0 +1,168 @@
+"""
+Compression of plaintext before it's encrypted, since ciphertext can't be compressed.
+
+zstd is used if the zstandard package is installed (pip install cstash[zstd]), otherwise zlib
+from the standard library. The start of each file is compressed as a sample first, and files
+which don't shrink enough, such as media or archives, are stored uncompressed.
+
+The codec used for a file is recorded in its database entry, so that fetch can decompress it.
+Both directions work as streams, so memory use doesn't depend on file size.
+"""
+
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ("zstd", "zlib")
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+# How much of the start of a file is compressed to decide whether compressing it is worthwhile
+SAMPLE_SIZE = 64 * 1024
+# Files whose sample doesn't compress to less than this fraction of its size aren't compressed
+MAXIMUM_RATIO = 0.9
+READ_SIZE = 1024 * 1024
+
+def available_codec(codec):
+    """
+    Return the codec which will be used when [codec] is asked for, or None for no
+    compression. zstd falls back to zlib if zstandard isn't installed
+    """
+
+    if codec is None or str(codec).lower() in ("", "none", "false"):
+        return None
+
+    codec = str(codec).lower()
+    if codec not in CODECS:
+        logging.error(f"Unknown compression codec {codec}, not compressing")
+        return None
+
+    if codec == "zstd" and zstandard is None:
+        logging.info("zstandard isn't installed, using zlib for compression instead")
+        return "zlib"
+
+    return codec
+
+def compressor(codec):
+    """ Return a new streaming compressor object for [codec], with compress() and flush() """
+
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    return zlib.compressobj(ZLIB_LEVEL)
+
+def decompressor(codec):
+    """ Return a new streaming decompressor object for [codec], with decompress() """
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This file was compressed with zstd. Install zstandard to fetch it")
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return zlib.decompressobj()
+
+def choose(filepath, codec):
+    """
+    Return [codec] if a sample from the start of [filepath] compresses well enough with it,
+    or None if the file should be stored uncompressed
+    """
+
+    if codec is None:
+        return None
+
+    with open(filepath, "rb") as sample_file:
+        sample = sample_file.read(SAMPLE_SIZE)
+
+    if not sample:
+        return None
+
+    sample_compressor = compressor(codec)
+    compressed_size = len(sample_compressor.compress(sample)) + len(sample_compressor.flush())
+    if compressed_size >= len(sample) * MAXIMUM_RATIO:
+        logging.debug(f"{filepath} doesn't compress well, storing it uncompressed")
+        return None
+
+    return codec
+
+def compress_bytes(data, codec):
+    """ Return [data] compressed with [codec] """
+
+    data_compressor = compressor(codec)
+    return data_compressor.compress(data) + data_compressor.flush()
+
+def decompress_bytes(data, codec):
+    """ Return [data] decompressed with [codec] """
+
+    data_decompressor = decompressor(codec)
+    return data_decompressor.decompress(data)
+
+class CompressingReader():
+    """
+    Binary file object reading the contents of the binary file object [source], compressed
+    with [codec]
+    """
+
+    def __init__(self, source, codec):
+        self.source = source
+        self.compressor = compressor(codec)
+        self.buffer = bytearray()
+        self.finished = False
+
+    def read(self, size=-1):
+        """ Return up to [size] bytes of compressed data, or all of it if [size] is negative """
+
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            block = self.source.read(READ_SIZE)
+            if block:
+                self.buffer += self.compressor.compress(block)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+class DecompressingWriter():
+    """
+    Binary file object which decompresses everything written to it with [codec], and writes
+    the result to the binary file object [destination]
+    """
+
+    def __init__(self, destination, codec):
+        self.destination = destination
+        self.decompressor = decompressor(codec)
+
+    def write(self, data):
+        """
+        Decompress [data] into the destination, and return the number of bytes taken. zlib
+        output is written READ_SIZE bytes at a time
+        """
+
+        if not hasattr(self.decompressor, "unconsumed_tail"):
+            self.destination.write(self.decompressor.decompress(data))
+            return len(data)
+
+        pending = data
+        while pending:
+            self.destination.write(self.decompressor.decompress(pending, READ_SIZE))
+            pending = self.decompressor.unconsumed_tail
+
+        return len(data)
+
+    def flush(self):
+        """ Flush the destination """
+
+        self.destination.flush()
+
+    def finish(self):
+        """ Write out anything the decompressor still holds, once all data has been written """
+
+        if hasattr(self.decompressor, "unconsumed_tail"):
+            self.destination.write(self.decompressor.flush())
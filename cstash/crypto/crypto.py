@@ -3,8 +3,46 @@ Calls the appropriate module to perform encryption tasks. At the moment
 only GnuPG is supported.
 """
 
+import io
+import logging
+import os
+import uuid
 import cstash.libs.helpers as helpers
 import cstash.libs.exceptions as cstash_exceptions
+from cstash.crypto import compression as compression_codecs
+
+class HashingReader():
+    """
+    Binary file object reading [source], which updates the hashlib object [file_hash] with
+    everything read, so that a file can be hashed in the same pass that encrypts it
+    """
+
+    def __init__(self, source, file_hash):
+        self.source = source
+        self.file_hash = file_hash
+
+    def read(self, size=-1):
+        """ Return up to [size] bytes from the source, or all of it if [size] is negative """
+
+        data = self.source.read(size)
+        self.file_hash.update(data)
+
+        return data
+
+class CountingChunks():
+    """
+    Iterable over the pieces of bytes yielded by [chunks], adding up their length in [size] as
+    they pass, so that the size of a stream is known once it's been consumed
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            yield chunk
 
 class Encryption():
     """
@@ -25,9 +63,11 @@ class Encryption():
             self.encryptor = PCrypt(cstash_directory=cstash_directory,
                                     log_level=log_level)
 
-    def encrypt(self, source_filepath, destination_filename, key):
+    def encrypt(self, source_filepath, destination_filename, key, compression=None, file_hash=None):
         """
-        Encrypt [source_filepath] into the [cstash_directory] as [destination_filename] using [key].
+        Encrypt [source_filepath] into the [cstash_directory] as [destination_filename] using [key],
+        compressing it with the [compression] codec first if given. The hashlib object
+        [file_hash], if given, is updated with the plaintext as it's read.
 
         Return the complete path for the encrypted file for success, or raise a
         CstashCriticalException
@@ -35,6 +75,16 @@ class Encryption():
 
         encrypted_filepath = f"{self.cstash_directory}/{destination_filename}"
 
+        if compression is not None or file_hash is not None:
+            try:
+                with open(encrypted_filepath, "wb+") as encrypted_file:
+                    for encrypted_chunk in self.encrypt_stream(source_filepath, key, compression, file_hash):
+                        encrypted_file.write(encrypted_chunk)
+                return encrypted_filepath
+            except Exception as e:
+                logging.error("Couldn't encrypt {}: {}".format(source_filepath, e))
+                raise cstash_exceptions.CstashCriticalException(message=f"Couldn't encrypt {source_filepath}")
+
         encrypted_filename = self.encryptor.encrypt(
             source_filepath=source_filepath, key=key, destination_filepath=encrypted_filepath)
         if encrypted_filename is not False:
@@ -42,6 +92,33 @@ class Encryption():
 
         raise cstash_exceptions.CstashCriticalException(message=encrypted_filename)
 
+    def encrypt_stream(self, source_filepath, key, compression=None, file_hash=None):
+        """
+        Encrypt [source_filepath] using [key] without writing anything to disk, and yield the
+        encrypted data in pieces as it's produced. The file is compressed with the
+        [compression] codec on the way, if given, and the hashlib object [file_hash] is
+        updated with the plaintext if given, so the file is only read once. Errors are raised
+        to the consumer
+        """
+
+        with open(source_filepath, "rb") as source_file:
+            if file_hash is not None:
+                source_file = HashingReader(source_file, file_hash)
+            if compression is not None:
+                source_file = compression_codecs.CompressingReader(source_file, compression)
+            yield from self.encryptor.encrypt_stream(source_file, key)
+
+    def encrypt_bytes(self, data, key, compression=None):
+        """
+        Return [data] encrypted using [key], compressed with the [compression] codec first if
+        given. Errors are raised to the caller
+        """
+
+        if compression is not None:
+            data = compression_codecs.compress_bytes(data, compression)
+
+        return b"".join(self.encryptor.encrypt_stream(io.BytesIO(data), key))
+
     def decrypt(self, filepath, destination, key, password=None):
         """
         Decrypt [filepath] to [destination]
@@ -55,3 +132,51 @@ class Encryption():
             return decrypted_filename
 
         raise cstash_exceptions.CstashCriticalException(message=decrypted_filename)
+
+    def decrypt_bytes(self, source, key, password=None, compression=None):
+        """
+        Decrypt the binary file object [source] in memory, decompress it with the
+        [compression] codec if given, and return the plaintext. Errors are raised to the caller
+        """
+
+        plaintext = io.BytesIO()
+        self.encryptor.decrypt_stream(source, plaintext, key, password)
+
+        if compression is not None:
+            return compression_codecs.decompress_bytes(plaintext.getvalue(), compression)
+
+        return plaintext.getvalue()
+
+    def decrypt_stream(self, source, destination, key, password=None, compression=None):
+        """
+        Decrypt the binary file object [source], for example a download in progress, to
+        [destination] without any intermediate copy, decompressing it with the [compression]
+        codec on the way if given. The plaintext is written next to the cleared [destination]
+        path under a temporary name, and renamed into place only once decryption has
+        finished, so a failure never leaves a partial file behind.
+
+        Return the complete path for the decrypted file for success, or raise a
+        CstashCriticalException
+        """
+
+        destination = helpers.clear_path(destination)
+        directory, filename = os.path.split(destination)
+        partial_path = f"{directory}/.{filename}.{uuid.uuid4().hex[:8]}.partial"
+
+        try:
+            partial_fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with os.fdopen(partial_fd, "wb") as partial_file:
+                if compression is None:
+                    self.encryptor.decrypt_stream(source, partial_file, key, password)
+                else:
+                    decompressing_file = compression_codecs.DecompressingWriter(partial_file, compression)
+                    self.encryptor.decrypt_stream(source, decompressing_file, key, password)
+                    decompressing_file.finish()
+            os.replace(partial_path, destination)
+        except Exception as e:
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            logging.error("Couldn't decrypt to {}: {}".format(destination, e))
+            raise cstash_exceptions.CstashCriticalException(message=f"Couldn't decrypt to {destination}")
+
+        return destination
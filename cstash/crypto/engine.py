@@ -0,0 +1,284 @@
+"""
+Stash files one after another with long lived encryption, database, and storage objects, so that
+callers which stash many files over time, such as the daemon, only pay for hashing, encryption,
+and uploading per file.
+
+Used by both `cstash stash` and the daemon. The engine can be shared between threads.
+
+With the profile's [chunked] option set to true, files are stashed as content-defined chunks,
+as described in cstash.crypto.chunked. With its [compression] option set to a codec, files which
+compress well are compressed before encryption, as described in cstash.crypto.compression. With
+its [pack] option set to true, files smaller than [pack_threshold] bytes are gathered into shared
+pack objects of about [pack_size] bytes, as described in cstash.crypto.packs. Files stashed one
+at a time with stash_file(), as the daemon does, are never packed, since a pack of a single file
+would only add a ranged GET to fetching it.
+
+Files which aren't chunked are first looked up by contents, and a copy of a file already stashed
+with the same key and bucket shares that file's object instead of being uploaded again, as
+described in cstash.crypto.filenames_database
+"""
+
+import hashlib
+import logging
+import os
+import cstash.libs.exceptions as exceptions
+from cstash.crypto import compression as compression_codecs
+from cstash.crypto.chunked import ChunkedStorage, DEFAULT_CHUNK_JOBS
+from cstash.crypto.crypto import CountingChunks, Encryption
+from cstash.crypto.filenames_database import FilenamesDatabase, STORE_BATCH_SIZE
+from cstash.crypto.packs import PackWriter, DEFAULT_PACK_THRESHOLD, DEFAULT_PACK_SIZE
+from cstash.storage.storage import Storage
+
+class StashEngine():
+    """
+    Stash files using the settings in [config], which must have every option `cstash stash`
+    needs: cryptographer, key, storage_provider, s3_endpoint_url, s3_access_key_id,
+    s3_secret_access_key, and bucket. Chunks are transferred [jobs] at once
+    """
+
+    def __init__(self, cstash_directory, config, log_level="ERROR", jobs=DEFAULT_CHUNK_JOBS):
+        self.cstash_directory = cstash_directory
+        self.config = config
+        self.log_level = log_level
+        self.filename_db = FilenamesDatabase(cstash_directory, log_level, keep_open=True)
+        self.encryption = Encryption(cstash_directory, config["cryptographer"], log_level)
+        self.storage = Storage(
+            storage_provider=config["storage_provider"],
+            log_level=log_level,
+            s3_endpoint_url=config['s3_endpoint_url'],
+            s3_access_key_id=config['s3_access_key_id'],
+            s3_secret_access_key=config['s3_secret_access_key'],
+            max_pool_connections=config.get('max_pool_connections'),
+            cstash_directory=cstash_directory,
+            manifest_max_age=config.get('manifest_max_age'),
+            transfer_config=config
+        )
+        self.chunked = str(config.get('chunked')).lower() == "true"
+        self.compression = compression_codecs.available_codec(config.get('compression'))
+        self.packing = str(config.get('pack')).lower() == "true"
+        self.pack_threshold = int(config.get('pack_threshold') or DEFAULT_PACK_THRESHOLD)
+        self.pack_size = int(config.get('pack_size') or DEFAULT_PACK_SIZE)
+        self.chunked_storage = ChunkedStorage(
+            cstash_directory, self.encryption, self.storage, self.filename_db, jobs=jobs)
+
+    def unchanged(self, path, stored_entry=None):
+        """
+        Return True if [path] is unchanged since it was last stashed. [stored_entry] may be
+        given if it's already been looked up
+        """
+
+        return self.filename_db.existing_hash(path, stored_entry)
+
+    def compression_for(self, path):
+        """ Return the codec to compress [path] with, or None to store it uncompressed """
+
+        return compression_codecs.choose(path, self.compression)
+
+    def duplicate_of(self, path):
+        """
+        Return a tuple of the (path, entry) tuple for a stashed copy of [path] which it can
+        share an object with, or None, and the hash of [path] if it had to be hashed, or None
+        """
+
+        return self.filename_db.find_duplicate(
+            path, self.config["cryptographer"], self.config["key"], self.config["s3_endpoint_url"],
+            self.config["bucket"])
+
+    def upload(self, path, compression=None, filename_hash=None, file_hash=None):
+        """
+        Encrypt [path] straight into an upload to the object [filename_hash], or the one
+        FilenamesDatabase.object_name() gives, compressing it with [compression] first if
+        given, without recording it in the database. The hashlib object [file_hash], if given,
+        is updated with the file's contents in the same pass. Return the number of bytes
+        stored for success, False for failure
+        """
+
+        filename_hash = filename_hash or self.filename_db.object_name(path)
+        encrypted = CountingChunks(self.encryption.encrypt_stream(
+            source_filepath=path, key=self.config["key"], compression=compression, file_hash=file_hash))
+        uploaded = self.storage.upload_stream(
+            self.config["bucket"], filename_hash, encrypted, size_hint=os.path.getsize(path))
+        if uploaded is not True:
+            logging.error(f"Couldn't upload {path}, it will not be recorded in the database")
+            return False
+
+        logging.debug('Uploaded {} to {}'.format(filename_hash, self.config["storage_provider"]))
+        return encrypted.size
+
+    def upload_chunked(self, path):
+        """
+        Upload the chunks of [path] which aren't stored yet, and record it in the database
+        along with its chunk manifest. Return True for success, False for failure
+        """
+
+        compression = self.compression_for(path)
+        try:
+            manifest, file_hash, uploaded = self.chunked_storage.upload(
+                path, self.config["cryptographer"], self.config["key"], self.config["s3_endpoint_url"],
+                self.config["bucket"], compression)
+        except exceptions.CstashUploadError:
+            logging.error(f"Couldn't upload {path}, it will not be recorded in the database")
+            return False
+
+        self.filename_db.store_chunked(
+            path, manifest,
+            cryptographer=self.config["cryptographer"],
+            key=self.config['key'],
+            storage_provider=self.config["storage_provider"],
+            s3_endpoint_url=self.config["s3_endpoint_url"],
+            bucket=self.config["bucket"],
+            file_hash=file_hash,
+            compression=compression)
+        logging.info(f"Uploaded {uploaded} new chunks of {len(manifest)} for {path}")
+
+        return True
+
+    def packable(self, path):
+        """ Return True if [path] should be stored in a pack """
+
+        return self.packing and not self.chunked and os.path.getsize(path) < self.pack_threshold
+
+    def record(self, paths, compressions=None, packs=None, overrides=None):
+        """
+        Write database entries for the uploaded [paths] in a single transaction. [compressions]
+        is a dict of path to the codec it was compressed with, for those that were, [packs] of
+        path to (pack_id, offset, length), for those stored in packs, and [overrides] of path
+        to entry fields, as FilenamesDatabase.store_many() takes
+        """
+
+        self.filename_db.store_many(
+            objs=paths,
+            cryptographer=self.config["cryptographer"],
+            key=self.config['key'],
+            storage_provider=self.config["storage_provider"],
+            s3_endpoint_url=self.config["s3_endpoint_url"],
+            bucket=self.config["bucket"],
+            compressions=compressions,
+            packs=packs,
+            overrides=overrides)
+        logging.debug('Updated the local database with entries for filenames mapped to the obsfucated names')
+
+    def stash(self, paths, force=False, pack=True):
+        """
+        Upload every path in [paths] that changed since it was last stashed, or all of them
+        with [force]. Database entries are written in batches of STORE_BATCH_SIZE. Small files
+        are only packed if packing is enabled and [pack] is True.
+
+        Yield a ('uploaded' | 'shared' | 'skipped' | 'failed', path) tuple for each path as it's
+        done, where 'shared' is a copy of a stashed file which now shares its object. Files going
+        into a pack are only done once their pack has been uploaded
+        """
+
+        stored_entries = self.filename_db.lookup_many(paths)
+        uploaded_paths = []
+        compressions = {}
+        packs = {}
+        overrides = {}
+        pack_members = {}
+        pack_writer = PackWriter(self.encryption, self.storage, self.config["key"], self.config["bucket"],
+                                 self.pack_size)
+
+        def finish(uploaded, this_path, compression=None, pack=None, entry_overrides=None, status='uploaded'):
+            """ Queue [this_path] to be recorded if it was [uploaded], and return its status """
+
+            if not uploaded:
+                return ('failed', this_path)
+
+            uploaded_paths.append(this_path)
+            if compression is not None:
+                compressions[this_path] = compression
+            if pack is not None:
+                packs[this_path] = pack
+            if entry_overrides:
+                overrides[this_path] = entry_overrides
+            if len(uploaded_paths) >= STORE_BATCH_SIZE:
+                self.record(uploaded_paths, compressions, packs, overrides)
+                uploaded_paths.clear()
+                compressions.clear()
+                packs.clear()
+                overrides.clear()
+
+            return (status, this_path)
+
+        def finish_pack(pack_result):
+            """ Finish every member of the pack in [pack_result], as returned by PackWriter """
+
+            uploaded, members = pack_result
+            finished = []
+            for member_path, pack in members:
+                compression, entry_overrides = pack_members.pop(member_path)
+                finished.append(finish(uploaded, member_path, compression, pack, entry_overrides))
+
+            return finished
+
+        def stash_path(this_path):
+            """ Stash [this_path], and yield the statuses of it and any other paths it finished """
+
+            stored_entry = stored_entries.get(this_path)
+            file_stored = stored_entry is not None and self.unchanged(this_path, stored_entry)
+            if file_stored and force is not True:
+                yield ('skipped', this_path)
+                return
+            if file_stored and force is True:
+                logging.warning("Re-uploading existing file: {}".format(this_path))
+
+            if self.chunked:
+                yield ('uploaded' if self.upload_chunked(this_path) else 'failed', this_path)
+                return
+
+            duplicate, file_hash = (None, None) if force is True else self.duplicate_of(this_path)
+            if duplicate is not None:
+                yield finish(True, this_path,
+                             entry_overrides=self.filename_db.shared_entry(duplicate[1], file_hash),
+                             status='shared')
+                return
+
+            hashed = { "file_hash": file_hash } if file_hash else None
+            compression = self.compression_for(this_path)
+            if pack and self.packable(this_path):
+                pack_members[this_path] = (compression, hashed)
+                yield from finish_pack(pack_writer.add(this_path, compression))
+                return
+
+            filename_hash = self.filename_db.object_name(this_path)
+            file_stat = os.stat(this_path)
+            file_hash = hashlib.sha256()
+            stored_size = self.upload(this_path, compression, filename_hash, file_hash)
+            if stored_size is not False:
+                self.filename_db.fingerprints.remember(this_path, file_stat, file_hash.hexdigest())
+            yield finish(stored_size is not False, this_path, compression,
+                         entry_overrides={ "filename_hash": filename_hash, "file_hash": file_hash.hexdigest(),
+                                           "stored_size": stored_size })
+
+        try:
+            for this_path in paths:
+                # A file which can't be read or uploaded fails on its own, without stopping the rest
+                try:
+                    statuses = list(stash_path(this_path))
+                except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                    logging.error(f"Couldn't stash {this_path}: {e}")
+                    pack_members.pop(this_path, None)
+                    statuses = [('failed', this_path)]
+                yield from statuses
+
+            yield from finish_pack(pack_writer.flush())
+        finally:
+            if uploaded_paths:
+                self.record(uploaded_paths, compressions, packs, overrides)
+
+    def stash_file(self, path, force=False):
+        """
+        Stash the single file at [path] as its own object, and record it straight away. Return
+        'uploaded', 'shared', 'skipped', or 'failed'
+        """
+
+        status = None
+        for status, _ in self.stash([path], force=force, pack=False):
+            pass
+
+        return status
+
+    def close(self):
+        """ Close the database connections held by the engine """
+
+        self.filename_db.close()
@@ -0,0 +1,149 @@
+"""
+Fetch many stashed files at once, such as a whole directory after a disk failure.
+
+Matches are grouped by endpoint and bucket, and fetched by [jobs] threads sharing one Storage per
+endpoint and one Encryption per cryptographer. Each file is decrypted as its download arrives, so
+downloads and decryption overlap both within a file and across files. A file which can't be
+fetched is logged and counted, and the rest carry on
+"""
+
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cstash.crypto.chunked import ChunkedStorage
+from cstash.crypto.crypto import Encryption
+from cstash.crypto.filenames_database import FilenamesDatabase
+from cstash.crypto.packs import PACK_PREFIX
+from cstash.storage.s3 import TRANSFER_MAX_CONCURRENCY
+from cstash.storage.storage import Storage
+
+class Fetcher():
+    """
+    Fetch database entries using [jobs] threads, with the S3 credentials in [config].
+    [storage_provider], [s3_endpoint_url], and [bucket] override those recorded in the entries
+    if given, and [password] is used for decryption if given
+    """
+
+    def __init__(self, cstash_directory, config, log_level="ERROR", jobs=1, storage_provider=None,
+                 s3_endpoint_url=None, bucket=None, password=None):
+        self.cstash_directory = cstash_directory
+        self.config = config
+        self.log_level = log_level
+        self.jobs = jobs
+        self.storage_provider = storage_provider
+        self.s3_endpoint_url = s3_endpoint_url
+        self.bucket = bucket
+        self.password = password
+        self.filename_db = FilenamesDatabase(cstash_directory, log_level)
+        self.storages = {}
+        self.encryptions = {}
+        self.lock = threading.Lock()
+
+    def storage(self, storage_provider, s3_endpoint_url):
+        """ Return the Storage for [storage_provider] at [s3_endpoint_url], creating it once """
+
+        with self.lock:
+            if (storage_provider, s3_endpoint_url) not in self.storages:
+                self.storages[(storage_provider, s3_endpoint_url)] = Storage(
+                    storage_provider,
+                    log_level=self.log_level,
+                    s3_endpoint_url=s3_endpoint_url,
+                    s3_access_key_id=self.config['s3_access_key_id'],
+                    s3_secret_access_key=self.config['s3_secret_access_key'],
+                    max_pool_connections=self.config.get('max_pool_connections') or self.jobs * TRANSFER_MAX_CONCURRENCY,
+                    transfer_config=self.config
+                )
+
+            return self.storages[(storage_provider, s3_endpoint_url)]
+
+    def encryption(self, cryptographer):
+        """ Return the Encryption for [cryptographer], creating it once """
+
+        with self.lock:
+            if cryptographer not in self.encryptions:
+                self.encryptions[cryptographer] = Encryption(
+                    cstash_directory=self.cstash_directory, cryptographer=cryptographer, log_level=self.log_level)
+
+            return self.encryptions[cryptographer]
+
+    def location(self, entry):
+        """ Return the (s3_endpoint_url, bucket) tuple to fetch [entry] from """
+
+        return (self.s3_endpoint_url or entry['s3_endpoint_url'] or "", self.bucket or entry['bucket'] or "")
+
+    def group(self, entries):
+        """
+        Return the (path, entry) tuples in [entries] sorted so that those stored at the same
+        endpoint and bucket are fetched together
+        """
+
+        return sorted(entries, key=lambda e: self.location(e[1]))
+
+    def fetch(self, this_path, entry):
+        """
+        Download and decrypt the stashed file [this_path] described by [entry] back into place.
+
+        Return the path of the decrypted file, or raise a CstashCriticalException
+        """
+
+        s3_endpoint_url, bucket = self.location(entry)
+        storage_provider = self.storage_provider or entry['storage_provider']
+        storage = self.storage(storage_provider, s3_endpoint_url or None)
+        encryption = self.encryption(entry['cryptographer'])
+        logging.debug("Fetching {} {} from the database for {}".format(
+            entry['filename_hash'], entry['cryptographer'], this_path))
+
+        if entry.get('chunked'):
+            manifest = self.filename_db.manifest(this_path)
+            logging.debug('Fetching {} chunks from {}'.format(len(manifest), storage_provider))
+            return ChunkedStorage(self.cstash_directory, encryption, storage, self.filename_db, jobs=self.jobs).fetch(
+                manifest, this_path, bucket, entry['key'], self.password, entry.get('compression'))
+
+        if entry.get('pack_id'):
+            logging.debug('Streaming {} from pack {}'.format(this_path, entry['pack_id']))
+            body = storage.download_stream(
+                bucket, f"{PACK_PREFIX}{entry['pack_id']}", byte_range=(entry['pack_offset'], entry['pack_length']))
+        else:
+            logging.debug('Streaming {} from {}'.format(entry['filename_hash'], storage_provider))
+            body = storage.download_stream(bucket, entry['filename_hash'])
+
+        return encryption.decrypt_stream(body, this_path, entry['key'], self.password, entry.get('compression'))
+
+    def run(self, entries):
+        """
+        Fetch every (path, entry) tuple in [entries], [self.jobs] at once, and yield a
+        ('fetched' | 'failed', path) tuple for each path as it's done, on the calling thread
+        """
+
+        finished = queue.Queue()
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+        pending = 0
+
+        def fetch_one(this_path, entry):
+            try:
+                decrypted_file_path = self.fetch(this_path, entry)
+                logging.debug('Decrypted {} to {}'.format(this_path, decrypted_file_path))
+                finished.put(('fetched', this_path))
+            except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                logging.error(f"Couldn't fetch {this_path}: {e}")
+                finished.put(('failed', this_path))
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for (s3_endpoint_url, bucket), group in itertools.groupby(
+                    self.group(entries), key=lambda e: self.location(e[1])):
+                logging.debug(f"Fetching files from {bucket} at {s3_endpoint_url}")
+                for this_path, entry in group:
+                    slots.acquire()
+                    pool.submit(fetch_one, this_path, entry)
+                    pending += 1
+                    while not finished.empty():
+                        pending -= 1
+                        yield finished.get()
+
+            while pending:
+                pending -= 1
+                yield finished.get()
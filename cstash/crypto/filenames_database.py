@@ -1,36 +1,317 @@
 """
 Used to perform operations on the filenames database, which stores a mapping from the real filename
 to the hashed filename, and other metadata
+
+The mapping is kept in typed tables, with directory paths stored once and shared by the files in
+them:
+
+    directories   — id, path
+    files         — directory_id, basename, and one column per entry field, with indexes on
+                    file_hash, bucket, mtime, size, pack_id, and (device, inode)
+    path_trigrams — an FTS5 trigram index of every full path, for substring and glob searches
+    manifests     — for files stashed in chunks, the ordered chunk ids and sizes making them up
+    chunks        — every chunk known to be stored, per endpoint and bucket
+
+The [filename_hash] field of an entry is the name of the object its contents are stored in. It's
+the hash of the entry's own path, unless the file was a copy of one already stashed, in which case
+it's the other entry's object, shared between them. The number of entries sharing an object is its
+reference count, so an object is never overwritten while something else refers to it, and is
+only deleted by `cstash storage gc` once nothing does.
+An entry's [stored_size] is the number of bytes uploaded to its object, where it was known.
+
+Databases written by earlier versions as a pickled SqliteDict are migrated the first time they're
+opened.
 """
 
 # -*- coding: utf-8 -*-
 
-from sqlitedict import SqliteDict
+from sqlitedict import decode
 import cstash.libs.exceptions as exceptions
+from cstash.crypto.chunked import CHUNK_PREFIX
+from cstash.crypto.fingerprints import FingerprintCache
+from cstash.crypto.packs import PACK_PREFIX
 import logging
 import hashlib
 import os
+import sqlite3
+import threading
+import uuid
+
+SCHEMA_VERSION = 6
+# The table earlier versions kept the pickled SqliteDict mapping in
+LEGACY_TABLE_NAME = "unnamed"
+# Fields of an entry, in the order they're stored in the [files] table
+ENTRY_FIELDS = ("filename_hash", "cryptographer", "key", "storage_provider", "s3_endpoint_url",
+                "bucket", "file_hash", "mtime", "size", "chunked", "compression", "pack_id", "pack_offset",
+                "pack_length", "device", "inode", "stored_size")
+# Columns added to tables after they were first created, as (schema version, table, column, type)
+ADDED_COLUMNS = [ (2, "files", "chunked", "INTEGER"),
+                  (3, "files", "compression", "TEXT"),
+                  (4, "files", "pack_id", "TEXT"),
+                  (4, "files", "pack_offset", "INTEGER"),
+                  (4, "files", "pack_length", "INTEGER"),
+                  (5, "files", "device", "INTEGER"),
+                  (5, "files", "inode", "INTEGER"),
+                  (6, "files", "stored_size", "INTEGER") ]
+# SQLite limits the number of bound parameters in a single statement
+LOOKUP_BATCH_SIZE = 250
+# Number of entries written per transaction by callers of store_many()
+STORE_BATCH_SIZE = 1000
+# The trigram tokenizer can't match anything shorter than this
+TRIGRAM_LENGTH = 3
+GLOB_CHARACTERS = ("*", "?", "[")
+# SQL for the full path of a row in [files] joined as [f] with [directories] joined as [d]
+FULL_PATH = "(CASE d.path WHEN '/' THEN '/' ELSE d.path || '/' END || f.basename)"
+SELECT_ENTRIES = "SELECT d.path, f.basename, {} FROM files f JOIN directories d ON d.id = f.directory_id".format(
+    ", ".join(f"f.{field}" for field in ENTRY_FIELDS))
 
 class FilenamesDatabase():
     """
     Creates and manages filename obsfucation database
     """
 
-    def __init__(self, cstash_directory, log_level=None): # pylint: disable=unused-argument
-        """ Create the cstash SQLite DB """
+    def __init__(self, cstash_directory, log_level=None, keep_open=False): # pylint: disable=unused-argument
+        """
+        Create the cstash SQLite DB, or migrate it to the current schema. With [keep_open],
+        each thread reuses one connection to the default DB until close() is called, instead
+        of opening a new one per operation
+        """
         self.db = "{}/filenames.sqlite".format(cstash_directory)
+        self.trigrams = False
+        self.keep_open = keep_open
+        self.local = threading.local()
+        self.open_connections = []
+        self.open_connections_lock = threading.Lock()
+        self.fingerprints = FingerprintCache(cstash_directory)
+        self.create_schema()
+
+    def connect(self, db=None):
+        """
+        Return a sqlite3 connection to [db]. Pass it to release() rather than closing it, in
+        case it's being kept open
+        """
+
+        if self.keep_open is not True or db not in (None, self.db):
+            return sqlite3.connect(db or self.db, timeout=30)
+
+        db_connection = getattr(self.local, "db_connection", None)
+        if db_connection is None:
+            db_connection = sqlite3.connect(self.db, timeout=30, check_same_thread=False)
+            self.local.db_connection = db_connection
+            with self.open_connections_lock:
+                self.open_connections.append(db_connection)
+
+        return db_connection
+
+    def release(self, db_connection):
+        """ Close [db_connection], unless it's one being kept open by connect() """
+
+        if db_connection is not getattr(self.local, "db_connection", None):
+            db_connection.close()
+
+    def close(self):
+        """ Close every connection kept open by connect(), from any thread """
+
+        with self.open_connections_lock:
+            for db_connection in self.open_connections:
+                db_connection.close()
+            self.open_connections.clear()
+        self.local = threading.local()
+        self.fingerprints.close()
+
+    def create_schema(self, db=None):
+        """
+        Create the tables and indexes if they don't exist yet, and move any entries left in a
+        legacy SqliteDict table into them. This is skipped when the DB's user_version shows it's
+        already at SCHEMA_VERSION. Sets [self.trigrams] to whether FTS5 trigram indexing is
+        available. Without it, substring searches scan every path instead
+        """
+
+        db_connection = self.connect(db)
+        db_connection.execute("PRAGMA journal_mode=WAL")
+
+        user_version = db_connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version >= SCHEMA_VERSION:
+            self.trigrams = db_connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'path_trigrams'").fetchone() is not None
+            self.release(db_connection)
+            return self.trigrams
+
+        logging.debug(f"Migrating {db or self.db} from schema version {user_version} to {SCHEMA_VERSION}")
+        with db_connection:
+            db_connection.execute(
+                "CREATE TABLE IF NOT EXISTS directories (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)")
+            db_connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "id INTEGER PRIMARY KEY, "
+                "directory_id INTEGER NOT NULL REFERENCES directories (id), "
+                "basename TEXT NOT NULL, "
+                "filename_hash TEXT NOT NULL, "
+                "cryptographer TEXT, "
+                "key TEXT, "
+                "storage_provider TEXT, "
+                "s3_endpoint_url TEXT, "
+                "bucket TEXT, "
+                "file_hash TEXT, "
+                "mtime REAL, "
+                "size INTEGER, "
+                "UNIQUE (directory_id, basename))")
+            for column in ["file_hash", "bucket", "mtime"]:
+                db_connection.execute(f"CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})")
+            self.add_columns(db_connection)
+            for column in ["size", "pack_id"]:
+                db_connection.execute(f"CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})")
+            db_connection.execute("CREATE INDEX IF NOT EXISTS files_inode ON files (device, inode)")
+            db_connection.execute(
+                "CREATE TABLE IF NOT EXISTS manifests ("
+                "file_id INTEGER NOT NULL REFERENCES files (id), "
+                "position INTEGER NOT NULL, "
+                "chunk_id TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "PRIMARY KEY (file_id, position)) WITHOUT ROWID")
+            db_connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "s3_endpoint_url TEXT NOT NULL, "
+                "bucket TEXT NOT NULL, "
+                "chunk_id TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "PRIMARY KEY (s3_endpoint_url, bucket, chunk_id)) WITHOUT ROWID")
+            try:
+                db_connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS path_trigrams "
+                    "USING fts5(path, tokenize='trigram case_sensitive 1')")
+                self.trigrams = True
+            except sqlite3.OperationalError as e:
+                logging.info(f"No FTS5 trigram support, substring searches will scan all paths: {e}")
+
+        legacy = db_connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (LEGACY_TABLE_NAME,)).fetchone()
+        if legacy is not None:
+            self.migrate_legacy_table(db_connection)
+
+        db_connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.release(db_connection)
+
+        return self.trigrams
+
+    @staticmethod
+    def add_columns(db_connection):
+        """ Add any of ADDED_COLUMNS which are missing over [db_connection], without committing """
+
+        for _, table, column, column_type in ADDED_COLUMNS:
+            existing = [ row[1] for row in db_connection.execute(f"PRAGMA table_info({table})") ]
+            if column not in existing:
+                db_connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def migrate_legacy_table(self, db_connection):
+        """
+        Move every entry from the pickled SqliteDict table into the typed tables over
+        [db_connection], in one transaction, then drop the old table and the indexes earlier
+        versions kept beside it, and reclaim the space
+        """
+
+        rows = db_connection.execute(f'SELECT key, value FROM "{LEGACY_TABLE_NAME}"')
+        entries = ((k, decode(v)) for k, v in rows)
+
+        with db_connection:
+            migrated = self.write_entries(entries, db_connection)
+            db_connection.execute(f'DROP TABLE "{LEGACY_TABLE_NAME}"')
+            db_connection.execute("DROP TABLE IF EXISTS path_index")
+
+        logging.info(f"Migrated {migrated} entries from the legacy database format")
+        db_connection.execute("VACUUM")
+
+    def directory_id(self, directory, db_connection, directory_ids=None):
+        """
+        Return the id of [directory] in the [directories] table, adding it if necessary.
+        [directory_ids] is an optional dict used to cache ids over a batch of writes
+        """
+
+        if directory_ids is not None and directory in directory_ids:
+            return directory_ids[directory]
+
+        db_connection.execute("INSERT OR IGNORE INTO directories (path) VALUES (?)", (directory,))
+        this_id = db_connection.execute("SELECT id FROM directories WHERE path = ?", (directory,)).fetchone()[0]
+
+        if directory_ids is not None:
+            directory_ids[directory] = this_id
+
+        return this_id
+
+    def write_entries(self, entries, db_connection):
+        """
+        Create or overwrite the (path, entry) tuples in [entries] over [db_connection], without
+        committing. Fields missing from an entry are stored as NULL.
+
+        Return the number of entries written
+        """
+
+        directory_ids = {}
+        written = 0
+        columns = ", ".join(ENTRY_FIELDS)
+        placeholders = ", ".join("?" * len(ENTRY_FIELDS))
+        assignments = ", ".join(f"{field} = ?" for field in ENTRY_FIELDS)
+
+        for this_path, entry in entries:
+            values = [ entry.get(field) for field in ENTRY_FIELDS ]
+            this_directory = self.directory_id(os.path.dirname(this_path), db_connection, directory_ids)
+            basename = os.path.basename(this_path)
+            existing = db_connection.execute(
+                "SELECT id FROM files WHERE directory_id = ? AND basename = ?",
+                (this_directory, basename)).fetchone()
+
+            if existing is not None:
+                db_connection.execute(f"UPDATE files SET {assignments} WHERE id = ?", values + [existing[0]])
+                db_connection.execute("DELETE FROM manifests WHERE file_id = ?", (existing[0],))
+            else:
+                cursor = db_connection.execute(
+                    f"INSERT INTO files (directory_id, basename, {columns}) VALUES (?, ?, {placeholders})",
+                    [this_directory, basename] + values)
+                if self.trigrams:
+                    db_connection.execute(
+                        "INSERT INTO path_trigrams (rowid, path) VALUES (?, ?)", (cursor.lastrowid, this_path))
+            written += 1
+
+        return written
+
+    @staticmethod
+    def row_to_entry(row):
+        """ Return a (path, entry) tuple from a [row] selected with SELECT_ENTRIES """
+
+        this_path = os.path.join(row[0], row[1])
+        return (this_path, dict(zip(ENTRY_FIELDS, row[2:])))
 
     def return_all_entries(self, db=None):
         """ Return a dict of the database """
 
-        db = db or self.db
-        db_connection = SqliteDict(db, autocommit=True, flag='r')
-        entries = dict(db_connection)
-        db_connection.close()
+        return dict(self.iter_search(None, db=db))
 
-        return entries
+    def tracked_directories(self, db=None):
+        """ Return a list of every directory which has at least one stashed file in it """
+
+        db_connection = self.connect(db)
+        directories = [ row[0] for row in db_connection.execute(
+            "SELECT path FROM directories WHERE EXISTS (SELECT 1 FROM files WHERE directory_id = directories.id)") ]
+        self.release(db_connection)
 
-    def search(self, obj, exact=False, db=None):
+        return directories
+
+    def tracked_files(self, db=None):
+        """
+        Return a dict of every directory which has stashed files in it, to a dict of the
+        basenames of those files to their stored (mtime, size)
+        """
+
+        db_connection = self.connect(db)
+        directories = {}
+        for path, basename, mtime, size in db_connection.execute(
+                "SELECT d.path, f.basename, f.mtime, f.size FROM files f JOIN directories d ON d.id = f.directory_id"):
+            directories.setdefault(path, {})[basename] = (mtime, size)
+        self.release(db_connection)
+
+        return directories
+
+    def search(self, obj, exact=False, db=None, prefix=False, limit=None):
         """
         Search the database for partial matches of [obj], and return a list of matches
         in the tuple form:
@@ -39,43 +320,97 @@ class FilenamesDatabase():
                   "cryptographer": string,
                   "key": string,
                   "storage_provider": string,
+                  "s3_endpoint_url": string,
                   "bucket": string,
-                  "file_hash": string } )
+                  "file_hash": string,
+                  "mtime": float,
+                  "size": int } )
+
+        See iter_search() for the meaning of [prefix] and [limit], and for glob matching.
 
         If [exact] == True, then only exact matches will be returned. Since there should
         only ever be a single exact match for a path in the DB, a CstashCriticalException
         will be thrown if more than a single element is in the resulting list. This shouldn't
-        be possible anyway, since the DB is a key/value store, but it's a safety measure.
+        be possible anyway, since paths are unique in the DB, but it's a safety measure.
         """
 
-        db = db or self.db
-        db_connection = SqliteDict(db, autocommit=True, flag='r')
-        if exact is True:
-            keys = [(k, db_connection[k]) for k in db_connection.keys() if obj == k]
-        elif obj is None:
-            keys = [(k, db_connection[k]) for k in db_connection.keys()]
-        else:
-            keys = [(k, db_connection[k]) for k in db_connection.keys() if obj in k]
+        keys = list(self.iter_search(obj, exact=exact, db=db, prefix=prefix, limit=limit))
 
         if exact is True and len(keys) > 1:
             raise exceptions.CstashCriticalException(message=(f"Found more than a single match "
                 "for {obj} in the database:\n\n{keys}")) # pylint: disable=bad-continuation
 
-        db_connection.close()
-
         return keys
 
+    def iter_search(self, obj, exact=False, db=None, prefix=False, limit=None):
+        """
+        Yield matches for [obj] in the same form as search(), one at a time, so that large
+        result sets are never held in memory. Which index is used depends on the query:
+
+        * [obj] is None: every entry
+        * [exact] == True: the entry for exactly [obj]
+        * [prefix] == True: entries whose path starts with [obj], such as a directory
+        * [obj] contains any of * ? [: entries whose path matches [obj] as a glob
+        * Otherwise: entries whose path contains [obj]
+
+        At most [limit] matches are yielded, if given
+        """
+
+        from_trigrams = f"{SELECT_ENTRIES} JOIN path_trigrams t ON t.rowid = f.id"
+
+        if obj is None or (prefix is True and obj == ""):
+            query, arguments = SELECT_ENTRIES, []
+        elif exact is True:
+            query = f"{SELECT_ENTRIES} WHERE d.path = ? AND f.basename = ?"
+            arguments = [os.path.dirname(obj), os.path.basename(obj)]
+        elif prefix is True:
+            # Everything in directories starting with [obj], plus files in the directory [obj]
+            # ends in whose names start with the rest of it
+            directory, partial_name = os.path.split(obj)
+            query = f"{SELECT_ENTRIES} WHERE (d.path >= ? AND d.path < ?) OR " \
+                "(d.path = ? AND f.basename >= ? AND f.basename < ?)"
+            arguments = [obj, self.prefix_end(obj), directory, partial_name, self.prefix_end(partial_name)]
+        elif any(c in obj for c in GLOB_CHARACTERS):
+            if self.trigrams:
+                query = f"{from_trigrams} WHERE t.path GLOB ?"
+            else:
+                query = f"{SELECT_ENTRIES} WHERE {FULL_PATH} GLOB ?"
+            arguments = [obj]
+        elif self.trigrams and len(obj) >= TRIGRAM_LENGTH:
+            query = f"{from_trigrams} WHERE path_trigrams MATCH ?"
+            arguments = ['"{}"'.format(obj.replace('"', '""'))]
+        else:
+            query = f"{SELECT_ENTRIES} WHERE instr({FULL_PATH}, ?) > 0"
+            arguments = [obj]
+
+        if limit is not None:
+            query = f"{query} LIMIT ?"
+            arguments.append(limit)
+
+        db_connection = self.connect(db)
+        try:
+            for row in db_connection.execute(query, arguments):
+                yield self.row_to_entry(row)
+        finally:
+            self.release(db_connection)
+
+    @staticmethod
+    def prefix_end(prefix):
+        """ Return the smallest string greater than every string starting with [prefix] """
+
+        if prefix == "":
+            return "\U0010ffff"
+
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
     def file_hash(self, filepath):
         """
-        Return the sha256 hash for the file at [filepath], or False on failure
+        Return the sha256 hash for the file at [filepath], or False on failure. Files which
+        haven't changed since they were last hashed are answered from the fingerprint cache
         """
 
         try:
-            sha256 = hashlib.sha256()
-            with open(filepath, 'rb') as f:
-                for block in iter(lambda: f.read(4096), b''):
-                    sha256.update(block)
-            return sha256.hexdigest()
+            return self.fingerprints.file_hash(filepath)
         except FileNotFoundError as e:
             logging.error(f"Couldn't hash the file {filepath}: {e}")
             return False
@@ -92,52 +427,384 @@ class FilenamesDatabase():
         except Exception:
             return False
 
-    def existing_hash(self, filepath):
+    def existing_hash(self, filepath, entry=None):
         """
-        Check if the hash for [filepath] is the same as the one in the database.
+        Check if the file at [filepath] is unchanged since it was last stored in the database.
+        Size and modification time are compared first, and only if those differ is the file
+        hashed and compared with the stored [file_hash]. On a hash match, the stored size and
+        modification time are refreshed so that the next check is a stat again.
+
+        [entry] may be given if the database entry has already been looked up, for example
+        with lookup_many(), to save a query.
 
         Return True if it's the same, False if not
         """
 
-        existing_entry = self.search(filepath)
+        if entry is not None:
+            return self.entry_unchanged(filepath, entry)
+
+        existing_entry = self.search(filepath, exact=True)
 
         if len(existing_entry) == 0:
             return False
 
-        new_hash = self.filename_hash(filepath)
+        return self.entry_unchanged(filepath, existing_entry[0][1])
 
-        if existing_entry[0][1]['filename_hash'] == new_hash:
+    def entry_unchanged(self, filepath, entry):
+        """
+        Compare the file at [filepath] with its database [entry], as described in
+        existing_hash(). Return True if it's unchanged, False if not
+        """
+
+        try:
+            file_stat = os.stat(filepath)
+        except FileNotFoundError:
+            return False
+
+        if entry.get('size') == file_stat.st_size and entry.get('mtime') == file_stat.st_mtime:
             return True
 
-        return False
+        if entry.get('file_hash') is None or entry['file_hash'] != self.file_hash(filepath):
+            return False
+
+        logging.debug(f"{filepath} has a new modification time, but the same contents")
+        self.update_stat(filepath, file_stat)
 
-    def store(self, obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket, db=None):
+        return True
+
+    def update_stat(self, filepath, file_stat=None, db=None):
+        """
+        Refresh the stored size and modification time for [filepath] from [file_stat], or from
+        a new stat of the file if not given
         """
-        Create or overwrite an entry in the filenames [db] for mapping [obj] to an obsfucated name.
 
-        Return a dict of [entry] denoting the obsfucated filename, and [db_connection] to be
-        used later for closing the connection
+        file_stat = file_stat or os.stat(filepath)
+        db_connection = self.connect(db)
+
+        with db_connection:
+            db_connection.execute(
+                "UPDATE files SET size = ?, mtime = ? WHERE basename = ? AND directory_id = "
+                "(SELECT id FROM directories WHERE path = ?)",
+                (file_stat.st_size, file_stat.st_mtime, os.path.basename(filepath), os.path.dirname(filepath)))
+
+        self.release(db_connection)
+
+    def lookup_many(self, objs, db=None):
+        """
+        Look up the exact paths in [objs] with one query per batch of LOOKUP_BATCH_SIZE paths,
+        over a single connection.
+
+        Return a dict of path to entry, for only those paths that exist in the database
         """
 
-        db = db or self.db
-        db_connection = SqliteDict(db, autocommit=False, flag='c')
+        db_connection = self.connect(db)
+        objs = list(objs)
+        entries = {}
 
-        new_entry = self.filename_hash(obj)
-        if not new_entry:
+        for start in range(0, len(objs), LOOKUP_BATCH_SIZE):
+            batch = objs[start:start + LOOKUP_BATCH_SIZE]
+            query = "{} WHERE (d.path, f.basename) IN (VALUES {})".format(
+                SELECT_ENTRIES, ", ".join(["(?, ?)"] * len(batch)))
+            arguments = [ part for this_path in batch for part in os.path.split(this_path) ]
+            for row in db_connection.execute(query, arguments):
+                this_path, entry = self.row_to_entry(row)
+                entries[this_path] = entry
+
+        self.release(db_connection)
+
+        return entries
+
+    def new_entry(self, obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket, file_hash=None,
+                  compression=None, pack=None, overrides=None):
+        """
+        Return the database entry for [obj], or raise a CstashCriticalException if its name
+        couldn't be hashed. [file_hash] may be given if the file has already been hashed.
+        [compression] is the codec the file was compressed with before encryption, if any, and
+        [pack] is a (pack_id, offset, length) tuple if it was stored in a pack. [overrides] is an
+        optional dict of fields to use instead, such as those from shared_entry()
+        """
+
+        filename_hash = self.filename_hash(obj)
+        if not filename_hash:
             raise exceptions.CstashCriticalException(message="File couldn't be hashed, exiting")
 
-        db_connection[obj] = {
-            "filename_hash": new_entry,
+        overrides = overrides or {}
+        file_stat = os.stat(obj)
+
+        entry = {
+            "filename_hash": filename_hash,
             "cryptographer": cryptographer,
             "key": key,
             "storage_provider": storage_provider,
             "s3_endpoint_url": s3_endpoint_url,
             "bucket": bucket,
-            "file_hash": self.file_hash(obj),
-            "mtime": os.stat(obj).st_mtime }
-        logging.debug("Wrote {} to database".format(db_connection[obj]))
+            "file_hash": file_hash or overrides.get("file_hash") or self.file_hash(obj),
+            "mtime": file_stat.st_mtime,
+            "size": file_stat.st_size,
+            "compression": compression,
+            "pack_id": pack[0] if pack else None,
+            "pack_offset": pack[1] if pack else None,
+            "pack_length": pack[2] if pack else None,
+            "device": file_stat.st_dev,
+            "inode": file_stat.st_ino }
+        entry.update(overrides)
+
+        return entry
+
+    def store(self, obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket, db=None):
+        """
+        Create or overwrite an entry in the filenames [db] for mapping [obj] to an obsfucated name.
+
+        Return a dict of [entry] denoting the obsfucated filename, and [db_connection] to be
+        used later for closing the connection, which is when the entry is committed
+        """
+
+        db_connection = self.connect(db)
+
+        entry = self.new_entry(obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket)
+        self.write_entries([(obj, entry)], db_connection)
+        logging.debug("Wrote {} to database".format(entry))
+
+        return { 'entry': entry['filename_hash'], 'db_connection': db_connection }
+
+    def store_many(self, objs, cryptographer, key, storage_provider, s3_endpoint_url, bucket, db=None,
+                   compressions=None, packs=None, overrides=None):
+        """
+        Create or overwrite entries for all paths in [objs], as store() does, in a single
+        transaction. [compressions] is an optional dict of path to the codec it was compressed
+        with, for those that were, [packs] of path to (pack_id, offset, length), for those
+        stored in packs, and [overrides] of path to fields to use instead of the new entry's,
+        as new_entry() takes.
+
+        Return a dict of path to obsfucated filename
+        """
+
+        compressions = compressions or {}
+        packs = packs or {}
+        overrides = overrides or {}
+        entries = { obj: self.new_entry(obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket,
+                                        compression=compressions.get(obj), pack=packs.get(obj),
+                                        overrides=overrides.get(obj))
+                    for obj in objs }
+
+        db_connection = self.connect(db)
+        self.write_entries(entries.items(), db_connection)
+        self.close_db_connection(db_connection)
+        logging.debug("Wrote {} entries to database".format(len(entries)))
+
+        return { obj: entry['filename_hash'] for obj, entry in entries.items() }
+
+    def store_chunked(self, obj, manifest, cryptographer, key, storage_provider, s3_endpoint_url, bucket,
+                      file_hash=None, compression=None, db=None):
+        """
+        Create or overwrite the entry for [obj], stashed in chunks, along with its [manifest]
+        of (chunk_id, size) tuples in order, in a single transaction. The chunks are also
+        recorded as stored in [bucket]. [compression] is the codec each chunk was compressed
+        with, if any
+        """
+
+        entry = self.new_entry(obj, cryptographer, key, storage_provider, s3_endpoint_url, bucket, file_hash,
+                               compression)
+        entry["chunked"] = 1
+
+        db_connection = self.connect(db)
+        with db_connection:
+            self.write_entries([(obj, entry)], db_connection)
+            file_id = db_connection.execute(
+                "SELECT f.id FROM files f JOIN directories d ON d.id = f.directory_id "
+                "WHERE d.path = ? AND f.basename = ?", os.path.split(obj)).fetchone()[0]
+            db_connection.executemany(
+                "INSERT INTO manifests (file_id, position, chunk_id, size) VALUES (?, ?, ?, ?)",
+                [ (file_id, position, chunk_id, size) for position, (chunk_id, size) in enumerate(manifest) ])
+            db_connection.executemany(
+                "INSERT OR IGNORE INTO chunks (s3_endpoint_url, bucket, chunk_id, size) VALUES (?, ?, ?, ?)",
+                [ (s3_endpoint_url, bucket, chunk_id, size) for chunk_id, size in manifest ])
+        self.release(db_connection)
+        logging.debug("Wrote {} with {} chunks to database".format(obj, len(manifest)))
+
+        return entry["filename_hash"]
+
+    def manifest(self, obj, db=None):
+        """ Return the (chunk_id, size) tuples making up [obj] in order, or [] if it isn't chunked """
+
+        db_connection = self.connect(db)
+        manifest = db_connection.execute(
+            "SELECT m.chunk_id, m.size FROM manifests m JOIN files f ON f.id = m.file_id "
+            "JOIN directories d ON d.id = f.directory_id WHERE d.path = ? AND f.basename = ? "
+            "ORDER BY m.position", os.path.split(obj)).fetchall()
+        self.release(db_connection)
+
+        return manifest
+
+    def known_chunks(self, chunk_ids, s3_endpoint_url, bucket, db=None):
+        """ Return the set of [chunk_ids] already recorded as stored in [bucket] """
+
+        db_connection = self.connect(db)
+        chunk_ids = list(chunk_ids)
+        known = set()
+
+        for start in range(0, len(chunk_ids), LOOKUP_BATCH_SIZE):
+            batch = chunk_ids[start:start + LOOKUP_BATCH_SIZE]
+            query = "SELECT chunk_id FROM chunks WHERE s3_endpoint_url = ? AND bucket = ? AND chunk_id IN ({})".format(
+                ", ".join("?" * len(batch)))
+            known.update(row[0] for row in db_connection.execute(query, [s3_endpoint_url, bucket] + batch))
+
+        self.release(db_connection)
+
+        return known
+
+    def forget_chunks(self, chunk_ids, bucket, db=None):
+        """
+        Stop recording [chunk_ids] as stored in [bucket] at any endpoint, such as before
+        deleting them, so that they're uploaded again if they're needed later
+        """
+
+        db_connection = self.connect(db)
+        with db_connection:
+            db_connection.executemany(
+                "DELETE FROM chunks WHERE bucket = ? AND chunk_id = ?", [ (bucket, chunk_id) for chunk_id in chunk_ids ])
+        self.release(db_connection)
+
+    def references(self, filename_hash, excluding=None, db=None):
+        """
+        Return the number of entries stored in the object [filename_hash], not counting the
+        entry for the path [excluding] if given
+        """
+
+        query = "SELECT COUNT(*) FROM files f JOIN directories d ON d.id = f.directory_id " \
+            "WHERE f.filename_hash = ? AND f.pack_id IS NULL AND (f.chunked IS NULL OR f.chunked = 0)"
+        arguments = [filename_hash]
+        if excluding is not None:
+            query = f"{query} AND NOT (d.path = ? AND f.basename = ?)"
+            arguments += os.path.split(excluding)
+
+        db_connection = self.connect(db)
+        count = db_connection.execute(query, arguments).fetchone()[0]
+        self.release(db_connection)
+
+        return count
+
+    def object_name(self, obj, db=None):
+        """
+        Return the name of the object to upload [obj] to. That's the hash of its path, unless
+        another entry shares the object of that name, in which case a new name is made up so
+        that the shared object isn't overwritten
+        """
+
+        filename_hash = self.filename_hash(obj)
+        if self.references(filename_hash, excluding=obj, db=db) == 0:
+            return filename_hash
+
+        logging.debug(f"The object for {obj} is shared with other files, uploading it under a new name")
+        return self.filename_hash(f"{obj}\0{uuid.uuid4().hex}")
+
+    def find_duplicate(self, obj, cryptographer, key, s3_endpoint_url, bucket, db=None):
+        """
+        Look for an entry stashed with the same [cryptographer], [key], [s3_endpoint_url], and
+        [bucket] as [obj] would be, whose contents are the same as [obj]'s. A hard link to the
+        same inode, unchanged since it was stashed, is found without reading [obj]. Otherwise
+        [obj] is only hashed if there's an entry of the same size to compare it with. Chunked
+        entries aren't considered, since their chunks are shared already.
+
+        Return a tuple of the matching (path, entry) tuple or None, and the hash of [obj] if it
+        had to be hashed or None
+        """
+
+        file_stat = os.stat(obj)
+        candidates = f"{SELECT_ENTRIES} WHERE f.cryptographer = ? AND f.key = ? AND f.s3_endpoint_url IS ? " \
+            "AND f.bucket = ? AND (f.chunked IS NULL OR f.chunked = 0) AND NOT (d.path = ? AND f.basename = ?)"
+        arguments = [cryptographer, key, s3_endpoint_url, bucket] + list(os.path.split(obj))
+
+        db_connection = self.connect(db)
+        try:
+            row = db_connection.execute(
+                f"{candidates} AND f.device = ? AND f.inode = ? AND f.size = ? AND f.mtime = ? LIMIT 1",
+                arguments + [file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime]).fetchone()
+            if row is not None:
+                logging.debug(f"{obj} is a hard link to the stashed {os.path.join(row[0], row[1])}")
+                return (self.row_to_entry(row), None)
+
+            row = db_connection.execute(f"{candidates} AND f.size = ? LIMIT 1", arguments + [file_stat.st_size]).fetchone()
+            if row is None:
+                return (None, None)
+
+            file_hash = self.file_hash(obj)
+            row = db_connection.execute(
+                f"{candidates} AND f.size = ? AND f.file_hash = ? LIMIT 1",
+                arguments + [file_stat.st_size, file_hash]).fetchone()
+        finally:
+            self.release(db_connection)
+
+        if row is None:
+            return (None, file_hash)
+
+        logging.debug(f"{obj} has the same contents as the stashed {os.path.join(row[0], row[1])}")
+        return (self.row_to_entry(row), file_hash)
+
+    @staticmethod
+    def shared_entry(entry, file_hash=None):
+        """
+        Return the fields a new entry takes from the existing [entry] when it shares its object,
+        for new_entry()'s [overrides]
+        """
+
+        fields = ["filename_hash", "compression", "pack_id", "pack_offset", "pack_length", "stored_size"]
+        shared = { field: entry.get(field) for field in fields }
+        shared["file_hash"] = file_hash or entry.get("file_hash")
+
+        return shared
+
+    def stored_objects(self, db=None):
+        """
+        Return a dict of every (storage_provider, s3_endpoint_url, bucket) the entries are stored
+        in, to a dict of the names of the objects they need there, to an
+        (expected_size, minimum_size, paths) tuple. [expected_size] is the object's recorded
+        stored size, if known. [minimum_size] is the least size it can have for the pack members
+        in it to be complete, or None if it isn't a pack. [paths] is the list of entries stored
+        in it. Chunked entries need every chunk in their manifests
+        """
+
+        db_connection = self.connect(db)
+        stored = {}
+
+        def need(location, object_name, this_path, expected_size=None, minimum_size=None):
+            objects = stored.setdefault(location, {})
+            if object_name not in objects:
+                objects[object_name] = (expected_size, minimum_size, [])
+            elif minimum_size is not None and minimum_size > (objects[object_name][1] or 0):
+                objects[object_name] = (objects[object_name][0], minimum_size, objects[object_name][2])
+            objects[object_name][2].append(this_path)
+
+        for row in db_connection.execute(
+                f"SELECT {FULL_PATH}, f.storage_provider, f.s3_endpoint_url, f.bucket, f.filename_hash, "
+                "f.stored_size, f.chunked, f.pack_id, f.pack_offset + f.pack_length "
+                "FROM files f JOIN directories d ON d.id = f.directory_id"):
+            this_path, location, filename_hash, stored_size, chunked, pack_id, pack_end = \
+                row[0], tuple(row[1:4]), row[4], row[5], row[6], row[7], row[8]
+            if pack_id:
+                need(location, f"{PACK_PREFIX}{pack_id}", this_path, minimum_size=pack_end)
+            elif not chunked:
+                need(location, filename_hash, this_path, expected_size=stored_size)
+
+        for row in db_connection.execute(
+                f"SELECT DISTINCT {FULL_PATH}, f.storage_provider, f.s3_endpoint_url, f.bucket, m.chunk_id "
+                "FROM manifests m JOIN files f ON f.id = m.file_id JOIN directories d ON d.id = f.directory_id"):
+            need(tuple(row[1:4]), f"{CHUNK_PREFIX}{row[4]}", row[0])
+        self.release(db_connection)
+
+        return stored
+
+    def checkpoint(self, db=None):
+        """
+        Move everything in the write-ahead log into the database file itself, so that the file
+        can be copied on its own, for example for a backup. Return the path to the file
+        """
+
+        db_connection = self.connect(db)
+        db_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.release(db_connection)
 
-        return { 'entry': new_entry, 'db_connection': db_connection }
+        return db or self.db
 
     def close_db_connection(self, db_connection):
         """
@@ -146,7 +813,7 @@ class FilenamesDatabase():
         """
 
         db_connection.commit()
-        db_connection.close()
+        self.release(db_connection)
 
     def restore(self):
         """
@@ -0,0 +1,192 @@
+"""
+A cache of content hashes for files on local disk, so that files which haven't been touched since
+they were last hashed only cost a stat.
+
+Hashes are kept in fingerprints.sqlite in the cstash directory, keyed by the file's device and
+inode, and only used while its size, mtime_ns, and ctime_ns are the same as when it was hashed.
+ctime can't be set by users, so contents changed with the mtime put back afterwards are still
+caught. A hash is only cached if the file didn't change while it was being hashed, and wasn't
+modified within RACY_WINDOW_NS of being hashed, since a write in the same timestamp tick could
+otherwise go unnoticed.
+
+The cache holds at most [maximum_entries] hashes. Beyond that, those least recently used are
+evicted. Losing the file only costs rehashing.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+FINGERPRINTS_FILE = "fingerprints.sqlite"
+DEFAULT_MAXIMUM_ENTRIES = 2000000
+# Hashes of files modified less than this many nanoseconds before being hashed aren't cached
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+# How often, in number of hashes stored, the size of the cache is checked
+EVICTION_INTERVAL = 1000
+# Last use is recorded to this many seconds, so that most lookups don't write
+USE_GRANULARITY = 24 * 60 * 60
+HASH_BLOCK_SIZE = 1024 * 1024
+
+class FingerprintCache():
+    """
+    Cache of sha256 hashes of files, kept in [cstash_directory]. Can be shared between threads
+    """
+
+    def __init__(self, cstash_directory, maximum_entries=DEFAULT_MAXIMUM_ENTRIES):
+        self.db = f"{cstash_directory}/{FINGERPRINTS_FILE}"
+        self.maximum_entries = maximum_entries
+        self.local = threading.local()
+        self.open_connections = []
+        self.open_connections_lock = threading.Lock()
+        self.stored = 0
+
+    def connect(self):
+        """ Return this thread's connection to the cache, creating the table if necessary """
+
+        db_connection = getattr(self.local, "db_connection", None)
+        if db_connection is None:
+            db_connection = sqlite3.connect(self.db, timeout=30, check_same_thread=False)
+            db_connection.execute("PRAGMA journal_mode=WAL")
+            db_connection.execute("PRAGMA synchronous=NORMAL")
+            with db_connection:
+                db_connection.execute(
+                    "CREATE TABLE IF NOT EXISTS fingerprints ("
+                    "device INTEGER NOT NULL, "
+                    "inode INTEGER NOT NULL, "
+                    "size INTEGER NOT NULL, "
+                    "mtime_ns INTEGER NOT NULL, "
+                    "ctime_ns INTEGER NOT NULL, "
+                    "file_hash TEXT NOT NULL, "
+                    "used INTEGER NOT NULL, "
+                    "PRIMARY KEY (device, inode)) WITHOUT ROWID")
+                db_connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_used ON fingerprints (used)")
+            self.local.db_connection = db_connection
+            with self.open_connections_lock:
+                self.open_connections.append(db_connection)
+
+        return db_connection
+
+    @staticmethod
+    def now():
+        """ Return the current time at the granularity last use is recorded with """
+
+        return int(time.time()) // USE_GRANULARITY * USE_GRANULARITY
+
+    def lookup(self, file_stat):
+        """ Return the cached hash for the file with the stat result [file_stat], or None """
+
+        db_connection = self.connect()
+        row = db_connection.execute(
+            "SELECT file_hash, used FROM fingerprints WHERE device = ? AND inode = ? AND size = ? "
+            "AND mtime_ns = ? AND ctime_ns = ?",
+            (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns,
+             file_stat.st_ctime_ns)).fetchone()
+        if row is None:
+            return None
+
+        file_hash, used = row
+        if used < self.now():
+            with db_connection:
+                db_connection.execute(
+                    "UPDATE fingerprints SET used = ? WHERE device = ? AND inode = ?",
+                    (self.now(), file_stat.st_dev, file_stat.st_ino))
+
+        return file_hash
+
+    def store(self, filepath, file_stat, file_hash):
+        """
+        Cache [file_hash] for [filepath], which was hashed after it was stat'd as [file_stat].
+        Nothing is cached if the file has changed since, or was modified too recently to be
+        sure of. Return True if it was cached
+        """
+
+        try:
+            current_stat = os.stat(filepath)
+        except FileNotFoundError:
+            return False
+
+        fingerprint = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns,
+                       file_stat.st_ctime_ns)
+        if fingerprint != (current_stat.st_dev, current_stat.st_ino, current_stat.st_size,
+                           current_stat.st_mtime_ns, current_stat.st_ctime_ns):
+            logging.debug(f"{filepath} changed while it was being hashed, not caching its hash")
+            return False
+
+        if time.time_ns() - max(file_stat.st_mtime_ns, file_stat.st_ctime_ns) < RACY_WINDOW_NS:
+            return False
+
+        db_connection = self.connect()
+        with db_connection:
+            db_connection.execute(
+                "INSERT OR REPLACE INTO fingerprints (device, inode, size, mtime_ns, ctime_ns, file_hash, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", fingerprint + (file_hash, self.now()))
+
+        self.stored += 1
+        if self.stored % EVICTION_INTERVAL == 0:
+            self.evict()
+
+        return True
+
+    def evict(self):
+        """ Delete the least recently used hashes beyond [self.maximum_entries] """
+
+        db_connection = self.connect()
+        excess = db_connection.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0] - self.maximum_entries
+        if excess <= 0:
+            return
+
+        with db_connection:
+            db_connection.execute(
+                "DELETE FROM fingerprints WHERE (device, inode) IN "
+                "(SELECT device, inode FROM fingerprints ORDER BY used LIMIT ?)", (excess,))
+        logging.debug(f"Evicted {excess} hashes from the fingerprint cache")
+
+    def file_hash(self, filepath):
+        """
+        Return the sha256 hash for the file at [filepath], from the cache if it hasn't changed
+        since it was last hashed, otherwise by reading it and caching the result. Raise
+        FileNotFoundError if it doesn't exist
+        """
+
+        file_stat = os.stat(filepath)
+        try:
+            cached = self.lookup(file_stat)
+        except sqlite3.Error as e:
+            logging.warning(f"Couldn't read the fingerprint cache, hashing {filepath}: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+        sha256 = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                sha256.update(block)
+        file_hash = sha256.hexdigest()
+
+        self.remember(filepath, file_stat, file_hash)
+
+        return file_hash
+
+    def remember(self, filepath, file_stat, file_hash):
+        """
+        As store(), but log failures to write to the cache rather than raising them, since
+        the cache is only an optimisation. Return True if the hash was cached
+        """
+
+        try:
+            return self.store(filepath, file_stat, file_hash)
+        except sqlite3.Error as e:
+            logging.warning(f"Couldn't write to the fingerprint cache: {e}")
+            return False
+
+    def close(self):
+        """ Close every connection to the cache, from any thread """
+
+        with self.open_connections_lock:
+            for db_connection in self.open_connections:
+                db_connection.close()
+            self.open_connections.clear()
+        self.local = threading.local()
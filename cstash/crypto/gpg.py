@@ -5,6 +5,10 @@ Use 'gnupg' module to call GPG binary for encryption/decryption tasks
 import logging
 import gnupg
 import os
+import subprocess
+import threading
+
+STREAM_BLOCK_SIZE = 1024 * 1024
 
 class GPG():
     def __init__(self, cstash_directory, log_level=None, gnupg_home=None): # pylint: disable=unused-argument
@@ -27,6 +31,92 @@ class GPG():
 
         return destination_filepath
 
+    def stream(self, args, source, password=None):
+        """
+        Run the gpg binary with [args], feeding it the binary file object [source] on stdin, and
+        yield its output in pieces as it's produced. Since stdin carries the data, [password] is
+        passed over a separate pipe. Raise a RuntimeError if gpg fails, or whatever reading
+        [source] raised if that fails
+        """
+
+        pass_fds = ()
+        if password is not None:
+            password_reader, password_writer = os.pipe()
+            with os.fdopen(password_writer, "w") as password_pipe:
+                password_pipe.write(f"{password}\n")
+            pass_fds = (password_reader,)
+            args = ["--pinentry-mode", "loopback", "--passphrase-fd", str(password_reader)] + args
+
+        try:
+            process = subprocess.Popen(
+                self.gpg.make_args(args, False), pass_fds=pass_fds,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finally:
+            for fd in pass_fds:
+                os.close(fd)
+        errors = []
+        feed_errors = []
+
+        def feed():
+            try:
+                for block in iter(lambda: source.read(STREAM_BLOCK_SIZE), b''):
+                    process.stdin.write(block)
+            except BrokenPipeError:
+                # gpg exited early, which its return code reports
+                pass
+            except Exception as e: # pylint: disable=broad-except
+                feed_errors.append(e)
+                process.kill()
+            finally:
+                try:
+                    process.stdin.close()
+                except (BrokenPipeError, ValueError):
+                    pass
+
+        def drain():
+            errors.append(process.stderr.read())
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        drainer = threading.Thread(target=drain, daemon=True)
+        feeder.start()
+        drainer.start()
+
+        finished = False
+        try:
+            for block in iter(lambda: process.stdout.read(STREAM_BLOCK_SIZE), b''):
+                yield block
+            finished = True
+        finally:
+            if not finished:
+                process.kill()
+            process.wait()
+            feeder.join()
+            drainer.join()
+
+        if feed_errors:
+            # The output stops wherever reading the source failed, so it can't be used
+            raise feed_errors[0]
+        if process.returncode != 0:
+            raise RuntimeError("gpg exited with {}: {}".format(
+                process.returncode, b"".join(errors).decode(errors="replace")))
+
+    def encrypt_stream(self, source, key):
+        """
+        Encrypt the binary file object [source] to [key], and yield the encrypted data in
+        pieces as it's produced
+        """
+
+        yield from self.stream(["--encrypt", "--recipient", key, "--output", "-"], source)
+
+    def decrypt_stream(self, source, destination, key, password=None): # pylint: disable=unused-argument
+        """
+        Decrypt the binary file object [source], writing the plaintext to the binary file
+        object [destination]. Raise a RuntimeError on failure
+        """
+
+        for block in self.stream(["--decrypt", "--output", "-"], source, password):
+            destination.write(block)
+
     def decrypt(self, filepath, destination, key, password=None): # pylint: disable=unused-argument
         """
         Decrypt [filepath] to [destination], and return the path to the decrypted file
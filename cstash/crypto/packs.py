@@ -0,0 +1,79 @@
+"""
+Pack many small files into shared objects, so that stashing a tree of small files takes one PUT
+per pack instead of one per file.
+
+Every member is encrypted on its own, and the encrypted members are stored back to back as
+PACK_PREFIX followed by a random pack id. A member's pack id, offset, and length are recorded in
+its database entry, so that fetch can download just that member with a ranged GET, and decrypt
+it as it would a whole object.
+"""
+
+import logging
+import uuid
+
+PACK_PREFIX = "packs/"
+# Files smaller than this many bytes are packed
+DEFAULT_PACK_THRESHOLD = 16 * 1024
+# A pack is uploaded once its members add up to this many bytes
+DEFAULT_PACK_SIZE = 32 * 1024 * 1024
+
+class PackWriter():
+    """
+    Gather files into packs of about [pack_size] bytes, encrypted with [encryption] using
+    [key], and upload them to [bucket] in [storage]
+    """
+
+    def __init__(self, encryption, storage, key, bucket, pack_size=DEFAULT_PACK_SIZE):
+        self.encryption = encryption
+        self.storage = storage
+        self.key = key
+        self.bucket = bucket
+        self.pack_size = pack_size
+        self.buffer = bytearray()
+        self.members = []
+
+    def add(self, path, compression=None):
+        """
+        Encrypt [path], compressed with [compression] if given, into the current pack. If
+        that fills the pack, upload it and return the result as flush() does, otherwise
+        return (True, []). Errors reading or encrypting [path] are raised, leaving the pack as
+        it was
+        """
+
+        with open(path, "rb") as member_file:
+            encrypted = self.encryption.encrypt_bytes(member_file.read(), self.key, compression)
+
+        self.members.append((path, len(self.buffer), len(encrypted)))
+        self.buffer += encrypted
+
+        if len(self.buffer) >= self.pack_size:
+            return self.flush()
+
+        return (True, [])
+
+    def flush(self):
+        """
+        Upload the current pack, if it has any members, and start a new one.
+
+        Return a tuple of True for success or False for failure, and a list of
+        (path, (pack_id, offset, length)) tuples for the members of the pack. The pack is
+        started afresh either way
+        """
+
+        if not self.members:
+            return (True, [])
+
+        pack_id = uuid.uuid4().hex
+        try:
+            uploaded = self.storage.upload_stream(
+                self.bucket, f"{PACK_PREFIX}{pack_id}", [bytes(self.buffer)], size_hint=len(self.buffer))
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
+            logging.error(f"Couldn't upload pack {pack_id}: {e}")
+            uploaded = False
+        members = [ (path, (pack_id, offset, length)) for path, offset, length in self.members ]
+        logging.debug(f"Uploaded pack {pack_id} of {len(members)} files, {len(self.buffer)} bytes")
+
+        self.buffer = bytearray()
+        self.members = []
+
+        return (uploaded is True, members)
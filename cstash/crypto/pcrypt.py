@@ -1,15 +1,43 @@
 """
 Cryptography functions supplied via native Python libraries
+
+Files are written in a versioned, chunked binary format so that memory use stays constant
+regardless of file size:
+
+    header: MAGIC (5 bytes) | VERSION (1 byte) | chunk size (4 bytes, big endian) | salt (16 bytes)
+    body:   AES-256-GCM sealed chunks of [chunk size] plaintext bytes, each 16 bytes longer than
+            its plaintext. The last chunk may be shorter, and is empty only for empty files
+
+A per-file key is derived from the stored Fernet key and the random salt with HKDF. Each chunk's
+nonce is its counter followed by a flag byte marking the final chunk, and the header is used as
+associated data, so reordered, truncated or extended files fail to decrypt.
+
+Objects written before this format existed are plain Fernet tokens, and are still decrypted.
 """
 
+import base64
 import logging
-from cryptography.fernet import Fernet
 import os
+import struct
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"CSTSH"
+VERSION = 1
+HEADER_FORMAT = ">5sBI16s"
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+TAG_LENGTH = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 
 class PCrypt():
-    def __init__(self, cstash_directory, log_level=None): # pylint: disable=unused-argument
+    def __init__(self, cstash_directory, log_level=None, chunk_size=DEFAULT_CHUNK_SIZE): # pylint: disable=unused-argument
         self.cstash_directory = cstash_directory
         self.keys_directory = f"{self.cstash_directory}/keys"
+        self.chunk_size = chunk_size
+        # Keys already read from [self.keys_directory], so that they're only read once
+        self.keys = {}
 
     def generate_key(self, key_name):
         """
@@ -38,9 +66,13 @@ class PCrypt():
     def get_key(self, key_name):
         """
         Ensure that [key_name] exists, and return it as a byte object. If the key
-        had to be generated, also write it to [self.key_directory]/[key_name]
+        had to be generated, also write it to [self.key_directory]/[key_name]. Keys are
+        cached after the first call
         """
 
+        if key_name in self.keys:
+            return self.keys[key_name]
+
         # FIXME: This should only happen in main.initialise(), and the below should be
         #        changed to a try/except block of trying to open the key file, and moved
         #        to __init__.self.fernet_key
@@ -50,8 +82,79 @@ class PCrypt():
             with open(f"{self.keys_directory}/{key_name}", "rb") as fernet_key_file:
                 fernet_key = fernet_key_file.read()
 
+        self.keys[key_name] = fernet_key
+
         return fernet_key
 
+    def derive_key(self, fernet_key, salt):
+        """ Derive the per-file AES-256-GCM key from [fernet_key] and [salt], and return it """
+
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b"cstash-pcrypt-v1").derive(base64.urlsafe_b64decode(fernet_key))
+
+    @staticmethod
+    def nonce(counter, last):
+        """ Return the 12 byte nonce for chunk number [counter], flagged if it's the [last] one """
+
+        return counter.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+    @staticmethod
+    def read_chunks(source, size):
+        """
+        Read [source] in pieces of [size] bytes, and yield (piece, is_last) tuples. An empty
+        [source] yields a single empty piece, so that there is always a final chunk
+        """
+
+        current = source.read(size)
+        while True:
+            following = source.read(size)
+            if not following:
+                yield current, True
+                return
+            yield current, False
+            current = following
+
+    def encrypt_stream(self, source, key):
+        """
+        Encrypt the binary file object [source] with [key], and yield the encrypted file in
+        pieces. Only a single chunk is held in memory at a time
+        """
+
+        salt = os.urandom(16)
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.chunk_size, salt)
+        aead = AESGCM(self.derive_key(self.get_key(key), salt))
+
+        yield header
+        for counter, (chunk, last) in enumerate(self.read_chunks(source, self.chunk_size)):
+            yield aead.encrypt(self.nonce(counter, last), chunk, header)
+
+    def decrypt_stream(self, source, destination, key, password=None): # pylint: disable=unused-argument
+        """
+        Decrypt the binary file object [source] with [key], writing the plaintext to the binary
+        file object [destination]. Legacy Fernet tokens are detected by their missing header.
+
+        Raise an exception if [source] can not be authenticated
+        """
+
+        fernet_key = self.get_key(key)
+        header = source.read(HEADER_LENGTH)
+
+        if len(header) < HEADER_LENGTH or not header.startswith(MAGIC):
+            logging.debug("No cstash header found, decrypting as a legacy Fernet token")
+            destination.write(Fernet(fernet_key).decrypt(header + source.read()))
+            return
+
+        _, version, chunk_size, salt = struct.unpack(HEADER_FORMAT, header)
+        if version != VERSION:
+            raise ValueError(f"Unsupported cstash file format version {version}")
+
+        aead = AESGCM(self.derive_key(fernet_key, salt))
+        for counter, (chunk, last) in enumerate(self.read_chunks(source, chunk_size + TAG_LENGTH)):
+            destination.write(aead.decrypt(self.nonce(counter, last), chunk, header))
+
     def encrypt(self, source_filepath, key, destination_filepath):
         """
         Encrypt [source_filepath] to [destination_filepath].
@@ -60,14 +163,10 @@ class PCrypt():
         """
 
         try:
-            fernet = Fernet(self.get_key(key))
-
-            with open(source_filepath, "rb") as source_data_file:
-                source_data = source_data_file.read()
-                encrypted_file_contents = fernet.encrypt(source_data)
-
-            with open(destination_filepath, "wb+") as destination_file:
-                destination_file.write(encrypted_file_contents)
+            with open(source_filepath, "rb") as source_file, \
+                 open(destination_filepath, "wb+") as destination_file:
+                for encrypted_chunk in self.encrypt_stream(source_file, key):
+                    destination_file.write(encrypted_chunk)
         except Exception as e:
             logging.error("Couldn't encrypt {}: {}".format(source_filepath, e))
             return False
@@ -80,20 +179,15 @@ class PCrypt():
         on success, or False on failure
         """
 
-        try:
-            fernet = Fernet(self.get_key(key))
-
-            with open(filepath) as file_contents:
-                contents = file_contents.read()
-
-            decrypted_contents = fernet.decrypt(contents.encode())
-
-            destination_file = destination or f"{filepath}.decrypted"
-            with open(destination, "wb+") as destination_f:
-                destination_f.write(decrypted_contents)
+        destination_file = destination or f"{filepath}.decrypted"
 
+        try:
+            with open(filepath, "rb") as source_file, \
+                 open(destination_file, "wb+") as destination_f:
+                self.decrypt_stream(source_file, destination_f, key)
         except Exception as e:
-            os.remove(destination_file)
+            if os.path.isfile(destination_file):
+                os.remove(destination_file)
             logging.error("Coudln't decrypt {}: {}".format(filepath, e))
             return False
 
@@ -0,0 +1,313 @@
+"""
+Staged, parallel stashing of many files. Stages are connected by bounded queues:
+
+    check   (thread pool)  — change detection, and lookup of stashed copies, against the filenames
+                             database
+    encrypt (process pool) — CPU bound compression and encryption to temporary files
+    upload  (thread pool)  — network bound uploads, then removal of the temporary files
+
+Database writes happen on the calling thread only. The number of plaintext bytes that have been
+handed to the encryption stage but not yet uploaded is capped by [max_in_flight_bytes], which
+bounds both memory and temporary disk use. Files larger than that are encrypted straight into a
+multipart upload by the upload stage instead
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import cstash.libs.exceptions as exceptions
+import cstash.libs.helpers as helpers
+from cstash.crypto import compression as compression_codecs
+from cstash.crypto.crypto import CountingChunks, Encryption
+from cstash.crypto.filenames_database import FilenamesDatabase, STORE_BATCH_SIZE
+from cstash.storage.s3 import TRANSFER_MAX_CONCURRENCY
+from cstash.storage.storage import Storage
+
+DEFAULT_MAX_IN_FLIGHT_BYTES = 1024 * 1024 * 1024
+QUEUE_DEPTH_PER_JOB = 4
+
+def encrypt_file(cstash_directory, cryptographer, log_level, source_filepath, destination_filename, key,
+                 compression=None):
+    """
+    Encrypt [source_filepath] to [destination_filename] in [cstash_directory], compressing it
+    with [compression] first if given, and hashing it in the same pass. This is a module level
+    function so that it can be pickled and run in a worker process.
+
+    Return a tuple of the path to the encrypted file, and the sha256 hash of the source file
+    """
+
+    file_hash = hashlib.sha256()
+    encrypted_filepath = Encryption(cstash_directory, cryptographer, log_level).encrypt(
+        source_filepath=source_filepath, destination_filename=destination_filename, key=key,
+        compression=compression, file_hash=file_hash)
+
+    return (encrypted_filepath, file_hash.hexdigest())
+
+class ByteBudget():
+    """
+    Counting limit on the number of bytes in flight. A single item larger than [limit] is still
+    let through, but only when nothing else is in flight
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """ Block until [size] bytes fit in the budget, then take them """
+
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        """ Give [size] bytes back to the budget """
+
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+class StashPipeline():
+    """
+    Stash a list of paths using [jobs] workers per stage
+    """
+
+    def __init__(self, cstash_directory, config, log_level="ERROR", jobs=None,
+                 max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES, force=False):
+        self.cstash_directory = cstash_directory
+        self.config = config
+        self.log_level = log_level
+        self.jobs = jobs or os.cpu_count() or 1
+        self.budget = ByteBudget(max_in_flight_bytes)
+        self.force = force
+        self.filename_db = FilenamesDatabase(cstash_directory, log_level)
+        self.stored_entries = {}
+        self.compression = compression_codecs.available_codec(config.get('compression'))
+        self.compressions = {}
+        self.overrides = {}
+        self.stats = {}
+        self.encryption = Encryption(cstash_directory, config["cryptographer"], log_level)
+        self.storage = Storage(
+            storage_provider=config["storage_provider"],
+            log_level=log_level,
+            s3_endpoint_url=config['s3_endpoint_url'],
+            s3_access_key_id=config['s3_access_key_id'],
+            s3_secret_access_key=config['s3_secret_access_key'],
+            max_pool_connections=config.get('max_pool_connections') or self.jobs * TRANSFER_MAX_CONCURRENCY,
+            cstash_directory=cstash_directory,
+            manifest_max_age=config.get('manifest_max_age'),
+            transfer_config=config
+        )
+
+    def check(self, to_check, to_encrypt, finished):
+        """
+        Take paths from [to_check] until a None sentinel is received. Paths that need uploading
+        are given an object name and passed on to [to_encrypt]. Everything else, including
+        copies of stashed files which will share their object, is reported to [finished]
+        """
+
+        while True:
+            this_path = to_check.get()
+            if this_path is None:
+                return
+
+            try:
+                stored_entry = self.stored_entries.get(this_path)
+                if self.force is not True and stored_entry is not None and \
+                   self.filename_db.existing_hash(this_path, stored_entry):
+                    finished.put(('skipped', this_path, None))
+                    continue
+
+                duplicate, file_hash = (None, None)
+                if self.force is not True:
+                    duplicate, file_hash = self.filename_db.find_duplicate(
+                        this_path, self.config["cryptographer"], self.config["key"], self.config["s3_endpoint_url"],
+                        self.config["bucket"])
+                if duplicate is not None:
+                    self.overrides[this_path] = self.filename_db.shared_entry(duplicate[1], file_hash)
+                    finished.put(('shared', this_path, None))
+                    continue
+
+                self.overrides[this_path] = { "filename_hash": self.filename_db.object_name(this_path) }
+                if file_hash:
+                    self.overrides[this_path]["file_hash"] = file_hash
+                to_encrypt.put(this_path)
+            except Exception as e: # pylint: disable=broad-except
+                finished.put(('failed', this_path, e))
+
+    def encrypt(self, to_encrypt, to_upload, finished):
+        """
+        Take paths from [to_encrypt] until a None sentinel is received, and hand them to a pool
+        of [self.jobs] processes once they fit in the byte budget. Finished encryptions are put
+        on [to_upload], followed by a sentinel for every uploader, and paths which can't be
+        handed over are reported to [finished]. Files larger than the whole budget are put on
+        [to_upload] without a future, to be streamed by the uploader instead
+        """
+
+        received_all = False
+        try:
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                while True:
+                    this_path = to_encrypt.get()
+                    if this_path is None:
+                        received_all = True
+                        break
+
+                    acquired = 0
+                    try:
+                        self.stats[this_path] = os.stat(this_path)
+                        size = self.stats[this_path].st_size
+                        compression = compression_codecs.choose(this_path, self.compression)
+                        if compression is not None:
+                            self.compressions[this_path] = compression
+                        if size > self.budget.limit:
+                            # Too large to ever fit the budget, so encrypt it straight into the upload
+                            to_upload.put((this_path, 0, None))
+                            continue
+
+                        self.budget.acquire(size)
+                        acquired = size
+                        future = pool.submit(
+                            encrypt_file, self.cstash_directory, self.config["cryptographer"], self.log_level,
+                            this_path, self.object_name(this_path), self.config["key"], compression)
+                        future.add_done_callback(
+                            lambda f, this_path=this_path, size=size: to_upload.put((this_path, size, f)))
+                    except Exception as e: # pylint: disable=broad-except
+                        self.budget.release(acquired)
+                        finished.put(('failed', this_path, e))
+        except Exception as e: # pylint: disable=broad-except
+            # The pool itself failed, so fail everything still to come, rather than leaving the
+            # checkers blocked on a full queue
+            logging.error(f"Encryption stopped: {e}")
+            while not received_all:
+                this_path = to_encrypt.get()
+                if this_path is None:
+                    received_all = True
+                    continue
+                finished.put(('failed', this_path, e))
+        finally:
+            for _ in range(self.jobs):
+                to_upload.put(None)
+
+    def upload(self, to_upload, finished):
+        """
+        Take encrypted files from [to_upload] until a None sentinel is received, upload them,
+        and remove the temporary files
+        """
+
+        while True:
+            item = to_upload.get()
+            if item is None:
+                return
+
+            this_path, size, future = item
+            encrypted_file_path = f"{self.cstash_directory}/{self.object_name(this_path)}"
+            try:
+                if future is None:
+                    file_hash = hashlib.sha256()
+                    encrypted = CountingChunks(self.encryption.encrypt_stream(
+                        this_path, self.config["key"], self.compressions.get(this_path), file_hash))
+                    uploaded = self.storage.upload_stream(
+                        self.config["bucket"], self.object_name(this_path), encrypted,
+                        size_hint=os.path.getsize(this_path))
+                    self.overrides[this_path]["file_hash"] = file_hash.hexdigest()
+                    self.overrides[this_path]["stored_size"] = encrypted.size
+                else:
+                    _, self.overrides[this_path]["file_hash"] = future.result()
+                    self.overrides[this_path]["stored_size"] = os.path.getsize(encrypted_file_path)
+                    uploaded = self.storage.upload(self.config["bucket"], encrypted_file_path)
+                if uploaded is not True:
+                    raise exceptions.CstashUploadError(message=f"Couldn't upload {this_path}")
+                self.filename_db.fingerprints.remember(
+                    this_path, self.stats.pop(this_path), self.overrides[this_path]["file_hash"])
+                finished.put(('uploaded', this_path, None))
+            except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                finished.put(('failed', this_path, e))
+            finally:
+                if os.path.isfile(encrypted_file_path):
+                    helpers.delete_file(encrypted_file_path)
+                self.budget.release(size)
+
+    def object_name(self, this_path):
+        """ Return the name of the object [this_path] is uploaded to, given by the check stage """
+
+        return self.overrides[this_path]["filename_hash"]
+
+    def store(self, uploaded_paths):
+        """ Write database entries for [uploaded_paths] in one transaction, and empty the list """
+
+        self.filename_db.store_many(
+            objs=uploaded_paths,
+            cryptographer=self.config["cryptographer"],
+            key=self.config['key'],
+            storage_provider=self.config["storage_provider"],
+            s3_endpoint_url=self.config["s3_endpoint_url"],
+            bucket=self.config["bucket"],
+            compressions=self.compressions,
+            overrides=self.overrides)
+        uploaded_paths.clear()
+
+    def run(self, paths):
+        """
+        Stash [paths] through the pipeline, and yield a ('uploaded' | 'shared' | 'skipped' |
+        'failed', path) tuple for each path as it's done, as StashEngine.stash() does. Database
+        entries are written in batches of STORE_BATCH_SIZE
+        """
+
+        if self.storage.storage_provider.bucket_exists(self.config["bucket"]) is False:
+            raise exceptions.CstashCriticalException(message="Couldn't upload to bucket")
+
+        self.stored_entries = self.filename_db.lookup_many(paths)
+
+        depth = self.jobs * QUEUE_DEPTH_PER_JOB
+        to_check = queue.Queue(maxsize=depth)
+        to_encrypt = queue.Queue(maxsize=depth)
+        to_upload = queue.Queue()
+        finished = queue.Queue()
+
+        checkers = [ threading.Thread(target=self.check, args=(to_check, to_encrypt, finished), daemon=True)
+                     for _ in range(self.jobs) ]
+        uploaders = [ threading.Thread(target=self.upload, args=(to_upload, finished), daemon=True)
+                      for _ in range(self.jobs) ]
+        encryptor = threading.Thread(target=self.encrypt, args=(to_encrypt, to_upload, finished), daemon=True)
+
+        def feed():
+            for this_path in paths:
+                to_check.put(this_path)
+            for _ in checkers:
+                to_check.put(None)
+            for checker in checkers:
+                checker.join()
+            to_encrypt.put(None)
+
+        for thread in checkers + uploaders + [encryptor]:
+            thread.start()
+        threading.Thread(target=feed, daemon=True).start()
+
+        uploaded_paths = []
+        try:
+            for _ in range(len(paths)):
+                status, this_path, error = finished.get()
+
+                if status in ('uploaded', 'shared'):
+                    uploaded_paths.append(this_path)
+                    if len(uploaded_paths) >= STORE_BATCH_SIZE:
+                        self.store(uploaded_paths)
+                elif status == 'skipped':
+                    logging.info(f"{this_path} is unchanged since it was last stashed, skipping")
+                else:
+                    logging.error(f"Couldn't stash {this_path}: {error}")
+
+                yield (status, this_path)
+        finally:
+            if uploaded_paths:
+                self.store(uploaded_paths)
+
+        encryptor.join()
+        for thread in uploaders:
+            thread.join()
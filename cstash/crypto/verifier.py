@@ -0,0 +1,163 @@
+"""
+Reconcile the filenames database against what's actually stored, such as from a nightly cron job.
+
+Entries are grouped by storage provider, endpoint, and bucket, and every object they need there
+is checked for: whole objects, the packs members are stored in, and the chunks in the manifests
+of chunked files. Each bucket is listed in full, in partitions [jobs] at once, and the listing is
+joined with the database to find objects which are:
+
+    missing         — needed by entries, but not stored
+    size_mismatched — stored, but not the size that was uploaded, or for packs, too small to
+                      hold all of their members
+    orphaned        — stored, but not needed by any entry
+
+Buckets needing only a few objects are checked with HEAD requests, [jobs] at once, instead of
+listing them, when orphans aren't wanted. Listings refresh the bucket's manifest as a side effect,
+and objects are never read or changed
+"""
+
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cstash.crypto.filenames_database import FilenamesDatabase
+from cstash.storage.storage import Storage
+
+# Objects cstash stores which aren't needed by entries, and so are never orphans
+KNOWN_OBJECTS = ("filenames.sqlite.encrypted",)
+# With no orphans wanted, buckets needing at most this many objects are checked with HEAD requests
+HEAD_THRESHOLD = 1000
+
+class Verifier():
+    """
+    Check the objects needed by the database in [cstash_directory] exist, using [jobs] threads
+    and the S3 credentials in [config]. Objects stored but not needed are only looked for if
+    [orphans] is True
+    """
+
+    def __init__(self, cstash_directory, config, log_level="ERROR", jobs=1, orphans=True):
+        self.cstash_directory = cstash_directory
+        self.config = config
+        self.log_level = log_level
+        self.jobs = jobs
+        self.orphans = orphans
+        self.filename_db = FilenamesDatabase(cstash_directory, log_level)
+
+    def storage(self, storage_provider, s3_endpoint_url):
+        """ Return a Storage for [storage_provider] at [s3_endpoint_url] """
+
+        return Storage(
+            storage_provider,
+            log_level=self.log_level,
+            s3_endpoint_url=s3_endpoint_url or None,
+            s3_access_key_id=self.config.get('s3_access_key_id'),
+            s3_secret_access_key=self.config.get('s3_secret_access_key'),
+            max_pool_connections=self.config.get('max_pool_connections') or self.jobs,
+            cstash_directory=self.cstash_directory,
+            manifest_max_age=self.config.get('manifest_max_age'),
+            transfer_config=self.config
+        )
+
+    @staticmethod
+    def compare(key, summary, needed, report):
+        """
+        Add [key] to the lists in [report] it belongs in, given its [summary] as stored or None
+        if it isn't, and the (expected_size, minimum_size, paths) tuple of what [needed] it
+        """
+
+        expected_size, minimum_size, paths = needed
+        if summary is None:
+            report["missing"].append({ "key": key, "paths": paths })
+        elif expected_size is not None and summary["Size"] != expected_size:
+            report["size_mismatched"].append(
+                { "key": key, "size": summary["Size"], "expected_size": expected_size, "paths": paths })
+        elif minimum_size is not None and summary["Size"] < minimum_size:
+            report["size_mismatched"].append(
+                { "key": key, "size": summary["Size"], "minimum_size": minimum_size, "paths": paths })
+
+    def verify_by_listing(self, storage, bucket, needed, report):
+        """ List [bucket] in [storage], and compare every object in it with those [needed] """
+
+        report["method"] = "list"
+        report["listed"] = 0
+        unseen = set(needed)
+        for summary in storage.list_objects(bucket, jobs=self.jobs, refresh=True):
+            key = summary["Key"]
+            report["listed"] += 1
+            if key in needed:
+                unseen.discard(key)
+                self.compare(key, summary, needed[key], report)
+            elif self.orphans and key not in KNOWN_OBJECTS:
+                last_modified = summary.get("LastModified")
+                if isinstance(last_modified, datetime.datetime):
+                    last_modified = last_modified.isoformat()
+                report["orphaned"].append({ "key": key, "size": summary["Size"], "last_modified": last_modified })
+
+        for key in sorted(unseen):
+            self.compare(key, None, needed[key], report)
+
+    def verify_by_head(self, storage, bucket, needed, report):
+        """ Look up every object [needed] in [bucket] in [storage], [self.jobs] at once """
+
+        report["method"] = "head"
+        lock = threading.Lock()
+
+        def head(key):
+            try:
+                summary = storage.head_object(bucket, key)
+            except Exception as e: # pylint: disable=broad-except
+                with lock:
+                    report["errors"].append(f"{key}: {e}")
+                return
+            with lock:
+                self.compare(key, summary, needed[key], report)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            list(pool.map(head, sorted(needed)))
+
+    def verify_bucket(self, storage_provider, s3_endpoint_url, bucket, needed):
+        """
+        Check the objects [needed] in [bucket] at [s3_endpoint_url] with [storage_provider],
+        a dict as FilenamesDatabase.stored_objects() gives for one bucket. Return the report
+        for the bucket
+        """
+
+        report = { "storage_provider": storage_provider, "s3_endpoint_url": s3_endpoint_url, "bucket": bucket,
+                   "method": None, "objects": len(needed), "listed": None, "missing": [], "size_mismatched": [],
+                   "orphaned": [] if self.orphans else None, "errors": [] }
+
+        try:
+            storage = self.storage(storage_provider, s3_endpoint_url)
+            if not self.orphans and len(needed) <= HEAD_THRESHOLD:
+                self.verify_by_head(storage, bucket, needed, report)
+            else:
+                self.verify_by_listing(storage, bucket, needed, report)
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
+            logging.error(f"Couldn't verify {bucket} at {s3_endpoint_url}: {e}")
+            report["errors"].append(str(e))
+
+        report["missing"].sort(key=lambda problem: problem["key"])
+        report["size_mismatched"].sort(key=lambda problem: problem["key"])
+
+        return report
+
+    def run(self):
+        """
+        Verify every bucket the database has entries in, one after another, and return the
+        report as a dict ready to be written as JSON. [ok] in the report is False if any
+        object is missing or the wrong size, or a bucket couldn't be checked. Orphans alone
+        don't make it False, since they only cost storage
+        """
+
+        buckets = []
+        for (storage_provider, s3_endpoint_url, bucket), needed in sorted(
+                self.filename_db.stored_objects().items(), key=lambda location: tuple(map(str, location[0]))):
+            logging.info(f"Verifying {len(needed)} objects in {bucket} at {s3_endpoint_url}")
+            buckets.append(self.verify_bucket(storage_provider, s3_endpoint_url, bucket, needed))
+        self.filename_db.close()
+
+        return {
+            "verified": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "ok": not any(report["missing"] or report["size_mismatched"] or report["errors"] for report in buckets),
+            "buckets": buckets
+        }
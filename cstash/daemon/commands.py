@@ -19,10 +19,13 @@ def daemon(ctx):
 
 @daemon.command()
 @click.pass_context
-def start(ctx):
+@click.option('--workers', '-w', type=click.IntRange(min=1), help='Number of files uploaded at once. Overrides daemon_workers in the config, and defaults to 4')
+@click.option('--poll', is_flag=True, default=False, help='Scan for changes instead of using inotify, for NFS and FUSE mounts')
+@click.option('--scan-period', type=click.IntRange(min=1), help='When scanning, seconds over which every directory is scanned once. Overrides daemon_scan_period in the config, and defaults to 60')
+def start(ctx, workers=None, poll=False, scan_period=None):
     """ Start the daemon """
 
-    ctx.obj.get('daemon').start()
+    ctx.obj.get('daemon').start(workers=workers, poll=poll, scan_period=scan_period)
 
 @daemon.command()
 @click.pass_context
@@ -3,7 +3,6 @@ Create a background process which continually looks for changes in the files sta
 with Cstash, and keep the configured remote storage for those files in sync
 """
 
-import time
 import logging
 import os
 import daemon
@@ -11,74 +10,129 @@ import daemon.pidfile
 import psutil
 import persistqueue
 import threading
+import time
 from cstash.crypto.filenames_database import FilenamesDatabase
-from cstash.crypto.commands import stash
+from cstash.crypto.engine import StashEngine
+from cstash.daemon.scheduler import Scheduler, DEFAULT_WORKERS
+from cstash.daemon.scanner import StatScanner, DEFAULT_SCAN_PERIOD
+
+# Seconds to wait before looking for changes again after the watcher or scanner failed
+WATCH_RESTART_DELAY = 10
+# After this many failures, the inotify watcher is given up on in favour of scanning
+MAX_WATCH_FAILURES = 5
 
 class Daemon():
-    def __init__(self, cstash_directory, log_level, click_context): # pylint: disable=unused-argument
+    def __init__(self, cstash_directory, log_level, click_context):
         self.cstash_directory = cstash_directory
         self.log_file = open(f"{cstash_directory}/cstash.log", "w+")
         self.pid_file = f"{self.cstash_directory}/cstash-daemon.pid"
         self.queue_location = f"{self.cstash_directory}/reprocess-queue"
+        self.log_level = log_level
         self.click_context = click_context
+        self.engine = None
+
+    def process_path(self, path):
+        """ Stash [path] with the daemon's engine, if it still exists """
+
+        if not os.path.isfile(path):
+            logging.info(f"{path} no longer exists, not stashing it")
+            return
+
+        status = self.engine.stash_file(path)
+        logging.info(f"{path}: {status}")
+
+    def enqueue(self, path):
+        """ Queue [path] for re-uploading """
 
-    def reload_files_to_watch(self):
+        reprocess_queue = persistqueue.UniqueQ(self.queue_location, multithreading=True)
+        reprocess_queue.put(path)
+
+    def populate_queue(self):
         """
-        Return a list of files to watch from the filesnames database
+        Scan every stashed file's directory once, and queue files whose modification time or
+        size differs from the database for re-uploading. Used when inotify events were lost
         """
 
-        files_to_watch = FilenamesDatabase(self.cstash_directory).return_all_entries()
-        logging.debug(f"Reloaded database: {files_to_watch}")
+        StatScanner(FilenamesDatabase(self.cstash_directory), self.enqueue).scan_all()
 
-        return files_to_watch
+    def watch(self):
+        """
+        Queue changed files as the kernel reports them with inotify, blocking for as long as the
+        watcher runs. Return False straight away if inotify can't be used, so that the caller can
+        fall back to populate_queue()
+        """
 
-    def process_queue(self):
-        """ Pop queue and send it to the stash() click command for processeing """
+        from cstash.daemon.watcher import InotifyWatcher, inotify_available
 
-        logging.info("Starting queue processor")
+        if not inotify_available():
+            logging.info("inotify isn't available, falling back to polling for changes")
+            return False
 
-        reprocess_queue = persistqueue.UniqueQ(self.queue_location)
+        try:
+            watcher = InotifyWatcher(FilenamesDatabase(self.cstash_directory), self.enqueue, rescan=self.populate_queue)
+        except OSError as e:
+            logging.info(f"Couldn't start inotify, falling back to polling for changes: {e}")
+            return False
 
-        i = 0
-        while i < reprocess_queue.size:
-            logging.info(reprocess_queue.size)
-            this_file = reprocess_queue.get()
-            logging.info(f"{this_file} was received for the queue. It is now being sent for processing")
-            stash.callback(None, None, None, None, True, this_file)
-            i += 1
+        logging.info("Watching for changes with inotify")
+        try:
+            watcher.run()
+        finally:
+            watcher.close()
 
-    def populate_queue(self):
+        return True
+
+    def poll(self, scan_period=DEFAULT_SCAN_PERIOD):
+        """
+        Look for changes by scanning every stashed file's directory at least once every
+        [scan_period] seconds, forever. For filesystems without inotify support
         """
-        Reload the entries from the filesnames database every 5 seconds, and monitor file changes by
-        comparing the modified time in the database with that of the current modification time. Trigger
-        a re-upload on modification time mismatch
+
+        logging.info(f"Scanning for changes every {scan_period}s")
+        StatScanner(FilenamesDatabase(self.cstash_directory), self.enqueue, period=scan_period).run()
+
+    def watch_changes(self, poll=False, scan_period=DEFAULT_SCAN_PERIOD):
         """
+        Look for changes for as long as the daemon runs, with inotify unless [poll] is True or
+        it can't be used, otherwise by scanning every [scan_period] seconds. Failures are logged
+        and looking for changes restarted, after a rescan for those missed meanwhile. After
+        MAX_WATCH_FAILURES failures, inotify is given up on in favour of scanning
+        """
+
+        failures = 0
+        while True:
+            try:
+                if poll is True or failures >= MAX_WATCH_FAILURES or self.watch() is False:
+                    self.poll(scan_period)
+                return
+            except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                failures += 1
+                logging.error(f"Looking for changes failed, restarting in {WATCH_RESTART_DELAY}s: {e}")
+                time.sleep(WATCH_RESTART_DELAY)
+                try:
+                    self.populate_queue()
+                except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                    logging.error(f"Couldn't rescan for changes: {e}")
 
-        entries = self.reload_files_to_watch()
-        for e in entries:
-            if not os.path.isfile(e):
-                continue
-            if entries[e]["mtime"] < os.stat(e).st_mtime:
-                logging.info(f"{e} changed. It will be queued for re-uploading")
-                reprocess_queue = persistqueue.UniqueQ(self.queue_location)
-                reprocess_queue.put(e)
+    def start(self, workers=None, poll=False, scan_period=None):
+        """
+        Bootstrap the daemon process. Changed files are found by a single watcher thread, and
+        uploaded by a fixed pool of [workers] threads, defaulting to the profile's
+        [daemon_workers] setting.
 
-    def start(self):
-        """ Bootstrap the daemon process """
+        With [poll], or if inotify isn't available, changes are found by scanning instead, with
+        a full pass every [scan_period] seconds, defaulting to the profile's
+        [daemon_scan_period] setting
+        """
 
         print("BEWARE: The daemon is experimental. If it explodes, it will be without warning")
 
         try:
             logger = logging.getLogger()
-
-            # Needed so we don't lose the Click() context
-            def process_wrapper():
-                with self.click_context:
-                    self.process_queue()
-
-            def populate_wrapper():
-                with self.click_context:
-                    self.populate_queue()
+            config = self.click_context.obj.get('config') or {}
+            workers = workers or int(config.get('daemon_workers') or DEFAULT_WORKERS)
+            scan_period = scan_period or int(config.get('daemon_scan_period') or DEFAULT_SCAN_PERIOD)
+            scheduler = Scheduler(self.queue_location, self.process_path, workers=workers)
 
             with daemon.DaemonContext(
                     pidfile=daemon.pidfile.PIDLockFile(self.pid_file),
@@ -88,10 +142,11 @@ class Daemon():
             ):
                 logging.info("Started cstash daemon")
 
-                while True:
-                    threading.Thread(target=process_wrapper).start()
-                    time.sleep(5)
-                    threading.Thread(target=populate_wrapper).start()
+                # Created after daemonising, so that connections aren't shared with the parent
+                self.engine = StashEngine(self.cstash_directory, config, self.log_level)
+
+                threading.Thread(target=self.watch_changes, args=(poll, scan_period), daemon=True).start()
+                scheduler.run()
 
         except Exception as e:
             print(f"Couldn't start the daemon: {e}")
@@ -0,0 +1,206 @@
+"""
+Find changed files by stat()ing them, for filesystems where inotify isn't available or doesn't see
+every change, such as NFS and FUSE mounts.
+
+Stashed files are grouped by directory, and each directory is read with a single os.scandir().
+Instead of scanning everything at once, directories are scanned one at a time, spread over
+[period] seconds. Each directory is then rescanned on its own interval, which halves every time
+it's found to have changed, and doubles every time it hasn't, between MINIMUM_INTERVAL and
+[period]. Once every directory has been scanned, the pass's duration is logged, and the list of
+stashed files is reloaded from the database.
+
+As with the inotify watcher, new files appearing in a scanned directory are reported too.
+"""
+
+import heapq
+import logging
+import os
+import time
+
+DEFAULT_SCAN_PERIOD = 60
+# Shortest time between two scans of a directory that keeps changing, in seconds
+MINIMUM_INTERVAL = 5
+# A pass taking longer than this many scan periods is logged as a warning
+SLOW_PASS_FACTOR = 1.5
+# Longest time to sleep between checks of whether to stop, in seconds
+STOP_CHECK_INTERVAL = 1
+
+class StatScanner():
+    """
+    Report changed files in the directories of everything in [filename_db] by calling
+    [enqueue] with their paths, scanning every directory at least once every [period] seconds
+    """
+
+    def __init__(self, filename_db, enqueue, period=DEFAULT_SCAN_PERIOD):
+        self.filename_db = filename_db
+        self.enqueue = enqueue
+        self.period = period
+        self.minimum_interval = min(MINIMUM_INTERVAL, period)
+        self.tracked = {}
+        self.intervals = {}
+        self.seen = {}
+        self.reported = {}
+        self.due = {}
+        self.schedule = []
+        self.last_pass_duration = None
+
+    def schedule_scan(self, directory, due):
+        """ Schedule [directory] to be scanned at [due], replacing any earlier schedule """
+
+        self.due[directory] = due
+        heapq.heappush(self.schedule, (due, directory))
+
+    def reload(self, now=None):
+        """
+        Reload the stashed files from the database. New directories are scheduled evenly
+        over the next [self.period] seconds from [now], and ones without stashed files in
+        them any more are dropped
+        """
+
+        now = time.monotonic() if now is None else now
+        self.tracked = self.filename_db.tracked_files()
+
+        new_directories = sorted(d for d in self.tracked if d not in self.intervals)
+        for i, directory in enumerate(new_directories):
+            self.intervals[directory] = self.period
+            self.schedule_scan(directory, now + i * self.period / len(new_directories))
+
+        for directory in [ d for d in self.intervals if d not in self.tracked ]:
+            del self.intervals[directory]
+            del self.due[directory]
+            self.seen.pop(directory, None)
+
+        # Forget reported changes once they've been stashed
+        for path, mtime in list(self.reported.items()):
+            directory, basename = os.path.split(path)
+            stored = self.tracked.get(directory, {}).get(basename)
+            if stored is None or (stored[0] or 0) >= mtime:
+                del self.reported[path]
+
+        logging.debug(f"Scanning {len(self.intervals)} directories")
+
+    def report(self, path, mtime):
+        """
+        Pass [path] to [self.enqueue], unless it was already reported at [mtime]. Return True
+        if it was reported
+        """
+
+        if self.reported.get(path) == mtime:
+            return False
+
+        logging.info(f"{path} changed. It will be queued for re-uploading")
+        self.reported[path] = mtime
+        self.enqueue(path)
+
+        return True
+
+    def scan_directory(self, directory):
+        """
+        Read [directory] once, and report every stashed file in it whose modification time
+        or size differs from the database, as well as files which weren't there when it was
+        last scanned. Return True if anything new was reported
+        """
+
+        stored_files = self.tracked.get(directory, {})
+        last_seen = self.seen.get(directory)
+        names = set()
+        changed = False
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    names.add(entry.name)
+
+                    stored = stored_files.get(entry.name)
+                    if stored is None:
+                        if last_seen is not None and entry.name not in last_seen:
+                            changed = self.report(entry.path, entry.stat().st_mtime) or changed
+                        continue
+
+                    stored_mtime, stored_size = stored
+                    file_stat = entry.stat()
+                    if (stored_mtime or 0) < file_stat.st_mtime or \
+                       (stored_size is not None and stored_size != file_stat.st_size):
+                        changed = self.report(entry.path, file_stat.st_mtime) or changed
+        except OSError as e:
+            logging.debug(f"Couldn't scan {directory}: {e}")
+            return False
+
+        self.seen[directory] = names
+
+        return changed
+
+    def scan_all(self):
+        """ Reload the stashed files, and scan every directory straight away """
+
+        self.reload()
+        for directory in list(self.intervals):
+            self.scan_directory(directory)
+
+    def wait(self, seconds, stop_event=None):
+        """ Sleep for [seconds], or until [stop_event] is set """
+
+        if stop_event is None:
+            time.sleep(seconds)
+        else:
+            stop_event.wait(seconds)
+
+    def finish_pass(self, duration, busy, directories):
+        """
+        Log how long the pass over [directories] took, and how much of that, [busy], was
+        spent scanning. Warn if it took so long that changes are being noticed late
+        """
+
+        self.last_pass_duration = duration
+        logging.info(f"Scanned {directories} directories in a pass of {duration:.1f}s, "
+                     f"{busy:.1f}s of it spent scanning")
+        if duration > self.period * SLOW_PASS_FACTOR:
+            logging.warning(f"A scan pass took {duration:.1f}s, longer than the scan period of {self.period}s. "
+                            "The filesystem isn't keeping up, so consider raising the scan period")
+
+    def run(self, stop_event=None):
+        """ Scan for changes until [stop_event] is set, or forever if it isn't given """
+
+        self.reload()
+        pass_start = time.monotonic()
+        scanned = set()
+        busy = 0
+
+        while stop_event is None or not stop_event.is_set():
+            if not self.schedule:
+                self.wait(STOP_CHECK_INTERVAL, stop_event)
+                if time.monotonic() - pass_start >= self.period:
+                    self.reload()
+                    pass_start = time.monotonic()
+                continue
+
+            due, directory = self.schedule[0]
+            now = time.monotonic()
+            if due > now:
+                self.wait(min(due - now, STOP_CHECK_INTERVAL), stop_event)
+                continue
+
+            heapq.heappop(self.schedule)
+            if self.due.get(directory) != due:
+                # Dropped or rescheduled since this was scheduled
+                continue
+
+            changed = self.scan_directory(directory)
+            finished = time.monotonic()
+            busy += finished - now
+
+            if changed:
+                self.intervals[directory] = max(self.minimum_interval, self.intervals[directory] / 2)
+            else:
+                self.intervals[directory] = min(self.period, self.intervals[directory] * 2)
+            self.schedule_scan(directory, finished + self.intervals[directory])
+
+            scanned.add(directory)
+            if len(scanned) >= len(self.intervals):
+                self.finish_pass(finished - pass_start, busy, len(scanned))
+                self.reload(finished)
+                pass_start = finished
+                scanned.clear()
+                busy = 0
@@ -0,0 +1,89 @@
+"""
+Run queued paths through a handler with a fixed number of worker threads.
+
+The backlog stays in the persistent queue on disk, and a path is only taken off it when a worker is
+free, so memory use doesn't grow with the backlog. Only one worker ever handles a given path at a
+time. If a path comes up again while it's being handled, it's handled once more straight after,
+instead of in parallel.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import persistqueue
+
+DEFAULT_WORKERS = 4
+# How long to wait for the queue or a free worker before checking whether to stop, in seconds
+POLL_INTERVAL = 1
+
+class Scheduler():
+    """
+    Take paths from the persistent queue at [queue_location], and call [handler] with each of
+    them on at most [workers] threads at once
+    """
+
+    def __init__(self, queue_location, handler, workers=DEFAULT_WORKERS):
+        self.queue_location = queue_location
+        self.handler = handler
+        self.workers = workers
+        self.slots = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.rerun = set()
+
+    def process(self, path):
+        """
+        Call [self.handler] with [path], again for as long as it was asked for while the last
+        call was running, then free the worker
+        """
+
+        try:
+            while True:
+                try:
+                    self.handler(path)
+                except (Exception, SystemExit) as e: # pylint: disable=broad-except
+                    logging.error(f"Couldn't process {path}: {e}")
+
+                with self.lock:
+                    if path not in self.rerun:
+                        self.in_flight.discard(path)
+                        return
+                    self.rerun.discard(path)
+                logging.info(f"{path} changed again while it was being processed, processing it again")
+        finally:
+            self.slots.release()
+
+    def dispatch(self, path, pool):
+        """
+        Hand [path] to a worker in [pool], or mark it to be processed again if it's already
+        being handled. Must be called holding a slot, which is passed on to the worker
+        """
+
+        with self.lock:
+            if path in self.in_flight:
+                self.rerun.add(path)
+                self.slots.release()
+                return
+            self.in_flight.add(path)
+
+        pool.submit(self.process, path)
+
+    def run(self, stop_event=None):
+        """ Process the queue until [stop_event] is set, or forever if it isn't given """
+
+        reprocess_queue = persistqueue.UniqueQ(self.queue_location, multithreading=True)
+        logging.info(f"Processing the queue with {self.workers} workers")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while stop_event is None or not stop_event.is_set():
+                if not self.slots.acquire(timeout=POLL_INTERVAL):
+                    continue
+
+                try:
+                    path = reprocess_queue.get(block=True, timeout=POLL_INTERVAL)
+                except persistqueue.Empty:
+                    self.slots.release()
+                    continue
+
+                logging.info(f"{path} was received from the queue. It is now being sent for processing")
+                self.dispatch(path, pool)
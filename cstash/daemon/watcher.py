@@ -0,0 +1,183 @@
+"""
+Watch the directories of stashed files for changes using Linux's inotify, through libc with ctypes.
+
+Only files that were closed after writing, or moved into a watched directory, are reported. Files
+are reported whether or not they're in the filenames database yet, so new files in stashed
+directories are picked up too. A new file's creation is followed by a close after writing, so
+creation events are only used to start watching new subdirectories.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+# How often the list of stashed directories is reloaded from the database, in seconds
+RELOAD_INTERVAL = 60
+# Suffix of the hidden files fetch decrypts into before renaming them into place
+PARTIAL_SUFFIX = ".partial"
+
+def load_libc():
+    """ Return libc with inotify support loaded through ctypes, or None if it's not available """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+def inotify_available():
+    """ Return True if inotify can be used on this system """
+
+    return load_libc() is not None
+
+class InotifyWatcher():
+    """
+    Report changed files in the directories of everything in [filename_db] by calling
+    [enqueue] with their paths. [rescan] is called if the kernel's event queue overflowed and
+    events were lost, so that changes can be found some other way
+    """
+
+    def __init__(self, filename_db, enqueue, rescan=None):
+        self.filename_db = filename_db
+        self.enqueue = enqueue
+        self.rescan = rescan
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        self.watches = {}
+        self.watched_directories = set()
+
+    def add_watch(self, directory):
+        """ Start watching [directory]. Return True for success, False for failure """
+
+        if directory in self.watched_directories:
+            return True
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logging.error("Ran out of inotify watches. Raise fs.inotify.max_user_watches to watch more directories")
+            elif error != errno.ENOENT:
+                logging.error(f"Couldn't watch {directory}: {os.strerror(error)}")
+            return False
+
+        self.watches[wd] = directory
+        self.watched_directories.add(directory)
+        return True
+
+    def refresh_watches(self):
+        """ Watch every directory which has stashed files in it """
+
+        directories = self.filename_db.tracked_directories()
+        for directory in directories:
+            self.add_watch(directory)
+        logging.debug(f"Watching {len(self.watched_directories)} directories")
+
+    def read_events(self):
+        """ Yield (wd, mask, name) tuples for all events waiting to be read """
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, name
+
+    def watch_new_directory(self, directory):
+        """
+        Watch [directory], which was just created or moved in, and its subdirectories, and
+        report the files already in them, since they were written before the watch existed
+        """
+
+        for this_directory, _, files in os.walk(directory):
+            self.add_watch(this_directory)
+            for this_file in files:
+                self.report(os.path.join(this_directory, this_file))
+
+    def report(self, path):
+        """ Pass [path] to [self.enqueue], unless it's a file which isn't finished yet """
+
+        if path.endswith(PARTIAL_SUFFIX) and os.path.basename(path).startswith("."):
+            return
+
+        logging.info(f"{path} changed. It will be queued for re-uploading")
+        self.enqueue(path)
+
+    def handle(self, wd, mask, name):
+        """ Act on a single event, as read by read_events() """
+
+        if mask & IN_Q_OVERFLOW:
+            logging.error("The inotify event queue overflowed, so changes may have been missed")
+            if self.rescan is not None:
+                self.rescan()
+            return
+
+        if mask & IN_IGNORED:
+            self.watched_directories.discard(self.watches.pop(wd, None))
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None or name == "":
+            return
+
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_new_directory(path)
+            return
+
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.report(path)
+
+    def run(self, stop_event=None, timeout=1):
+        """
+        Watch for changes until [stop_event] is set, or forever if it isn't given. The list of
+        stashed directories is reloaded every RELOAD_INTERVAL seconds
+        """
+
+        self.refresh_watches()
+        last_refresh = time.monotonic()
+
+        while stop_event is None or not stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if ready:
+                for wd, mask, name in self.read_events():
+                    self.handle(wd, mask, name)
+
+            if time.monotonic() - last_refresh > RELOAD_INTERVAL:
+                self.refresh_watches()
+                last_refresh = time.monotonic()
+
+    def close(self):
+        """ Stop watching everything """
+
+        os.close(self.fd)
@@ -0,0 +1,131 @@
+"""
+Delete objects from a bucket which nothing in the filenames database refers to anymore, such as
+those left behind by files stashed again under a new name, entries removed from the database, or
+runs that failed between uploading and recording.
+
+The referenced objects are read from the database first: whole objects, packs, and the chunks in
+the manifests of chunked files. The bucket is then listed in full, and every other object older
+than [min_age] seconds is deleted, DELETE_BATCH_SIZE per request with [jobs] requests at once.
+Anything younger may be an upload which hasn't been recorded yet, so it's left alone. Chunks are
+forgotten by the database before they're deleted, so that they're uploaded again if they're ever
+needed. Chunked files shouldn't be stashed to the bucket while it's being collected, since one
+could refer to a chunk as it's being deleted
+"""
+
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cstash.libs.exceptions as exceptions
+import cstash.libs.helpers as helpers
+from cstash.crypto.chunked import CHUNK_PREFIX
+from cstash.crypto.filenames_database import FilenamesDatabase
+from cstash.crypto.verifier import KNOWN_OBJECTS
+from cstash.storage.s3 import DELETE_BATCH_SIZE
+
+DEFAULT_MIN_AGE = 24 * 60 * 60
+
+class GarbageCollector():
+    """
+    Delete unreferenced objects older than [min_age] seconds from [bucket] in [storage], a
+    Storage, sending [jobs] requests at once. With [dry_run], only find what would be deleted
+    """
+
+    def __init__(self, cstash_directory, storage, bucket, log_level="ERROR", jobs=1, min_age=DEFAULT_MIN_AGE,
+                 dry_run=False):
+        self.storage = storage
+        self.bucket = bucket
+        self.jobs = jobs
+        self.min_age = min_age
+        self.dry_run = dry_run
+        self.filename_db = FilenamesDatabase(cstash_directory, log_level)
+
+    def referenced(self):
+        """
+        Return the set of names of objects in [self.bucket] the database refers to, from
+        entries at any endpoint, to err on the side of keeping objects. Raise a CstashCriticalException if nothing refers to the bucket at all,
+        since then the database is more likely to be missing than the objects unused
+        """
+
+        referenced = set()
+        for (_, _, bucket), objects in self.filename_db.stored_objects().items():
+            if bucket == self.bucket:
+                referenced.update(objects)
+
+        if not referenced:
+            raise exceptions.CstashCriticalException(
+                message=f"Nothing in the database refers to {self.bucket}, refusing to delete everything in it")
+
+        return referenced
+
+    def delete(self, batch, results, lock):
+        """
+        Delete the objects in [batch], a dict of their names to sizes, recording the outcome in
+        [results]
+        """
+
+        chunk_ids = [ key[len(CHUNK_PREFIX):] for key in batch if key.startswith(CHUNK_PREFIX) ]
+        try:
+            if chunk_ids:
+                self.filename_db.forget_chunks(chunk_ids, self.bucket)
+            errors = self.storage.delete_objects(self.bucket, list(batch))
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
+            errors = [ (key, str(e)) for key in batch ]
+
+        failed = { key for key, _ in errors }
+        with lock:
+            deleted = [ key for key in batch if key not in failed ]
+            results['deleted'] += deleted
+            results['bytes'] += sum(batch[key] for key in deleted)
+            results['failed'] += errors
+        for key, message in errors:
+            logging.error(f"Couldn't delete {key} from {self.bucket}: {message}")
+
+    def run(self):
+        """
+        Collect [self.bucket], and return a dict with lists of the names of objects 'deleted'
+        (or which would have been with [self.dry_run]), (name, error message) tuples of those
+        which 'failed', and the names of unreferenced objects too 'recent' to delete, along with
+        the number of 'bytes' deleted
+        """
+
+        referenced = self.referenced()
+        cutoff = helpers.datetime_this_seconds_ago(self.min_age)
+        results = {'deleted': [], 'failed': [], 'recent': [], 'bytes': 0}
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+        batch = {}
+
+        def submit(pool, batch):
+            if self.dry_run:
+                results['deleted'] += list(batch)
+                results['bytes'] += sum(batch.values())
+                return
+            slots.acquire()
+            future = pool.submit(self.delete, batch, results, lock)
+            future.add_done_callback(lambda _: slots.release())
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for summary in self.storage.list_objects(self.bucket, jobs=self.jobs, refresh=True):
+                key = summary["Key"]
+                if key in referenced or key in KNOWN_OBJECTS:
+                    continue
+
+                last_modified = summary.get("LastModified")
+                if isinstance(last_modified, str):
+                    last_modified = datetime.datetime.fromisoformat(last_modified)
+                if last_modified is None or last_modified > cutoff:
+                    results['recent'].append(key)
+                    continue
+
+                batch[key] = summary.get("Size") or 0
+                if len(batch) >= DELETE_BATCH_SIZE:
+                    submit(pool, batch)
+                    batch = {}
+
+            if batch:
+                submit(pool, batch)
+
+        self.filename_db.close()
+
+        return results
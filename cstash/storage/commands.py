@@ -3,6 +3,8 @@ CLI methods for the storage command
 """
 
 import click
+import sys
+from cstash.libs import helpers
 from cstash.libs.exceptions import CstashCriticalException
 
 @click.group()
@@ -13,11 +15,20 @@ def storage():
 @storage.command()
 @click.pass_context
 @click.option('--bucket', '-b', help='Bucket to search. Mandatory if you supply --filename')
-@click.option('--filename', '-f', help='Filename to search for in --bucket')
+@click.option('--filename', '-f', help="Filename to search for in --bucket. Matches any part of an object's name, or the whole name if it's a glob such as 'chunks/*'")
+@click.option('--prefix', '-p', default="", help='Only list objects whose names start with this, such as chunks/')
+@click.option('--delimiter', '-d', help="List objects below the next delimiter after --prefix as a single common prefix, such as with '/'")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Number of partitions of the bucket to list at once, for very large buckets. Results come in no particular order')
+@click.option('--refresh', '-r', is_flag=True, default=False, help="List the bucket itself rather than its local manifest, even if the manifest is fresh. Listing the whole bucket refreshes the manifest")
 @click.option('--storage-provider', '-s', default='s3', type=click.Choice(['s3']), help='The object storage provider to use. Currently only supports the default S3 provider')
 @click.option('--s3-endpoint-url', '-e', help='Used for other S3 compatible providers — e.g. https://ams3.digitaloceanspaces.com')
-def search(ctx, bucket=None, filename=None, storage_provider=None, s3_endpoint_url=None):
-    """ Search the [bucket] on [storage_provider] for [filename] """
+def search(ctx, bucket=None, filename=None, storage_provider=None, s3_endpoint_url=None, prefix="", delimiter=None, jobs=1, refresh=False):
+    """
+    Search the [bucket] on [storage_provider] for [filename]. Matching objects are printed as
+    the bucket is listed, one per line. A manifest of the bucket kept locally is searched
+    instead while it's fresh, which is for manifest_max_age seconds from the config after the
+    bucket was last listed in full, or a day by default
+    """
 
     from cstash.storage import storage as storage_module
 
@@ -31,9 +42,70 @@ def search(ctx, bucket=None, filename=None, storage_provider=None, s3_endpoint_u
     storage_obj = storage_module.Storage(
         storage_provider=config["storage_provider"],
         log_level=ctx.obj.get('log_level'),
-        s3_endpoint_url=config['s3_endpoint_url'],
+        s3_endpoint_url=s3_endpoint_url or config['s3_endpoint_url'],
+        s3_access_key_id=s3_access_key_id,
+        s3_secret_access_key=s3_secret_access_key,
+        cstash_directory=ctx.obj.get('cstash_directory'),
+        manifest_max_age=config.get('manifest_max_age'),
+        transfer_config=config
+    )
+
+    results = storage_obj.search(
+        bucket=bucket, filename=filename, prefix=prefix, delimiter=delimiter, jobs=jobs, refresh=refresh)
+    if bucket is None:
+        print(results)
+        return
+
+    found = False
+    for key in results:
+        found = True
+        print(key)
+    if not found:
+        print("No results found")
+
+@storage.command()
+@click.pass_context
+@click.option('--bucket', '-b', help='Bucket to collect. Defaults to the bucket in the config')
+@click.option('--min-age', default=24, type=click.FloatRange(min=0), help="Only delete objects at least this many hours old, so that uploads which haven't been recorded yet are kept. Default is 24")
+@click.option('--dry-run', '-n', is_flag=True, default=False, help='Only list the objects which would be deleted')
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Number of delete requests, of up to 1000 objects each, and listing partitions at once. Default is 4')
+@click.option('--storage-provider', '-s', default='s3', type=click.Choice(['s3']), help='The object storage provider to use. Currently only supports the default S3 provider')
+@click.option('--s3-endpoint-url', '-e', help='Used for other S3 compatible providers — e.g. https://ams3.digitaloceanspaces.com')
+def gc(ctx, bucket=None, min_age=24, dry_run=False, jobs=4, storage_provider=None, s3_endpoint_url=None):
+    """
+    Delete objects in [bucket] which no entry in the local database refers to, such as those
+    left behind by files stashed again or failed runs. Objects younger than --min-age hours
+    are kept
+    """
+
+    from cstash.storage import storage as storage_module
+    from cstash.storage.collector import GarbageCollector
+
+    config = ctx.obj.get('config')
+    bucket = bucket or config.get('bucket')
+    if bucket is None:
+        raise CstashCriticalException(message="No bucket given with --bucket or in the config")
+
+    storage_obj = storage_module.Storage(
+        storage_provider=storage_provider or config["storage_provider"],
+        log_level=ctx.obj.get('log_level'),
+        s3_endpoint_url=s3_endpoint_url or config['s3_endpoint_url'],
         s3_access_key_id=config['s3_access_key_id'],
-        s3_secret_access_key=config['s3_secret_access_key']
+        s3_secret_access_key=config['s3_secret_access_key'],
+        max_pool_connections=jobs,
+        cstash_directory=ctx.obj.get('cstash_directory'),
+        manifest_max_age=config.get('manifest_max_age'),
+        transfer_config=config
     )
 
-    print(storage_obj.search(bucket=bucket, filename=filename, storage_provider=storage_provider))
+    results = GarbageCollector(ctx.obj.get('cstash_directory'), storage_obj, bucket, ctx.obj.get('log_level'),
+                               jobs=jobs, min_age=helpers.seconds_from_hours(min_age), dry_run=dry_run).run()
+
+    for key in results['deleted']:
+        print(f"{'Would delete' if dry_run else 'Deleted'} {key}")
+    for key, message in results['failed']:
+        print(f"Couldn't delete {key}: {message}")
+    print(f"{'Would delete' if dry_run else 'Deleted'} {len(results['deleted'])} objects, {results['bytes']} bytes. " \
+          f"Kept {len(results['recent'])} unreferenced objects younger than {min_age:g} hours, failed {len(results['failed'])}")
+    if results['failed']:
+        sys.exit(1)
@@ -0,0 +1,180 @@
+"""
+A local copy of the listing of each bucket cstash uses, so that what's in a bucket can be known
+without listing it again.
+
+Listings are kept in buckets.sqlite in the cstash directory, per endpoint and bucket, with each
+object's key, size, ETag and last modified time. Every upload, delete, and existence check cstash
+makes updates them. A manifest is only trusted to be complete for [max_age] seconds after the
+bucket was last listed in full, since other machines and tools can change the bucket too. After
+that, callers go back to the network, and the next full listing refreshes it.
+"""
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+MANIFEST_FILE = "buckets.sqlite"
+DEFAULT_MAX_AGE = 24 * 60 * 60
+# Rows written per transaction while refreshing
+REFRESH_BATCH_SIZE = 1000
+
+class BucketManifest():
+    """
+    The local listing of [bucket] at [s3_endpoint_url], kept in [cstash_directory], trusted for
+    [max_age] seconds after a full listing. Can be shared between threads
+    """
+
+    def __init__(self, cstash_directory, s3_endpoint_url, bucket, max_age=DEFAULT_MAX_AGE):
+        self.db = f"{cstash_directory}/{MANIFEST_FILE}"
+        self.s3_endpoint_url = s3_endpoint_url or ""
+        self.bucket = bucket
+        self.max_age = int(max_age or DEFAULT_MAX_AGE)
+        self.local = threading.local()
+
+    def connect(self):
+        """ Return this thread's connection to the manifests, creating the tables if necessary """
+
+        db_connection = getattr(self.local, "db_connection", None)
+        if db_connection is None:
+            db_connection = sqlite3.connect(self.db, timeout=30)
+            db_connection.execute("PRAGMA journal_mode=WAL")
+            db_connection.execute("PRAGMA synchronous=NORMAL")
+            with db_connection:
+                db_connection.execute(
+                    "CREATE TABLE IF NOT EXISTS objects ("
+                    "s3_endpoint_url TEXT NOT NULL, "
+                    "bucket TEXT NOT NULL, "
+                    "key TEXT NOT NULL, "
+                    "size INTEGER, "
+                    "etag TEXT, "
+                    "last_modified TEXT, "
+                    "seen REAL NOT NULL, "
+                    "PRIMARY KEY (s3_endpoint_url, bucket, key)) WITHOUT ROWID")
+                db_connection.execute(
+                    "CREATE TABLE IF NOT EXISTS refreshes ("
+                    "s3_endpoint_url TEXT NOT NULL, "
+                    "bucket TEXT NOT NULL, "
+                    "refreshed REAL NOT NULL, "
+                    "PRIMARY KEY (s3_endpoint_url, bucket))")
+            self.local.db_connection = db_connection
+
+        return db_connection
+
+    def age(self):
+        """ Return the number of seconds since the bucket was last listed in full, or None if never """
+
+        row = self.connect().execute(
+            "SELECT refreshed FROM refreshes WHERE s3_endpoint_url = ? AND bucket = ?",
+            (self.s3_endpoint_url, self.bucket)).fetchone()
+
+        return None if row is None else time.time() - row[0]
+
+    def fresh(self):
+        """ Return True if the manifest can be trusted to be complete """
+
+        age = self.age()
+        return age is not None and age < self.max_age
+
+    @staticmethod
+    def row(obj, seen):
+        """ Return the column values after the bucket for the object summary [obj], as listed """
+
+        last_modified = obj.get("LastModified")
+        if isinstance(last_modified, datetime.datetime):
+            last_modified = last_modified.isoformat()
+
+        return (obj["Key"], obj.get("Size"), obj.get("ETag"), last_modified, seen)
+
+    def add(self, key, size=None, etag=None, last_modified=None):
+        """ Record that [key] is stored, with its [size], [etag] and [last_modified] time if known """
+
+        if last_modified is None:
+            last_modified = datetime.datetime.now(datetime.timezone.utc)
+        obj = { "Key": key, "Size": size, "ETag": etag, "LastModified": last_modified }
+
+        db_connection = self.connect()
+        with db_connection:
+            db_connection.execute(
+                "INSERT OR REPLACE INTO objects (s3_endpoint_url, bucket, key, size, etag, last_modified, seen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (self.s3_endpoint_url, self.bucket) + self.row(obj, time.time()))
+
+    def remove(self, keys):
+        """ Record that the objects in [keys] have been deleted """
+
+        db_connection = self.connect()
+        with db_connection:
+            db_connection.executemany(
+                "DELETE FROM objects WHERE s3_endpoint_url = ? AND bucket = ? AND key = ?",
+                [ (self.s3_endpoint_url, self.bucket, key) for key in keys ])
+
+    def contains(self, key):
+        """
+        Return True if [key] is stored, False if it isn't, or None if the manifest isn't fresh
+        enough to say
+        """
+
+        if not self.fresh():
+            return None
+
+        return self.connect().execute(
+            "SELECT 1 FROM objects WHERE s3_endpoint_url = ? AND bucket = ? AND key = ?",
+            (self.s3_endpoint_url, self.bucket, key)).fetchone() is not None
+
+    def iter_objects(self, prefix="", delimiter=None):
+        """
+        Yield the recorded objects starting with [prefix] in key order, as S3.iter_objects()
+        does, including common prefixes when [delimiter] is given
+        """
+
+        query = "SELECT key, size, etag, last_modified FROM objects WHERE s3_endpoint_url = ? AND bucket = ?"
+        arguments = [self.s3_endpoint_url, self.bucket]
+        if prefix:
+            query = f"{query} AND key >= ? AND key < ?"
+            arguments += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+        last_prefix = None
+        for key, size, etag, last_modified in self.connect().execute(f"{query} ORDER BY key", arguments):
+            if delimiter is not None and delimiter in key[len(prefix):]:
+                common_prefix = key[:key.index(delimiter, len(prefix)) + len(delimiter)]
+                if common_prefix != last_prefix:
+                    last_prefix = common_prefix
+                    yield { "Prefix": common_prefix }
+                continue
+            yield { "Key": key, "Size": size, "ETag": etag, "LastModified": last_modified }
+
+    def refreshing(self, objects):
+        """
+        Yield every object summary from [objects], a full listing of the bucket, recording each
+        one as it goes. Once the listing is exhausted, objects it didn't include are forgotten,
+        unless they were added since it started, and the manifest is marked fresh. A listing
+        which isn't consumed to the end leaves the manifest as stale as it was
+        """
+
+        started = time.time()
+        db_connection = self.connect()
+        batch = []
+
+        def write(batch):
+            with db_connection:
+                db_connection.executemany(
+                    "INSERT OR REPLACE INTO objects (s3_endpoint_url, bucket, key, size, etag, last_modified, seen) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            batch.clear()
+
+        for obj in objects:
+            batch.append((self.s3_endpoint_url, self.bucket) + self.row(obj, time.time()))
+            if len(batch) >= REFRESH_BATCH_SIZE:
+                write(batch)
+            yield obj
+        write(batch)
+
+        with db_connection:
+            forgotten = db_connection.execute(
+                "DELETE FROM objects WHERE s3_endpoint_url = ? AND bucket = ? AND seen < ?",
+                (self.s3_endpoint_url, self.bucket, started)).rowcount
+            db_connection.execute(
+                "INSERT OR REPLACE INTO refreshes (s3_endpoint_url, bucket, refreshed) VALUES (?, ?, ?)",
+                (self.s3_endpoint_url, self.bucket, started))
+        logging.info(f"Refreshed the manifest of {self.bucket}, forgetting {forgotten} objects no longer listed")
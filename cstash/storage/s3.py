@@ -2,46 +2,287 @@
 Class for operations with the S3 API
 """
 
+import base64
 import boto3
+import boto3.s3.transfer
+import fnmatch
 import logging
+import math
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import cstash.libs.helpers as helpers
+from cstash.storage.manifest import BucketManifest
+import botocore.config
 import botocore.exceptions
 import sys
+import time
+from cstash.storage import tuning
+
+# Most bytes of parts held in memory and uploading at once by a single upload_stream()
+STREAM_BUFFER_SIZE = 128 * 1024 * 1024
+# Most threads used by a single upload or download, unless the config sets max_concurrency
+TRANSFER_MAX_CONCURRENCY = tuning.DEFAULT_MAX_CONCURRENCY
+DEFAULT_MAX_POOL_CONNECTIONS = TRANSFER_MAX_CONCURRENCY
+# Object names are hex digests, so parallel listings split the key space on the next hex digit
+PARTITION_CHARACTERS = "0123456789abcdef"
+# Greater than any character in practice, for listing everything after a prefix
+LAST_CHARACTER = "\U0010ffff"
+GLOB_CHARACTERS = ("*", "?", "[")
+# DeleteObjects takes at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+# Process wide pools, so that clients, their connection pools, and bucket checks are shared by
+# every S3 object created during a run. Transfer measurements are shared too, see
+# cstash.storage.tuning
+_clients = {}
+_existing_buckets = set()
+_pool_lock = threading.Lock()
+
+def get_client(s3_endpoint_url, s3_access_key_id, s3_secret_access_key, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Return a client for the given endpoint and credentials, creating it only the first time
+    it's asked for. [max_pool_connections] should be at least the number of transfers expected
+    to run at once multiplied by TRANSFER_MAX_CONCURRENCY
+    """
+
+    pool_key = (s3_endpoint_url, s3_access_key_id, s3_secret_access_key, max_pool_connections)
+
+    with _pool_lock:
+        if pool_key not in _clients:
+            s3_client = boto3.client(
+                service_name='s3',
+                endpoint_url=s3_endpoint_url,
+                aws_access_key_id=s3_access_key_id,
+                aws_secret_access_key=s3_secret_access_key,
+                config=botocore.config.Config(max_pool_connections=max_pool_connections)
+            )
+            _clients[pool_key] = s3_client
+
+        return _clients[pool_key]
+
+def checksum(data):
+    """
+    Return the base64 CRC32 of [data], as S3 takes it for an additional checksum. Sending it
+    with the data saves botocore making another pass over it to work one out
+    """
+
+    return base64.b64encode(zlib.crc32(data).to_bytes(4, "big")).decode()
 
 class S3():
-    def __init__(self, s3_access_key_id, s3_secret_access_key, s3_endpoint_url="https://s3.amazonaws.com", log_level=None): # pylint: disable=unused-argument
-        self.s3_client = boto3.client(
-            service_name='s3',
-            endpoint_url=s3_endpoint_url,
-            aws_access_key_id=s3_access_key_id,
-            aws_secret_access_key=s3_secret_access_key
+    def __init__(self, s3_access_key_id, s3_secret_access_key, s3_endpoint_url="https://s3.amazonaws.com", log_level=None, max_pool_connections=None, cstash_directory=None, manifest_max_age=None, transfer_config=None): # pylint: disable=unused-argument
+        """
+        With [cstash_directory], a manifest of each bucket used is kept there, and trusted for
+        [manifest_max_age] seconds after the bucket was last listed in full, as described in
+        cstash.storage.manifest. Transfers are tuned as described in cstash.storage.tuning, with
+        any of multipart_threshold, part_size, and max_concurrency in the [transfer_config]
+        dict, such as the config, used as given instead
+        """
+
+        self.s3_endpoint_url = s3_endpoint_url
+        self.s3_access_key_id = s3_access_key_id
+        self.cstash_directory = cstash_directory
+        self.manifest_max_age = manifest_max_age
+        self.manifests = {}
+        self.transfer_overrides = tuning.overrides(transfer_config)
+        self.tuner = tuning.get_tuner(s3_endpoint_url)
+        self.s3_client = get_client(
+            s3_endpoint_url=s3_endpoint_url,
+            s3_access_key_id=s3_access_key_id,
+            s3_secret_access_key=s3_secret_access_key,
+            max_pool_connections=max(int(max_pool_connections or DEFAULT_MAX_POOL_CONNECTIONS),
+                                     self.transfer_overrides.get("max_concurrency", 0))
         )
 
-    def search(self, bucket=None, filename=None, s3_client=None):
+    def manifest(self, bucket):
+        """ Return the BucketManifest for [bucket], or None if manifests aren't being kept """
+
+        if self.cstash_directory is None:
+            return None
+        if bucket not in self.manifests:
+            self.manifests[bucket] = BucketManifest(
+                self.cstash_directory, self.s3_endpoint_url, bucket, self.manifest_max_age)
+
+        return self.manifests[bucket]
+
+    def search(self, bucket=None, filename=None, s3_client=None, prefix="", delimiter=None, jobs=1, refresh=False):
         """
         Take [bucket], [filename], and [s3_client] for returning listings and:
 
         * If [bucket] is None, then only return a listing of all buckets
         * If [filename] is not None, then return matching objects, otherwise return all objects
+
+        Objects are returned as a generator of names, listed page by page as they're consumed.
+        See iter_search() for [prefix], [delimiter], [jobs], and [refresh]
         """
 
-        s3_client = s3_client or self.s3_client
+        if bucket is None:
+            print("Returning listing of buckets, since you didn't supply a bucket (see --help)\n")
+            return self.list_buckets(s3_client)
 
-        try:
-            if bucket is None:
-                print("Returning listing of buckets, since you didn't supply a bucket (see --help)\n")
-                return self.list_buckets()
+        if filename is None:
+            print("Returning a listing of the bucket {} only, since you did not supply an object to search for (see --help)\n".format(bucket))
+
+        return self.iter_search(bucket, filename, prefix, delimiter, jobs, s3_client, refresh)
+
+    def iter_search(self, bucket, filename=None, prefix="", delimiter=None, jobs=1, s3_client=None, refresh=False):
+        """
+        Yield the names of objects in [bucket] starting with [prefix] and matching [filename],
+        as a substring or, if it contains any of * ? [, as a glob. The start of a glob up to its
+        first wildcard is used as the prefix to list, so that S3 does the filtering.
+
+        With [delimiter], objects below the next [delimiter] after the prefix aren't listed,
+        and the common prefixes they share are yielded instead, ending in [delimiter]. Otherwise,
+        with [jobs] greater than 1, the listing is split into partitions listed [jobs] at once,
+        and names are yielded in no particular order.
+
+        Names come from the bucket's manifest while it's fresh, unless [refresh] is True.
+        Otherwise the bucket is listed, and a listing of the whole bucket refreshes the manifest
+        """
+
+        s3_client = s3_client or self.s3_client
+        prefix = prefix or ""
 
-            if filename is None:
-                print("Returning a listing of the bucket {} only, since you did not supply an object to search for (see --help)\n".format(bucket))
-                return self.get_objects(bucket, s3_client)
+        if filename is not None and any(c in filename for c in GLOB_CHARACTERS):
+            literal = filename[:min(filename.index(c) for c in GLOB_CHARACTERS if c in filename)]
+            if literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return
+            matches = lambda key: fnmatch.fnmatchcase(key, filename)
+        elif filename is not None:
+            matches = lambda key: filename in key
+        else:
+            matches = lambda key: True
 
-            all_objects = self.get_objects(bucket, s3_client)
+        try:
+            for obj in self.list_objects(bucket, prefix, delimiter, jobs, refresh, s3_client):
+                key = obj.get("Key", obj.get("Prefix"))
+                if matches(key):
+                    yield key
         except botocore.exceptions.EndpointConnectionError:
             logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
             sys.exit(1)
 
-        return [ s for s in all_objects if filename in s ]
+    def list_objects(self, bucket, prefix="", delimiter=None, jobs=1, refresh=False, s3_client=None):
+        """
+        Return an iterable of the object summaries in [bucket] starting with [prefix], as
+        iter_objects() yields them. They come from the bucket's manifest while it's fresh,
+        unless [refresh] is True. Otherwise the bucket is listed, in partitions [jobs] at once
+        if [jobs] is greater than 1 and there's no [delimiter], and a listing of the whole
+        bucket refreshes the manifest
+        """
+
+        s3_client = s3_client or self.s3_client
+        manifest = self.manifest(bucket)
+        if manifest is not None and refresh is not True and manifest.fresh():
+            logging.debug(f"Listing {bucket} from its manifest")
+            return manifest.iter_objects(prefix, delimiter)
+
+        if delimiter is None and jobs > 1:
+            objects = self.iter_objects_partitioned(bucket, prefix, jobs, s3_client)
+        else:
+            objects = self.iter_objects(bucket, prefix, delimiter, s3_client=s3_client)
+        if manifest is not None and prefix == "" and delimiter is None:
+            objects = manifest.refreshing(objects)
+
+        return objects
+
+    def iter_objects(self, bucket, prefix="", delimiter=None, start_after=None, stop_at=None, s3_client=None):
+        """
+        Yield the object summaries in [bucket] starting with [prefix] one page at a time, as
+        dicts with Key, Size, ETag, and LastModified. With [delimiter], common prefixes are
+        yielded too, as dicts with just a Prefix. Listing starts after the key [start_after]
+        and stops before the first key not less than [stop_at], if given
+        """
+
+        s3_client = s3_client or self.s3_client
+        arguments = { "Bucket": bucket, "Prefix": prefix or "" }
+        if delimiter is not None:
+            arguments["Delimiter"] = delimiter
+        if start_after is not None:
+            arguments["StartAfter"] = start_after
+
+        for page in s3_client.get_paginator("list_objects_v2").paginate(**arguments):
+            for obj in page.get("Contents", []):
+                if stop_at is not None and obj["Key"] >= stop_at:
+                    return
+                yield obj
+            for common_prefix in page.get("CommonPrefixes", []):
+                yield { "Prefix": common_prefix["Prefix"] }
+
+    def partitions(self, prefix=""):
+        """
+        Return (start_after, stop_at, partition_prefix) tuples covering every key starting with
+        [prefix] between them, for iter_objects(). There is one per hex digit following
+        [prefix], and three more for keys whose next character comes before, between, or
+        after those digits, which are usually few
+        """
+
+        partitions = [ (None, None, f"{prefix}{character}") for character in PARTITION_CHARACTERS ]
+        partitions += [ (None, f"{prefix}0", prefix),
+                        (f"{prefix}9{LAST_CHARACTER}", f"{prefix}a", prefix),
+                        (f"{prefix}f{LAST_CHARACTER}", None, prefix) ]
+
+        return partitions
+
+    def iter_objects_partitioned(self, bucket, prefix="", jobs=len(PARTITION_CHARACTERS), s3_client=None):
+        """
+        Yield the object summaries in [bucket] starting with [prefix], as iter_objects() does,
+        listing the partitions from partitions() [jobs] at once. Summaries are yielded as they
+        arrive, in no particular order, and at most a few pages per job are held in memory
+        """
+
+        s3_client = s3_client or self.s3_client
+        partitions = self.partitions(prefix)
+        pages = queue.Queue(maxsize=jobs * 2)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            # Give up once the consumer has stopped, rather than blocking on a full queue forever
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def list_partition(start_after, stop_at, partition_prefix):
+            try:
+                page = []
+                for obj in self.iter_objects(bucket, partition_prefix, start_after=start_after,
+                                             stop_at=stop_at, s3_client=s3_client):
+                    if stopped.is_set():
+                        return
+                    page.append(obj)
+                    if len(page) >= 1000:
+                        put(page)
+                        page = []
+                put(page)
+            except Exception as e: # pylint: disable=broad-except
+                put(e)
+            finally:
+                put(finished)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for partition in partitions:
+                pool.submit(list_partition, *partition)
+
+            try:
+                remaining = len(partitions)
+                while remaining > 0:
+                    page = pages.get()
+                    if page is finished:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield from page
+            finally:
+                stopped.set()
 
     def list_buckets(self, s3_client=None):
         """ List all buckets in the account """
@@ -58,12 +299,21 @@ class S3():
             sys.exit(1)
 
     def bucket_exists(self, bucket, s3_client=None):
-        """ Return True if [bucket] exists, False if it doesn't """
+        """
+        Return True if [bucket] exists, False if it doesn't. A bucket found once is remembered
+        for the rest of the run, so it's only checked again after a failed check
+        """
 
         s3_client = s3_client or self.s3_client
+        bucket_key = (self.s3_endpoint_url, self.s3_access_key_id, bucket)
+        if bucket_key in _existing_buckets:
+            return True
 
         try:
+            started = time.monotonic()
             s3_client.list_objects(Bucket=bucket, MaxKeys=1)
+            self.tuner.record_request(time.monotonic() - started)
+            _existing_buckets.add(bucket_key)
             return True
         except botocore.exceptions.EndpointConnectionError:
             logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
@@ -72,32 +322,73 @@ class S3():
             logging.error("Couldn't find bucket. Check access rights and whether the bucket actually exists: {}".format(e))
             return False
 
-    def get_objects(self, bucket, s3_client=None):
-        """ Take [bucket] and [s3_client], and return a list of all objects from [bucket] """
+    def object_exists(self, bucket, obj, s3_client=None):
+        """
+        Return True if [obj] exists in [bucket], False if it doesn't or couldn't be checked.
+        The bucket's manifest answers while it's fresh, otherwise the object is looked up
+        """
+
+        manifest = self.manifest(bucket)
+        if manifest is not None:
+            known = manifest.contains(obj)
+            if known is not None:
+                return known
 
         try:
-            all_objects = s3_client.list_objects_v2(Bucket=bucket)
+            return self.head_object(bucket, obj, s3_client) is not None
+        except botocore.exceptions.ClientError:
+            return False
         except botocore.exceptions.EndpointConnectionError:
             logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
-            sys.exit(1)
+            return False
 
-        if 'Contents' in all_objects.keys():
-            all_objects = [ k['Key'] for k in [ obj for obj in all_objects['Contents'] ]] # pylint: disable=unnecessary-comprehension
-        else:
-            all_objects = []
+    def head_object(self, bucket, obj, s3_client=None):
+        """
+        Look up [obj] in [bucket], without consulting the manifest, and return its summary as
+        iter_objects() would, or None if it doesn't exist. An object found is recorded in the
+        bucket's manifest. Errors other than the object not being found are raised
+        """
+
+        s3_client = s3_client or self.s3_client
+        try:
+            started = time.monotonic()
+            response = s3_client.head_object(Bucket=bucket, Key=obj)
+            self.tuner.record_request(time.monotonic() - started)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+        summary = { "Key": obj, "Size": response.get("ContentLength"), "ETag": response.get("ETag"),
+                    "LastModified": response.get("LastModified") }
+        if self.manifest(bucket) is not None:
+            self.manifest(bucket).add(obj, summary["Size"], summary["ETag"], summary["LastModified"])
+
+        return summary
+
+    def get_objects(self, bucket, s3_client=None):
+        """ Take [bucket] and [s3_client], and return a list of all objects from [bucket] """
 
-        return all_objects
+        return list(self.iter_search(bucket, s3_client=s3_client))
 
     def upload(self, bucket, obj, s3_client=None):
-        """ Upload [obj] to [bucket]. Return True for success, False for failure """
+        """
+        Upload [obj] to [bucket], with settings chosen for its size. Return True for success,
+        False for failure
+        """
 
         s3_client = s3_client or self.s3_client
-        transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=1024, use_threads=True, max_concurrency=10)
-        s3_transfer = boto3.s3.transfer.S3Transfer(client=s3_client, config=transfer_config)
+        size = os.path.getsize(obj)
+        settings = self.tuner.settings(size, self.transfer_overrides)
 
         try:
             logging.debug("Uploading {} to {}".format(obj, bucket))
-            s3_transfer.upload_file(obj, bucket, helpers.strip_path(obj)[1])
+            started = time.monotonic()
+            with boto3.s3.transfer.S3Transfer(client=s3_client, config=settings.transfer_config()) as s3_transfer:
+                s3_transfer.upload_file(obj, bucket, helpers.strip_path(obj)[1])
+            self.tuner.record_transfer(size, time.monotonic() - started, settings.streams(size))
+            if self.manifest(bucket) is not None:
+                self.manifest(bucket).add(helpers.strip_path(obj)[1], size)
 
             return True
         except botocore.exceptions.EndpointConnectionError:
@@ -107,20 +398,173 @@ class S3():
             logging.error("Error uploading: {}".format(e))
             return False
 
+    def upload_stream(self, bucket, obj, chunks, size_hint=None, s3_client=None):
+        """
+        Upload the bytes yielded by [chunks] to [bucket] as [obj], without a local file. Parts
+        are sent as a multipart upload as soon as they are filled, as many at once as the
+        settings chosen for [size_hint] allow, within STREAM_BUFFER_SIZE of memory. The part
+        size and multipart threshold are capped at STREAM_BUFFER_SIZE here, even if they're
+        set higher in the config. Data smaller than both is sent with a single PUT.
+        Every part is sent with its CRC32, which S3 checks on arrival. [size_hint] is the
+        expected size of the data, used to choose the settings.
+
+        Return True for success, False for failure
+        """
+
+        s3_client = s3_client or self.s3_client
+        settings = self.tuner.settings(size_hint, self.transfer_overrides)
+        # Parts and the data held before multipart starts are kept within the buffer, whatever
+        # the settings, unless the parts have to be larger to fit the size hint in MAXIMUM_PARTS
+        part_size = min(settings.part_size, STREAM_BUFFER_SIZE)
+        if size_hint is not None:
+            part_size = max(part_size, math.ceil(size_hint * tuning.SIZE_MARGIN / tuning.MAXIMUM_PARTS))
+        multipart_start = max(part_size, min(settings.multipart_threshold, STREAM_BUFFER_SIZE))
+        parts_in_flight = max(1, min(settings.max_concurrency, STREAM_BUFFER_SIZE // part_size))
+        slots = threading.BoundedSemaphore(parts_in_flight)
+        upload_id = None
+        futures = []
+
+        def upload_part(part_number, body):
+            try:
+                part_checksum = checksum(body)
+                started = time.monotonic()
+                response = s3_client.upload_part(
+                    Bucket=bucket, Key=obj, UploadId=upload_id, PartNumber=part_number, Body=body,
+                    ChecksumCRC32=part_checksum)
+                self.tuner.record_transfer(len(body), time.monotonic() - started)
+                return { "PartNumber": part_number, "ETag": response["ETag"], "ChecksumCRC32": part_checksum }
+            finally:
+                slots.release()
+
+        def submit_part(pool, body):
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+            slots.acquire()
+            futures.append(pool.submit(upload_part, len(futures) + 1, body))
+
+        try:
+            logging.debug("Streaming {} to {}".format(obj, bucket))
+            with ThreadPoolExecutor(max_workers=parts_in_flight) as pool:
+                buffer = bytearray()
+                size = 0
+                for chunk in chunks:
+                    buffer += chunk
+                    size += len(chunk)
+                    if upload_id is None and len(buffer) < multipart_start:
+                        continue
+                    while len(buffer) >= part_size:
+                        if upload_id is None:
+                            started = time.monotonic()
+                            upload_id = s3_client.create_multipart_upload(
+                                Bucket=bucket, Key=obj, ChecksumAlgorithm="CRC32")["UploadId"]
+                            self.tuner.record_request(time.monotonic() - started)
+                        submit_part(pool, bytes(buffer[:part_size]))
+                        del buffer[:part_size]
+
+                if upload_id is None:
+                    body = bytes(buffer)
+                    started = time.monotonic()
+                    response = s3_client.put_object(Bucket=bucket, Key=obj, Body=body, ChecksumCRC32=checksum(body))
+                    self.tuner.record_transfer(len(body), time.monotonic() - started)
+                    if self.manifest(bucket) is not None:
+                        self.manifest(bucket).add(obj, size, response.get("ETag"))
+                    return True
+
+                if buffer:
+                    submit_part(pool, bytes(buffer))
+                parts = [ future.result() for future in futures ]
+
+            response = s3_client.complete_multipart_upload(
+                Bucket=bucket, Key=obj, UploadId=upload_id, MultipartUpload={ "Parts": parts })
+            if self.manifest(bucket) is not None:
+                self.manifest(bucket).add(obj, size, response.get("ETag"))
+
+            return True
+        except botocore.exceptions.EndpointConnectionError:
+            logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
+        except Exception as e:
+            logging.error("Error uploading {}: {}".format(obj, e))
+
+        if upload_id is not None:
+            try:
+                s3_client.abort_multipart_upload(Bucket=bucket, Key=obj, UploadId=upload_id)
+            except Exception as e:
+                logging.error("Couldn't abort the multipart upload of {}: {}".format(obj, e))
+
+        return False
+
+    def delete_objects(self, bucket, objs, s3_client=None):
+        """
+        Delete the objects named in [objs] from [bucket] with a single DeleteObjects request,
+        so at most DELETE_BATCH_SIZE of them. Deleted objects are removed from the bucket's
+        manifest.
+
+        Return a list of the (name, error message) tuples of objects which couldn't be deleted
+        """
+
+        s3_client = s3_client or self.s3_client
+        objs = list(objs)
+
+        try:
+            logging.debug("Deleting {} objects from {}".format(len(objs), bucket))
+            response = s3_client.delete_objects(
+                Bucket=bucket, Delete={ "Objects": [ { "Key": obj } for obj in objs ], "Quiet": True })
+            errors = [ (error["Key"], error.get("Message", error.get("Code"))) for error in response.get("Errors", []) ]
+        except botocore.exceptions.EndpointConnectionError:
+            logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
+            errors = [ (obj, "Couldn't connect to the endpoint") for obj in objs ]
+        except Exception as e:
+            logging.error("Error deleting from {}: {}".format(bucket, e))
+            errors = [ (obj, str(e)) for obj in objs ]
+
+        if self.manifest(bucket) is not None:
+            failed = { obj for obj, _ in errors }
+            self.manifest(bucket).remove([ obj for obj in objs if obj not in failed ])
+
+        return errors
+
+    def download_stream(self, bucket, obj, byte_range=None, s3_client=None):
+        """
+        Start downloading [obj] from [bucket], and return a binary file object that reads the
+        object's contents as they arrive, or False on failure. [byte_range] is an optional
+        (offset, length) tuple, to download only that part of the object with a ranged GET
+        """
+
+        s3_client = s3_client or self.s3_client
+
+        try:
+            logging.debug("Streaming {} from {}".format(obj, bucket))
+            if byte_range is not None:
+                offset, length = byte_range
+                return s3_client.get_object(
+                    Bucket=bucket, Key=obj, Range=f"bytes={offset}-{offset + length - 1}")["Body"]
+            return s3_client.get_object(Bucket=bucket, Key=obj)["Body"]
+        except botocore.exceptions.EndpointConnectionError:
+            logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
+            return False
+        except Exception as e:
+            logging.error("Error downloading {}: {}".format(obj, e))
+            return False
+
     def download(self, bucket, obj, destination, s3_client=None):
         """
-        Download [obj] from [bucket], and store on local disk at [destination]
+        Download [obj] from [bucket], and store on local disk at [destination]. Its size isn't
+        known beforehand, so it's downloaded with the settings for an object of unknown size
 
         Return [destination] on success, False on failure
         """
 
         s3_client = s3_client or self.s3_client
-        transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=1024, use_threads=True, max_concurrency=10)
-        s3_transfer = boto3.s3.transfer.S3Transfer(client=s3_client, config=transfer_config)
+        settings = self.tuner.settings(None, self.transfer_overrides)
 
         try:
             logging.debug("Downloading {} to {}".format(obj, destination))
-            s3_transfer.download_file(bucket, obj, destination)
+            started = time.monotonic()
+            with boto3.s3.transfer.S3Transfer(client=s3_client, config=settings.transfer_config()) as s3_transfer:
+                s3_transfer.download_file(bucket, obj, destination)
+            size = os.path.getsize(destination)
+            self.tuner.record_transfer(size, time.monotonic() - started, settings.streams(size))
             return destination
         except botocore.exceptions.EndpointConnectionError:
             logging.error("Couldn't connect to an S3 endpoint. If you're using an S3 compatible provider other than AWS, remember to set --s3-endpoint-url")
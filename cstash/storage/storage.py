@@ -9,26 +9,71 @@ import cstash.libs.helpers as helpers
 import os
 
 class Storage():
-    def __init__(self, storage_provider, s3_access_key_id, s3_secret_access_key, log_level="ERROR", s3_endpoint_url=None):
+    def __init__(self, storage_provider, s3_access_key_id, s3_secret_access_key, log_level="ERROR", s3_endpoint_url=None, max_pool_connections=None, cstash_directory=None, manifest_max_age=None, transfer_config=None):
+        """
+        With [cstash_directory], a manifest of the contents of each bucket used is kept there,
+        and trusted for [manifest_max_age] seconds after the bucket was last listed in full.
+        Transfers are tuned to each object's size and the endpoint's measured performance,
+        unless multipart_threshold, part_size, or max_concurrency are set in the
+        [transfer_config] dict, such as the config
+        """
+
         if storage_provider == 's3':
             from cstash.storage.s3 import S3
             self.storage_provider = S3(
                 s3_endpoint_url=s3_endpoint_url,
                 log_level=log_level,
                 s3_access_key_id=s3_access_key_id,
-                s3_secret_access_key=s3_secret_access_key
+                s3_secret_access_key=s3_secret_access_key,
+                max_pool_connections=max_pool_connections,
+                cstash_directory=cstash_directory,
+                manifest_max_age=manifest_max_age,
+                transfer_config=transfer_config
             )
 
-    def search(self, bucket, filename, storage_provider=None):
+    def search(self, bucket, filename, storage_provider=None, prefix="", delimiter=None, jobs=1, refresh=False):
         """
         Search [bucket] with [storage_provider] for [filename]
 
         * If [bucket] is None, then only return a listing of all buckets
         * If [filename] is not None, then return matching objects, otherwise return all objects
+
+        Objects are returned as a generator, so that large buckets can be streamed. Only those
+        starting with [prefix] are listed. With [delimiter], objects below the next
+        [delimiter] are summarised by their common prefix, and with [jobs] greater than 1,
+        the listing is split into partitions listed in parallel. The bucket's manifest is used
+        while it's fresh, unless [refresh] is True
+        """
+
+        storage_provider = storage_provider or self.storage_provider
+        return self.storage_provider.search(
+            bucket, filename, prefix=prefix, delimiter=delimiter, jobs=jobs, refresh=refresh)
+
+    def list_objects(self, bucket, prefix="", jobs=1, refresh=False, storage_provider=None):
+        """
+        Return an iterable of the objects in [bucket] with [storage_provider] starting with
+        [prefix], as dicts with their Key, Size, ETag, and LastModified time. The bucket is
+        listed in [jobs] partitions at once, and the manifest is used while it's fresh, unless
+        [refresh] is True
+        """
+
+        storage_provider = storage_provider or self.storage_provider
+        return self.storage_provider.list_objects(bucket, prefix, jobs=jobs, refresh=refresh)
+
+    def head_object(self, bucket, filename, storage_provider=None):
+        """
+        Look [filename] up in [bucket] with [storage_provider], and return a dict of its Key,
+        Size, ETag, and LastModified time, or None if it doesn't exist
         """
 
         storage_provider = storage_provider or self.storage_provider
-        return self.storage_provider.search(bucket, filename)
+        return self.storage_provider.head_object(bucket, filename)
+
+    def object_exists(self, bucket, filename, storage_provider=None):
+        """ Return True if [filename] is already stored in [bucket], False if not """
+
+        storage_provider = storage_provider or self.storage_provider
+        return self.storage_provider.object_exists(bucket, filename)
 
     def upload(self, bucket, filename, storage_provider=None):
         """
@@ -44,6 +89,35 @@ class Storage():
         logging.info("Uploading {} to {}".format(filename, bucket))
         return self.storage_provider.upload(bucket, filename)
 
+    def upload_stream(self, bucket, filename, chunks, size_hint=None, storage_provider=None):
+        """
+        Make calls to [storage_provider] to upload the bytes yielded by [chunks] to [bucket] as
+        [filename], without writing them to local disk first. [size_hint] is the expected number
+        of bytes, if known
+
+        Return True for success, False for failure
+        """
+
+        storage_provider = storage_provider or self.storage_provider
+        if self.storage_provider.bucket_exists(bucket) is False:
+            raise exceptions.CstashCriticalException(message="Couldn't upload to bucket")
+
+        logging.info("Streaming {} to {}".format(filename, bucket))
+        return self.storage_provider.upload_stream(bucket, filename, chunks, size_hint=size_hint)
+
+    def delete_objects(self, bucket, filenames, storage_provider=None):
+        """
+        Make calls to [storage_provider] to delete every object in [filenames] from [bucket] in
+        one request, so there must be no more than it takes at once, such as
+        cstash.storage.s3.DELETE_BATCH_SIZE.
+
+        Return a list of (filename, error message) tuples for those which couldn't be deleted
+        """
+
+        storage_provider = storage_provider or self.storage_provider
+        logging.info("Deleting {} objects from {}".format(len(filenames), bucket))
+        return self.storage_provider.delete_objects(bucket, filenames)
+
     def download(self, bucket, filename, destination=None, storage_provider=None):
         """
         Make calls to [storage_provider] to fetch [filename] from [bucket],
@@ -68,3 +142,21 @@ class Storage():
             raise exceptions.CstashCriticalException(message="Couldn't download {} from {}".format(filename, storage_provider))
 
         return downloaded_object
+
+    def download_stream(self, bucket, filename, storage_provider=None, byte_range=None):
+        """
+        Make calls to [storage_provider] to start fetching [filename] from [bucket], or only the
+        (offset, length) [byte_range] of it if given.
+
+        Return a binary file object to read the contents from as they arrive, or raise a
+        CstashCriticalException on failure
+        """
+
+        storage_provider = storage_provider or self.storage_provider
+
+        body = self.storage_provider.download_stream(bucket, filename, byte_range=byte_range)
+
+        if body is False:
+            raise exceptions.CstashCriticalException(message="Couldn't download {} from {}".format(filename, storage_provider))
+
+        return body
@@ -0,0 +1,176 @@
+"""
+Choose how each object is transferred from its size and how the endpoint has been performing,
+rather than one fixed configuration for everything.
+
+Every endpoint has a TransferTuner, shared by the whole process, which keeps moving averages of
+the latency of a request, measured from small requests, and the throughput of a single stream,
+measured from transfers of at least MINIMUM_SAMPLE_SIZE. Until anything has been measured,
+DEFAULT_LATENCY and DEFAULT_THROUGHPUT are assumed.
+
+A multipart upload costs two round trips more than a single PUT, and [c] streams move data [c]
+times as fast as one, so multipart only pays off once
+
+    size > 2 * latency * throughput * c / (c - 1)
+
+Below that, and never below MINIMUM_PART_SIZE, objects go out as a single PUT. Parts are large
+enough to fit in MAXIMUM_PARTS, and for the latency of each request to be a small fraction of its
+time on the wire, and an object is sent over as many streams as it has parts, up to the maximum
+concurrency. Any of the threshold, part size, and concurrency can be fixed per profile in the
+config instead, as multipart_threshold, part_size, and max_concurrency
+"""
+
+import math
+import threading
+import boto3.s3.transfer
+import cstash.libs.exceptions as exceptions
+
+# S3 refuses multipart parts smaller than 5 MiB (apart from the last), larger than 5 GiB, and
+# more than 10000 parts
+S3_MINIMUM_PART_SIZE = 5 * 1024 * 1024
+MAXIMUM_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAXIMUM_PARTS = 10000
+# The smallest part size chosen, unless overridden
+MINIMUM_PART_SIZE = 8 * 1024 * 1024
+# Room left in part sizes for encryption and compression overhead, when the size is a guess
+SIZE_MARGIN = 1.05
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_LATENCY = 0.05
+DEFAULT_THROUGHPUT = 10 * 1024 * 1024
+# Transfers smaller than this are dominated by latency, so they're only used to measure it
+MINIMUM_SAMPLE_SIZE = 256 * 1024
+# Parts are sized to take at least this many round trips to send, to amortise the latency
+LATENCY_AMORTISATION = 8
+# Weight of each new measurement in the moving averages
+SMOOTHING = 0.3
+# Settings from the config which override those chosen, with the range of values each can take
+OVERRIDES = {
+    "multipart_threshold": (1, None),
+    "part_size": (S3_MINIMUM_PART_SIZE, MAXIMUM_PART_SIZE),
+    "max_concurrency": (1, None)
+}
+
+_tuners = {}
+_tuners_lock = threading.Lock()
+
+def get_tuner(s3_endpoint_url):
+    """ Return the TransferTuner for [s3_endpoint_url], creating it the first time """
+
+    with _tuners_lock:
+        if s3_endpoint_url not in _tuners:
+            _tuners[s3_endpoint_url] = TransferTuner()
+
+        return _tuners[s3_endpoint_url]
+
+def overrides(config):
+    """
+    Return a dict of the settings in OVERRIDES which are set in [config], as integers. Raise a
+    CstashCriticalException if any isn't a whole number in its range, rather than let S3 refuse
+    it mid transfer
+    """
+
+    config = config or {}
+    settings = {}
+    for name, (minimum, maximum) in OVERRIDES.items():
+        if not config.get(name):
+            continue
+
+        try:
+            value = int(config[name])
+        except (TypeError, ValueError):
+            value = None
+        if value is None or value < minimum or (maximum is not None and value > maximum):
+            allowed = f"at least {minimum}" if maximum is None else f"from {minimum} to {maximum}"
+            raise exceptions.CstashCriticalException(
+                message=f"{name} is {config[name]} in the config, but must be a whole number {allowed}")
+        settings[name] = value
+
+    return settings
+
+class TransferSettings():
+    """
+    The [multipart_threshold], [part_size], and [max_concurrency] to transfer an object with
+    """
+
+    def __init__(self, multipart_threshold, part_size, max_concurrency):
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+
+    def streams(self, size):
+        """ Return the number of streams an object of [size] bytes is moved over """
+
+        if size < self.multipart_threshold:
+            return 1
+
+        return max(1, min(self.max_concurrency, math.ceil(size / self.part_size)))
+
+    def transfer_config(self):
+        """ Return the settings as a boto3 TransferConfig """
+
+        return boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.multipart_threshold, multipart_chunksize=self.part_size,
+            max_concurrency=self.max_concurrency, use_threads=True)
+
+class TransferTuner():
+    """
+    Measurements of an endpoint's latency and per stream throughput, used to choose transfer
+    settings. Can be shared between threads
+    """
+
+    def __init__(self):
+        self.latency = DEFAULT_LATENCY
+        self.throughput = DEFAULT_THROUGHPUT
+        self.lock = threading.Lock()
+
+    def record_request(self, seconds):
+        """ Record that a request which moved next to no data took [seconds] """
+
+        with self.lock:
+            self.latency += SMOOTHING * (seconds - self.latency)
+
+    def record_transfer(self, size, seconds, streams=1):
+        """
+        Record that [size] bytes were moved in [seconds] over [streams] parallel streams.
+        Transfers too small to say anything about throughput are counted as requests
+        """
+
+        if size < MINIMUM_SAMPLE_SIZE * streams:
+            self.record_request(seconds)
+            return
+
+        with self.lock:
+            throughput = size / streams / max(seconds - self.latency, seconds / 2)
+            self.throughput += SMOOTHING * (throughput - self.throughput)
+
+    def settings(self, size=None, config_overrides=None):
+        """
+        Return the TransferSettings for an object of about [size] bytes, or of unknown size if
+        None. [config_overrides] is a dict from overrides(), whose settings are used as given
+        """
+
+        config_overrides = config_overrides or {}
+        with self.lock:
+            latency, throughput = self.latency, self.throughput
+
+        max_concurrency = config_overrides.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+
+        multipart_threshold = config_overrides.get("multipart_threshold")
+        if multipart_threshold is None:
+            multipart_threshold = MINIMUM_PART_SIZE
+            if max_concurrency > 1:
+                multipart_threshold = max(
+                    multipart_threshold, math.ceil(2 * latency * throughput * max_concurrency / (max_concurrency - 1)))
+            else:
+                multipart_threshold = MAXIMUM_PART_SIZE
+
+        part_size = config_overrides.get("part_size")
+        if part_size is None:
+            part_size = max(MINIMUM_PART_SIZE, math.ceil(LATENCY_AMORTISATION * latency * throughput))
+            if size is not None:
+                part_size = max(part_size, math.ceil(size * SIZE_MARGIN / MAXIMUM_PARTS))
+            part_size = min(part_size, MAXIMUM_PART_SIZE)
+
+        if size is not None and "max_concurrency" not in config_overrides:
+            max_concurrency = max(1, min(max_concurrency, math.ceil(size / part_size)))
+
+        return TransferSettings(multipart_threshold, part_size, max_concurrency)
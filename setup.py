@@ -23,8 +23,12 @@ setuptools.setup(
         'python-gnupg',
         'daemon',
         'persist-queue',
-        'cryptography'
+        'cryptography',
+        'numpy'
         ],
+    extras_require={
+        "zstd": ["zstandard"]
+    },
     tests_require=[
         "coverage",
         "moto"
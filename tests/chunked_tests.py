@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for stashing files as content-defined chunks
+"""
+
+import unittest
+import io
+import os
+import shutil
+from cstash.crypto.chunked import ChunkedStorage
+from cstash.crypto.crypto import Encryption
+from cstash.crypto.filenames_database import FilenamesDatabase
+
+class RecordingStorage():
+    """ Stands in for Storage, keeping uploaded objects in [self.objects] """
+
+    def __init__(self):
+        self.objects = {}
+
+    def object_exists(self, bucket, filename): # pylint: disable=unused-argument
+        return filename in self.objects
+
+    def upload_stream(self, bucket, filename, chunks, size_hint=None): # pylint: disable=unused-argument
+        self.objects[filename] = b"".join(chunks)
+        return True
+
+    def download_stream(self, bucket, filename): # pylint: disable=unused-argument
+        return io.BytesIO(self.objects[filename])
+
+class TestChunkedStorage(unittest.TestCase):
+    """
+    Test that chunked files can be fetched back, whatever else shares the bucket
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths and storage options to be used """
+
+        super(TestChunkedStorage, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.test_file = f"{self.test_files_directory}/chunky"
+        self.endpoint_url = "https://s3.amazonaws.com"
+        self.bucket = "bucket"
+
+    def setUp(self):
+        """ Write a file large enough to make several chunks """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        self.data = os.urandom(3 * 1024 * 1024)
+        with open(self.test_file, "wb") as test_file:
+            test_file.write(self.data)
+
+        self.encryption = Encryption(self.test_files_directory, "python")
+        self.storage = RecordingStorage()
+        self.filename_db = FilenamesDatabase(self.test_files_directory)
+        self.chunked_storage = ChunkedStorage(
+            self.test_files_directory, self.encryption, self.storage, self.filename_db, jobs=2)
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        self.filename_db.close()
+        shutil.rmtree(self.test_files_directory)
+
+    def test_same_data_under_two_keys(self):
+        """
+        Stash the test file with one key, then again with another, and fetch both.
+
+        Should upload the chunks again for the second key rather than reuse the first key's,
+        and give back the file's contents with either key
+        """
+
+        manifests = {}
+        for key in ("first_key", "second_key"):
+            this_path = f"{self.test_file}.{key}"
+            shutil.copy(self.test_file, this_path)
+            manifest, _, uploaded = self.chunked_storage.upload(
+                this_path, "python", key, self.endpoint_url, self.bucket)
+            self.filename_db.store_chunked(
+                this_path, manifest, "python", key, "s3", self.endpoint_url, self.bucket)
+            manifests[key] = manifest
+
+            self.assertEqual(uploaded, len(manifest))
+
+        self.assertFalse({ chunk_id for chunk_id, _ in manifests["first_key"] } &
+                         { chunk_id for chunk_id, _ in manifests["second_key"] })
+
+        for key, manifest in manifests.items():
+            destination = self.chunked_storage.fetch(
+                manifest, f"{self.test_files_directory}/fetched.{key}", self.bucket, key)
+            with open(destination, "rb") as fetched:
+                self.assertEqual(fetched.read(), self.data)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for content-defined chunking
+"""
+
+import unittest
+import io
+import os
+import time
+from cstash.crypto import chunker
+
+class TestChunker(unittest.TestCase):
+    """
+    Test that files are split into chunks within the size limits, at boundaries that follow
+    the content
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the chunk sizes to be used, small enough for the tests to be quick """
+
+        super(TestChunker, self).__init__(*args, **kwargs)
+        self.sizes = { "minimum_size": 1024, "average_size": 4096, "maximum_size": 16384 }
+        self.data = os.urandom(512 * 1024)
+
+    def test_split_sizes(self):
+        """
+        Split random data.
+
+        Should give chunks which join back into the data, all within the size limits apart
+        from the last one
+        """
+
+        chunks = list(chunker.split(io.BytesIO(self.data), **self.sizes))
+
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), self.sizes["minimum_size"])
+            self.assertLessEqual(len(chunk), self.sizes["maximum_size"])
+
+    def test_insertion_keeps_chunks(self):
+        """
+        Split random data, then split it again with a few bytes inserted in the middle.
+
+        Should find all but a few of the original chunks again
+        """
+
+        edited = self.data[:len(self.data) // 2] + b"inserted" + self.data[len(self.data) // 2:]
+
+        original = list(chunker.split(io.BytesIO(self.data), **self.sizes))
+        changed = set(chunker.split(io.BytesIO(edited), **self.sizes))
+
+        self.assertLessEqual(len([ c for c in original if c not in changed ]), 2)
+
+    def test_boundaries_unchanged(self):
+        """
+        Find boundaries in random data both with find_boundary, and by computing the hash one
+        byte at a time.
+
+        Should find the same boundaries, so that chunks stashed before keep being matched
+        """
+
+        mask = chunker.boundary_mask(self.sizes["average_size"])
+        for offset in range(0, 64 * 1024, 8192):
+            data = self.data[offset:offset + 64 * 1024]
+            rolling_hash = 0
+            expected = len(data)
+            for i in range(self.sizes["minimum_size"], len(data)):
+                rolling_hash = ((rolling_hash << 1) + chunker.GEAR[data[i]]) & chunker.HASH_MASK
+                if not rolling_hash & mask:
+                    expected = i + 1
+                    break
+
+            self.assertEqual(
+                chunker.find_boundary(data, self.sizes["minimum_size"], len(data), mask), expected)
+
+    def test_throughput(self):
+        """
+        Split 32 MiB of random data with the default chunk sizes.
+
+        Should chunk at least 20 MiB a second, several times faster than hashing one byte at
+        a time can
+        """
+
+        data = os.urandom(32 * 1024 * 1024)
+
+        started = time.monotonic()
+        chunks = list(chunker.split(io.BytesIO(data)))
+        seconds = time.monotonic() - started
+
+        self.assertEqual(sum(len(chunk) for chunk in chunks), len(data))
+        self.assertGreater(len(data) / 1024 / 1024 / seconds, 20)
+
+    def test_empty(self):
+        """ Split an empty file. Should give no chunks """
+
+        self.assertEqual(list(chunker.split(io.BytesIO(b""), **self.sizes)), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for garbage collection of unreferenced objects
+"""
+
+import unittest
+import datetime
+import os
+import shutil
+from cstash.crypto.filenames_database import FilenamesDatabase
+from cstash.storage.collector import GarbageCollector
+from cstash.storage.s3 import DELETE_BATCH_SIZE
+
+class ListingStorage():
+    """ Stands in for Storage, listing and deleting the object summaries in [self.objects] """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def list_objects(self, bucket, prefix="", jobs=1, refresh=False): # pylint: disable=unused-argument
+        return list(self.objects.values())
+
+    def delete_objects(self, bucket, filenames): # pylint: disable=unused-argument
+        self.requests.append(filenames)
+        for filename in filenames:
+            del self.objects[filename]
+        return []
+
+class TestGarbageCollector(unittest.TestCase):
+    """
+    Test that only old objects nothing refers to are deleted, in batches
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestGarbageCollector, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.test_file_path = f"{self.test_files_directory}/stashed"
+        self.endpoint_url = "https://s3.amazonaws.com"
+
+    def setUp(self):
+        """ Stash a test file in a chunk, and this file whole """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        with open(self.test_file_path, "w") as test_file:
+            test_file.write("foobar")
+
+        files_db = FilenamesDatabase(self.test_files_directory)
+        files_db.store_chunked(self.test_file_path, [("a" * 64, 6)], "python", "default", "s3", self.endpoint_url, "bucket")
+        self.whole_object = files_db.store_many([__file__], "python", "default", "s3", self.endpoint_url, "bucket")[__file__]
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_collect(self):
+        """
+        Collect a bucket holding the referenced objects, a database backup, a recent orphan,
+        and more old orphans than fit in one request, first as a dry run.
+
+        Should delete only the old orphans, in requests of DELETE_BATCH_SIZE, and forget no
+        chunk still referred to
+        """
+
+        old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+        objects = { key: { "Key": key, "Size": 1, "LastModified": old }
+                    for key in [f"chunks/{'a' * 64}", self.whole_object, "filenames.sqlite.encrypted"] +
+                               [ f"{i:064x}" for i in range(DELETE_BATCH_SIZE + 1) ] }
+        objects["recent"] = { "Key": "recent", "Size": 1, "LastModified": datetime.datetime.now(datetime.timezone.utc) }
+        storage = ListingStorage(objects)
+
+        results = GarbageCollector(self.test_files_directory, storage, "bucket", dry_run=True).run()
+        self.assertEqual((len(results['deleted']), results['recent'], storage.requests),
+                         (DELETE_BATCH_SIZE + 1, ["recent"], []))
+
+        results = GarbageCollector(self.test_files_directory, storage, "bucket", jobs=2).run()
+        self.assertEqual(sorted(len(request) for request in storage.requests), [1, DELETE_BATCH_SIZE])
+        self.assertEqual(results['bytes'], DELETE_BATCH_SIZE + 1)
+        self.assertEqual(sorted(storage.objects),
+                         sorted([f"chunks/{'a' * 64}", self.whole_object, "filenames.sqlite.encrypted", "recent"]))
+        self.assertEqual(FilenamesDatabase(self.test_files_directory).known_chunks(["a" * 64], self.endpoint_url, "bucket"), {"a" * 64})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for compression before encryption
+"""
+
+import unittest
+import hashlib
+import io
+import os
+import shutil
+from cstash.crypto import compression
+from cstash.crypto.crypto import Encryption
+
+class TestCompression(unittest.TestCase):
+    """
+    Test choosing whether to compress files, and compressing them as streams
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths and data to be used """
+
+        super(TestCompression, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.text_file = f"{self.test_files_directory}/text.csv"
+        self.random_file = f"{self.test_files_directory}/random.bin"
+        self.text = b"".join(b"%d,some,comma,separated,values\n" % i for i in range(100000))
+
+    def setUp(self):
+        """ Write a file which compresses well, and one which doesn't """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        with open(self.text_file, "wb") as text_file:
+            text_file.write(self.text)
+        with open(self.random_file, "wb") as random_file:
+            random_file.write(os.urandom(256 * 1024))
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_choose(self):
+        """
+        Choose a codec for both files.
+
+        Should compress the text, but not the random data
+        """
+
+        codec = compression.available_codec("zstd")
+
+        self.assertIn(codec, compression.CODECS)
+        self.assertEqual(compression.choose(self.text_file, codec), codec)
+        self.assertIsNone(compression.choose(self.random_file, codec))
+        self.assertIsNone(compression.available_codec("none"))
+
+    def test_stream_round_trip(self):
+        """
+        Compress the text through CompressingReader in small reads, then decompress it through
+        DecompressingWriter in small writes.
+
+        Should give back the original text, having compressed it
+        """
+
+        codec = compression.available_codec("zlib")
+        reader = compression.CompressingReader(io.BytesIO(self.text), codec)
+        compressed = b"".join(iter(lambda: reader.read(1000), b""))
+
+        destination = io.BytesIO()
+        writer = compression.DecompressingWriter(destination, codec)
+        for start in range(0, len(compressed), 1000):
+            writer.write(compressed[start:start + 1000])
+        writer.finish()
+
+        self.assertLess(len(compressed), len(self.text) / 4)
+        self.assertEqual(destination.getvalue(), self.text)
+
+    def test_encrypt_decrypt_compressed(self):
+        """
+        Encrypt the text with compression, hashing it in the same pass, and decrypt it again.
+
+        Should hash the uncompressed text, and give back the original text
+        """
+
+        codec = compression.available_codec("zstd")
+        encryption = Encryption(self.test_files_directory, "python")
+        file_hash = hashlib.sha256()
+        encrypted = b"".join(encryption.encrypt_stream(self.text_file, "test", compression=codec, file_hash=file_hash))
+        self.assertEqual(file_hash.hexdigest(), hashlib.sha256(self.text).hexdigest())
+
+        destination = f"{self.test_files_directory}/decrypted.csv"
+        encryption.decrypt_stream(io.BytesIO(encrypted), destination, "test", compression=codec)
+
+        with open(destination, "rb") as decrypted_file:
+            self.assertEqual(decrypted_file.read(), self.text)
+
+if __name__ == "__main__":
+    unittest.main()
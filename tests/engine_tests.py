@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for stashing files with the engine
+"""
+
+import unittest
+import os
+import shutil
+from cstash.crypto.engine import StashEngine
+
+class RecordingStorage():
+    """ Stands in for Storage, keeping uploaded objects in [self.objects] """
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_stream(self, bucket, filename, chunks, size_hint=None): # pylint: disable=unused-argument
+        self.objects[filename] = b"".join(chunks)
+        return True
+
+class TestStashEngine(unittest.TestCase):
+    """
+    Test that files are stashed and recorded one after another
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths and config to be used """
+
+        super(TestStashEngine, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.config = {
+            "cryptographer": "python",
+            "key": "default",
+            "storage_provider": "s3",
+            "s3_endpoint_url": "https://s3.amazonaws.com",
+            "s3_access_key_id": "access_key_id",
+            "s3_secret_access_key": "secret_access_key",
+            "bucket": "bucket",
+            "pack": "true"
+        }
+
+    def setUp(self):
+        """ Write a small file and a larger one """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        self.small_file = f"{self.test_files_directory}/small"
+        self.large_file = f"{self.test_files_directory}/large"
+        with open(self.small_file, "wb") as small_file:
+            small_file.write(os.urandom(100))
+        with open(self.large_file, "wb") as large_file:
+            large_file.write(os.urandom(64 * 1024))
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_unreadable_paths(self):
+        """
+        Stash a directory and a path which doesn't exist, between a file to pack and a file to
+        upload whole.
+
+        Should fail only the unreadable paths, and upload and record the others
+        """
+
+        engine = StashEngine(self.test_files_directory, self.config)
+        engine.storage = engine.chunked_storage.storage = RecordingStorage()
+        paths = [self.small_file, self.test_files_directory, f"{self.test_files_directory}/missing", self.large_file]
+
+        results = dict((this_path, status) for status, this_path in engine.stash(paths))
+        recorded = engine.filename_db.lookup_many(paths)
+        engine.close()
+
+        self.assertEqual(results, {
+            self.small_file: "uploaded",
+            self.test_files_directory: "failed",
+            f"{self.test_files_directory}/missing": "failed",
+            self.large_file: "uploaded"
+        })
+        self.assertEqual(set(recorded), { self.small_file, self.large_file })
+        self.assertEqual(len(engine.storage.objects), 2)
+
+if __name__ == "__main__":
+    unittest.main()
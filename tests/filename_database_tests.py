@@ -9,6 +9,8 @@ from sqlitedict import SqliteDict
 import os
 import shutil
 import hashlib
+import sqlite3
+import threading
 import cstash.crypto.filenames_database as filenames
 
 class TestFilenameDatabaseOperations(unittest.TestCase):
@@ -92,6 +94,9 @@ class TestFilenameDatabaseOperations(unittest.TestCase):
         Test search() by searching for an existing record with permutations of fuzziness,
         and directory levels.
 
+        The fixture is written in the legacy SqliteDict format, so this also tests migration.
+        Fields the fixture didn't set are migrated as None.
+
         Should return a list with a single element containing the existing record in all cases.
         """
 
@@ -100,14 +105,15 @@ class TestFilenameDatabaseOperations(unittest.TestCase):
         for name, (exact, this_path, this_hash) in self.search_cases.items():
             with self.subTest(name=name):
                 result = files_db.search(obj=this_path, exact=exact)
-                self.assertTrue(result == [(
-                    this_path,
+                self.assertEqual(len(result), 1)
+                self.assertEqual(result[0][0], this_path)
+                self.assertEqual(
+                    { k: v for k, v in result[0][1].items() if v is not None },
                     {
                         "filename_hash": this_hash,
                         "cryptographer": self.dummy_cryptographer,
                         "bucket": self.dummy_bucket_name
-                    }
-                    )])
+                    })
 
     def test_search_non_existent_record(self):
         """
@@ -126,18 +132,40 @@ class TestFilenameDatabaseOperations(unittest.TestCase):
 
     def test_existing_hash(self):
         """
-        Test existing_hash() by searching for both known entries that should exist
-        in the database, and made up entries that shouldn't.
+        Test existing_hash() by storing entries for the test files, then checking them
+        unmodified, touched, modified, and checking made up entries that shouldn't exist.
 
-        Should return True for known entries, and False for made up entries.
+        Should return True for unmodified and touched files, and False for modified files
+        and made up entries.
         """
 
         files_db = filenames.FilenamesDatabase(self.test_files_directory)
 
+        for this_path in [self.single_directory_file_path, self.two_directory_tieres_file_path]:
+            store_result = files_db.store(
+                obj=this_path,
+                cryptographer=self.dummy_cryptographer,
+                key=self.dummy_key,
+                storage_provider=self.storage_provider,
+                s3_endpoint_url=self.dummy_endpoint_url,
+                bucket=self.dummy_bucket_name
+            )
+            files_db.close_db_connection(store_result["db_connection"])
+
         self.assertTrue(files_db.existing_hash(self.single_directory_file_path))
         self.assertTrue(files_db.existing_hash(self.two_directory_tieres_file_path))
         self.assertFalse(files_db.existing_hash("boogada"))
 
+        file_stat = os.stat(self.single_directory_file_path)
+        os.utime(self.single_directory_file_path, (file_stat.st_atime, file_stat.st_mtime + 10))
+        self.assertTrue(files_db.existing_hash(self.single_directory_file_path))
+        self.assertEqual(files_db.search(self.single_directory_file_path, exact=True)[0][1]["mtime"],
+                         file_stat.st_mtime + 10)
+
+        with open(self.two_directory_tieres_file_path, "a") as test_file:
+            test_file.write(", and some more")
+        self.assertFalse(files_db.existing_hash(self.two_directory_tieres_file_path))
+
     def test_store_and_close(self):
         """
         Store an entry in the database using store(), then close the connection using
@@ -193,5 +221,244 @@ class TestFilenameDatabaseOperations(unittest.TestCase):
 
         files_db.close_db_connection(store_result["db_connection"])
 
+    def test_lookup_many(self):
+        """
+        Look up a mix of existing and made up paths with lookup_many().
+
+        Should return a dict with entries for only the existing paths
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+
+        result = files_db.lookup_many([
+            self.single_directory_file_path,
+            self.two_directory_tieres_file_path,
+            "/should/not/exist"
+        ])
+
+        self.assertEqual(sorted(result.keys()),
+                         sorted([self.single_directory_file_path, self.two_directory_tieres_file_path]))
+        self.assertEqual(result[self.single_directory_file_path]["filename_hash"],
+                         self.single_directory_filename_hash)
+
+    def test_store_many_and_lookup(self):
+        """
+        Store both test files with store_many(), then look them up with lookup_many().
+
+        Should return the same obsfucated names from both, with the size of the files stored
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+
+        stored = files_db.store_many(
+            objs=[self.single_directory_file_path, self.two_directory_tieres_file_path],
+            cryptographer=self.dummy_cryptographer,
+            key=self.dummy_key,
+            storage_provider=self.storage_provider,
+            s3_endpoint_url=self.dummy_endpoint_url,
+            bucket=self.dummy_bucket_name
+        )
+        looked_up = files_db.lookup_many(stored.keys())
+
+        for this_path, filename_hash in stored.items():
+            self.assertEqual(looked_up[this_path]["filename_hash"], filename_hash)
+            self.assertEqual(looked_up[this_path]["size"], os.path.getsize(this_path))
+            self.assertTrue(files_db.existing_hash(this_path, looked_up[this_path]))
+
+    def test_search_indexed_queries(self):
+        """
+        Search with a glob, a directory prefix, a substring shorter than a trigram, and a limit.
+
+        Should return the matching test files only, and no more than the limit
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        both_files = sorted([self.single_directory_file_path, self.two_directory_tieres_file_path])
+
+        cases = {
+            "glob": (f"{self.test_files_directory}/*.txt", False, None, both_files),
+            "glob_no_match": ("*.csv", False, None, []),
+            "prefix": (f"{self.test_files_directory}/one/", True, None, [self.two_directory_tieres_file_path]),
+            "short_substring": ("tw", False, None, [self.two_directory_tieres_file_path]),
+            "substring_case_sensitive": ("FOOBAR", False, None, []),
+            "limit": ("foobar", False, 1, 1)
+        }
+
+        for name, (query, prefix, limit, expected) in cases.items():
+            with self.subTest(name=name):
+                result = sorted([ r[0] for r in files_db.iter_search(query, prefix=prefix, limit=limit) ])
+                if isinstance(expected, int):
+                    self.assertEqual(len(result), expected)
+                else:
+                    self.assertEqual(result, expected)
+
+    def test_legacy_migration(self):
+        """
+        Open the legacy fixture database, then open it again.
+
+        Should drop the legacy table on the first open, and keep both entries on the second
+        """
+
+        filenames.FilenamesDatabase(self.test_files_directory)
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+
+        with sqlite3.connect(self.test_db_file) as db_connection:
+            tables = [ row[0] for row in db_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'") ]
+        self.assertNotIn("unnamed", tables)
+        self.assertEqual(len(files_db.return_all_entries()), 2)
+
+    def test_schema_version(self):
+        """
+        Open the database, drop one of its indexes, then open it again, and again after
+        marking it as an older schema version.
+
+        Should only recreate the index when the schema version is older than SCHEMA_VERSION
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        trigrams = files_db.trigrams
+
+        def indexes():
+            with sqlite3.connect(self.test_db_file) as db_connection:
+                return [ row[0] for row in db_connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'") ]
+
+        with sqlite3.connect(self.test_db_file) as db_connection:
+            self.assertEqual(db_connection.execute("PRAGMA user_version").fetchone()[0], filenames.SCHEMA_VERSION)
+            db_connection.execute("DROP INDEX files_mtime")
+
+        self.assertEqual(filenames.FilenamesDatabase(self.test_files_directory).trigrams, trigrams)
+        self.assertNotIn("files_mtime", indexes())
+
+        with sqlite3.connect(self.test_db_file) as db_connection:
+            db_connection.execute(f"PRAGMA user_version = {filenames.SCHEMA_VERSION - 1}")
+
+        filenames.FilenamesDatabase(self.test_files_directory)
+        self.assertIn("files_mtime", indexes())
+
+    def test_store_chunked(self):
+        """
+        Store a test file with a chunk manifest, then store it again whole.
+
+        Should return the manifest in order and know its chunks, then forget the manifest but
+        not the chunks
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        manifest = [("b" * 64, 20), ("a" * 64, 11)]
+
+        files_db.store_chunked(
+            self.single_directory_file_path, manifest, self.dummy_cryptographer, self.dummy_key,
+            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        self.assertEqual(files_db.manifest(self.single_directory_file_path), manifest)
+        self.assertEqual(files_db.search(self.single_directory_file_path, exact=True)[0][1]["chunked"], 1)
+        self.assertEqual(files_db.known_chunks(["a" * 64, "c" * 64], self.dummy_endpoint_url, self.dummy_bucket_name),
+                         {"a" * 64})
+
+        files_db.store_many([self.single_directory_file_path], self.dummy_cryptographer, self.dummy_key,
+                            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        self.assertEqual(files_db.manifest(self.single_directory_file_path), [])
+        self.assertEqual(len(files_db.known_chunks(["a" * 64, "b" * 64], self.dummy_endpoint_url, self.dummy_bucket_name)), 2)
+
+    def test_shared_objects(self):
+        """
+        Store one test file, then look for copies of it from the other test file, which has the
+        same contents, and from a hard link to it, then share its object with the copy.
+
+        Should find the copy by hash and the hard link without hashing, count both references
+        to the shared object, and upload either file under a new name so it isn't overwritten
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        hard_link = f"{self.test_files_directory}/hard_link.txt"
+        os.link(self.single_directory_file_path, hard_link)
+        storage_options = (self.dummy_cryptographer, self.dummy_key, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        files_db.store_many([self.single_directory_file_path], self.dummy_cryptographer, self.dummy_key,
+                            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        (duplicate_path, duplicate), file_hash = files_db.find_duplicate(self.two_directory_tieres_file_path, *storage_options)
+        self.assertEqual(duplicate_path, self.single_directory_file_path)
+        self.assertEqual(file_hash, duplicate["file_hash"])
+
+        (duplicate_path, _), file_hash = files_db.find_duplicate(hard_link, *storage_options)
+        self.assertEqual(duplicate_path, self.single_directory_file_path)
+        self.assertIsNone(file_hash)
+
+        self.assertEqual(files_db.find_duplicate(hard_link, "other_cryptographer", *storage_options[1:]), (None, None))
+
+        files_db.store_many([self.two_directory_tieres_file_path], self.dummy_cryptographer, self.dummy_key,
+                            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name,
+                            overrides={ self.two_directory_tieres_file_path: files_db.shared_entry(duplicate) })
+
+        shared_object = self.single_directory_filename_hash
+        self.assertEqual(files_db.references(shared_object), 2)
+        self.assertEqual(files_db.references(shared_object, excluding=self.single_directory_file_path), 1)
+        self.assertNotEqual(files_db.object_name(self.single_directory_file_path), shared_object)
+        self.assertNotEqual(files_db.object_name(self.two_directory_tieres_file_path), shared_object)
+
+    def test_stored_objects(self):
+        """
+        Store one test file whole with its stored size, and the other in chunks, then in a pack.
+
+        Should need the whole object at its stored size, then each chunk, then the pack, at
+        least as large as the end of its member
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        location = (self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        files_db.store_many([self.single_directory_file_path], self.dummy_cryptographer, self.dummy_key,
+                            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name,
+                            overrides={ self.single_directory_file_path: { "stored_size": 123 } })
+        files_db.store_chunked(
+            self.two_directory_tieres_file_path, [("a" * 64, 20), ("b" * 64, 11)], self.dummy_cryptographer,
+            self.dummy_key, self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name)
+
+        self.assertEqual(files_db.stored_objects(), { location: {
+            self.single_directory_filename_hash: (123, None, [self.single_directory_file_path]),
+            f"chunks/{'a' * 64}": (None, None, [self.two_directory_tieres_file_path]),
+            f"chunks/{'b' * 64}": (None, None, [self.two_directory_tieres_file_path]) } })
+
+        files_db.store_many([self.two_directory_tieres_file_path], self.dummy_cryptographer, self.dummy_key,
+                            self.storage_provider, self.dummy_endpoint_url, self.dummy_bucket_name,
+                            packs={ self.two_directory_tieres_file_path: ("p" * 32, 100, 40) })
+
+        self.assertEqual(files_db.stored_objects()[location][f"packs/{'p' * 32}"],
+                         (None, 140, [self.two_directory_tieres_file_path]))
+
+    def test_keep_open(self):
+        """
+        Store and look up the test files over connections kept open, from two threads.
+
+        Should reuse one connection per thread, see writes made from the other thread, and
+        close every connection with close()
+        """
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory, keep_open=True)
+        self.assertIs(files_db.connect(), files_db.connect())
+
+        def store_in_thread():
+            files_db.store_many(
+                objs=[self.single_directory_file_path],
+                cryptographer=self.dummy_cryptographer,
+                key=self.dummy_key,
+                storage_provider=self.storage_provider,
+                s3_endpoint_url=self.dummy_endpoint_url,
+                bucket=self.dummy_bucket_name
+            )
+
+        thread = threading.Thread(target=store_in_thread)
+        thread.start()
+        thread.join()
+
+        looked_up = files_db.lookup_many([self.single_directory_file_path])
+        self.assertEqual(looked_up[self.single_directory_file_path]["key"], self.dummy_key)
+        self.assertEqual(len(files_db.open_connections), 2)
+
+        files_db.close()
+        self.assertEqual(files_db.open_connections, [])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for the fingerprint cache
+"""
+
+import unittest
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import cstash.crypto.fingerprints as fingerprints
+
+class TestFingerprintCache(unittest.TestCase):
+    """
+    Test that file hashes are cached, invalidated, and evicted
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestFingerprintCache, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.test_file = f"{self.test_files_directory}/fingerprinted"
+
+    def setUp(self):
+        """ Write a test file, and cache hashes of files however recently they were modified """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        with open(self.test_file, "wb") as test_file:
+            test_file.write(b"Some amazing things, right here")
+        self.racy_window = fingerprints.RACY_WINDOW_NS
+        fingerprints.RACY_WINDOW_NS = 0
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        fingerprints.RACY_WINDOW_NS = self.racy_window
+        shutil.rmtree(self.test_files_directory)
+
+    def test_cached_and_invalidated(self):
+        """
+        Hash the test file twice, then change its contents without changing its size or
+        mtime, and hash it again.
+
+        Should cache the first hash, and give the new hash after the change
+        """
+
+        cache = fingerprints.FingerprintCache(self.test_files_directory)
+        first_hash = cache.file_hash(self.test_file)
+
+        self.assertEqual(first_hash, hashlib.sha256(b"Some amazing things, right here").hexdigest())
+        self.assertEqual(cache.lookup(os.stat(self.test_file)), first_hash)
+        self.assertEqual(cache.file_hash(self.test_file), first_hash)
+
+        file_stat = os.stat(self.test_file)
+        with open(self.test_file, "wb") as test_file:
+            test_file.write(b"Some amazing things, right there")
+        os.utime(self.test_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+        self.assertIsNone(cache.lookup(os.stat(self.test_file)))
+        self.assertEqual(cache.file_hash(self.test_file), hashlib.sha256(b"Some amazing things, right there").hexdigest())
+
+    def test_eviction(self):
+        """
+        Hash three files with a cache of at most two, then evict.
+
+        Should keep two hashes
+        """
+
+        cache = fingerprints.FingerprintCache(self.test_files_directory, maximum_entries=2)
+        for i in range(3):
+            shutil.copy(self.test_file, f"{self.test_file}{i}")
+            cache.file_hash(f"{self.test_file}{i}")
+        cache.evict()
+
+        self.assertEqual(cache.connect().execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0], 2)
+
+    def test_close_and_failures(self):
+        """
+        Hash the test file from another thread, close the cache, then remember a hash in a
+        cache which can't be opened.
+
+        Should close the other thread's connection too, and log the failure rather than raise
+        """
+
+        cache = fingerprints.FingerprintCache(self.test_files_directory)
+        thread = threading.Thread(target=cache.file_hash, args=(self.test_file,))
+        thread.start()
+        thread.join()
+        other_connection = cache.open_connections[0]
+        cache.close()
+
+        self.assertEqual(cache.open_connections, [])
+        with self.assertRaises(sqlite3.ProgrammingError):
+            other_connection.execute("SELECT 1")
+
+        broken_cache = fingerprints.FingerprintCache(f"{self.test_files_directory}/missing")
+        self.assertFalse(broken_cache.remember(self.test_file, os.stat(self.test_file), "hash"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,6 +9,18 @@ import helper_tests
 import filename_database_tests
 import integration_tests
 import config_tests
+import pcrypt_tests
+import watcher_tests
+import scheduler_tests
+import chunker_tests
+import compression_tests
+import pack_tests
+import fingerprint_tests
+import manifest_tests
+import collector_tests
+import tuning_tests
+import chunked_tests
+import engine_tests
 
 loader = unittest.TestLoader()
 suite  = unittest.TestSuite()
@@ -17,6 +29,18 @@ suite.addTests(loader.loadTestsFromModule(helper_tests))
 suite.addTests(loader.loadTestsFromModule(filename_database_tests))
 suite.addTests(loader.loadTestsFromModule(integration_tests))
 suite.addTests(loader.loadTestsFromModule(config_tests))
+suite.addTests(loader.loadTestsFromModule(pcrypt_tests))
+suite.addTests(loader.loadTestsFromModule(watcher_tests))
+suite.addTests(loader.loadTestsFromModule(scheduler_tests))
+suite.addTests(loader.loadTestsFromModule(chunker_tests))
+suite.addTests(loader.loadTestsFromModule(compression_tests))
+suite.addTests(loader.loadTestsFromModule(pack_tests))
+suite.addTests(loader.loadTestsFromModule(fingerprint_tests))
+suite.addTests(loader.loadTestsFromModule(manifest_tests))
+suite.addTests(loader.loadTestsFromModule(collector_tests))
+suite.addTests(loader.loadTestsFromModule(tuning_tests))
+suite.addTests(loader.loadTestsFromModule(chunked_tests))
+suite.addTests(loader.loadTestsFromModule(engine_tests))
 
 runner = unittest.TextTestRunner(verbosity=3)
 result = runner.run(suite)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for the local manifests of bucket contents
+"""
+
+import unittest
+import os
+import shutil
+from cstash.storage.manifest import BucketManifest
+
+class TestBucketManifest(unittest.TestCase):
+    """
+    Test recording objects, refreshing from a listing, and listing from the manifest
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestBucketManifest, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+
+    def setUp(self):
+        """ Create the directory the manifests are kept in """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_refresh_and_list(self):
+        """
+        Record an object, refresh from a listing without it, then add and remove objects.
+
+        Should not answer until refreshed, then forget the unlisted object, and list common
+        prefixes with a delimiter
+        """
+
+        manifest = BucketManifest(self.test_files_directory, "https://s3.amazonaws.com", "bucket")
+        other_bucket = BucketManifest(self.test_files_directory, "https://s3.amazonaws.com", "other-bucket")
+        manifest.add("deleted", 10)
+        self.assertIsNone(manifest.contains("deleted"))
+
+        listing = [ { "Key": key, "Size": 1, "ETag": '"etag"' } for key in ["a1", "chunks/c1", "chunks/c2", "packs/p1"] ]
+        self.assertEqual(list(manifest.refreshing(listing)), listing)
+
+        self.assertTrue(manifest.fresh())
+        self.assertFalse(manifest.contains("deleted"))
+        self.assertTrue(manifest.contains("chunks/c2"))
+        self.assertIsNone(other_bucket.contains("a1"))
+
+        manifest.add("b1", 5)
+        manifest.remove(["chunks/c1"])
+        self.assertEqual([ obj["Key"] for obj in manifest.iter_objects("chunks/") ], ["chunks/c2"])
+        self.assertEqual([ obj.get("Key", obj.get("Prefix")) for obj in manifest.iter_objects(delimiter="/") ],
+                         ["a1", "b1", "chunks/", "packs/"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for packing small files into shared objects
+"""
+
+import unittest
+import io
+import os
+import shutil
+from cstash.crypto.crypto import Encryption
+from cstash.crypto.packs import PackWriter, PACK_PREFIX
+
+class RecordingStorage():
+    """ Stands in for Storage, keeping uploaded objects in [self.objects] """
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_stream(self, bucket, filename, chunks, size_hint=None): # pylint: disable=unused-argument
+        self.objects[filename] = b"".join(chunks)
+        return True
+
+class TestPackWriter(unittest.TestCase):
+    """
+    Test that small files are packed together, and can each be decrypted from their own range
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestPackWriter, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+
+    def setUp(self):
+        """ Write some small files """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        self.files = {}
+        for i in range(10):
+            this_path = f"{self.test_files_directory}/small{i}"
+            self.files[this_path] = os.urandom(i * 100)
+            with open(this_path, "wb") as small_file:
+                small_file.write(self.files[this_path])
+
+        self.encryption = Encryption(self.test_files_directory, "python")
+        self.storage = RecordingStorage()
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_pack_and_read_members(self):
+        """
+        Pack the files into packs of about 2 KB, then decrypt each member from its range.
+
+        Should upload fewer packs than files, and give back every file's contents
+        """
+
+        pack_writer = PackWriter(self.encryption, self.storage, "test", "bucket", pack_size=2048)
+        members = []
+        for this_path in self.files:
+            uploaded, flushed = pack_writer.add(this_path)
+            self.assertTrue(uploaded)
+            members += flushed
+        uploaded, flushed = pack_writer.flush()
+        self.assertTrue(uploaded)
+        members += flushed
+
+        self.assertEqual(len(members), len(self.files))
+        self.assertLess(len(self.storage.objects), len(self.files))
+
+        for this_path, (pack_id, offset, length) in members:
+            pack = self.storage.objects[f"{PACK_PREFIX}{pack_id}"]
+            destination = f"{this_path}.fetched"
+            self.encryption.decrypt_stream(io.BytesIO(pack[offset:offset + length]), destination, "test")
+            with open(destination, "rb") as fetched_file:
+                self.assertEqual(fetched_file.read(), self.files[this_path])
+
+if __name__ == "__main__":
+    unittest.main()
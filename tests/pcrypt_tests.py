@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for the PCrypt class
+"""
+
+import unittest
+import os
+import shutil
+from cryptography.fernet import Fernet
+from cstash.crypto.pcrypt import PCrypt
+
+class TestPCryptOperations(unittest.TestCase):
+    """
+    Test the chunked file format written by PCrypt, and decryption of legacy Fernet tokens
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestPCryptOperations, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.source_file = f"{self.test_files_directory}/source"
+        self.encrypted_file = f"{self.test_files_directory}/source.encrypted"
+        self.decrypted_file = f"{self.test_files_directory}/source.decrypted"
+        self.key_name = "test_key"
+
+    def setUp(self):
+        """ Create a key, and a PCrypt object with a tiny chunk size to force many chunks """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        self.pcrypt = PCrypt(cstash_directory=self.test_files_directory, chunk_size=64)
+        self.pcrypt.generate_key(self.key_name)
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def encrypt_and_decrypt(self, contents):
+        """ Round trip [contents] through PCrypt, and return the decrypted bytes """
+
+        with open(self.source_file, "wb") as source:
+            source.write(contents)
+
+        self.pcrypt.encrypt(self.source_file, self.key_name, self.encrypted_file)
+        decrypted = self.pcrypt.decrypt(self.encrypted_file, self.decrypted_file, self.key_name)
+
+        with open(decrypted, "rb") as decrypted_file:
+            return decrypted_file.read()
+
+    def test_round_trip(self):
+        """
+        Encrypt and decrypt files of sizes around chunk boundaries.
+
+        Should return the original contents in all cases
+        """
+
+        for size in [0, 1, 63, 64, 65, 128, 1000]:
+            with self.subTest(size=size):
+                contents = os.urandom(size)
+                self.assertEqual(self.encrypt_and_decrypt(contents), contents)
+
+    def test_legacy_fernet(self):
+        """
+        Decrypt a file written as a single Fernet token by earlier versions.
+
+        Should return the original contents
+        """
+
+        fernet = Fernet(self.pcrypt.get_key(self.key_name))
+        with open(self.encrypted_file, "wb") as encrypted:
+            encrypted.write(fernet.encrypt(b"Some amazing things, right here"))
+
+        decrypted = self.pcrypt.decrypt(self.encrypted_file, self.decrypted_file, self.key_name)
+        with open(decrypted, "rb") as decrypted_file:
+            self.assertEqual(decrypted_file.read(), b"Some amazing things, right here")
+
+    def test_truncated_file(self):
+        """
+        Decrypt a file which has had its final chunk removed.
+
+        Should return False, and not leave a partially decrypted file behind
+        """
+
+        self.encrypt_and_decrypt(os.urandom(200))
+        with open(self.encrypted_file, "rb+") as encrypted:
+            encrypted.truncate(os.path.getsize(self.encrypted_file) - (200 % 64 + 16))
+
+        self.assertFalse(self.pcrypt.decrypt(self.encrypted_file, self.decrypted_file, self.key_name))
+        self.assertFalse(os.path.exists(self.decrypted_file))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for the daemon's scheduler
+"""
+
+import unittest
+import os
+import shutil
+import threading
+import time
+import persistqueue
+from cstash.daemon.scheduler import Scheduler
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test that the scheduler bounds concurrency, and never handles a path twice at once
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestScheduler, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.queue_location = f"{self.test_files_directory}/reprocess-queue"
+
+    def setUp(self):
+        """ Create the directory for the queue, and counters for the handler """
+
+        os.makedirs(self.test_files_directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.running = {}
+        self.calls = {}
+        self.most_running = 0
+        self.overlapped = False
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def handler(self, path):
+        """ Record concurrency while pretending to upload [path] """
+
+        with self.lock:
+            if self.running.get(path):
+                self.overlapped = True
+            self.running[path] = True
+            self.calls[path] = self.calls.get(path, 0) + 1
+            self.most_running = max(self.most_running, sum(self.running.values()))
+        time.sleep(0.1)
+        with self.lock:
+            self.running[path] = False
+
+    def test_bounded_single_flight(self):
+        """
+        Queue more paths than workers, and queue one path again while it's being handled.
+
+        Should never run more handlers than workers, never run the same path twice at once,
+        and handle the repeated path a second time
+        """
+
+        reprocess_queue = persistqueue.UniqueQ(self.queue_location, multithreading=True)
+        for i in range(6):
+            reprocess_queue.put(f"/path/{i}")
+
+        stop_event = threading.Event()
+        scheduler = Scheduler(self.queue_location, self.handler, workers=2)
+        thread = threading.Thread(target=scheduler.run, args=(stop_event,))
+        thread.start()
+
+        time.sleep(0.05)
+        reprocess_queue.put("/path/0")
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and sum(self.calls.values()) < 7:
+            time.sleep(0.05)
+        stop_event.set()
+        thread.join()
+
+        self.assertEqual(self.most_running, 2)
+        self.assertFalse(self.overlapped)
+        self.assertEqual(self.calls["/path/0"], 2)
+        self.assertEqual(sum(self.calls.values()), 7)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for choosing transfer settings
+"""
+
+import unittest
+from cstash.storage import tuning
+
+class TestTransferTuner(unittest.TestCase):
+    """
+    Test that settings follow object sizes, measurements, and overrides from the config
+    """
+
+    def test_settings_for_sizes(self):
+        """
+        Choose settings for a small file and a 50 GB file with no measurements.
+
+        Should send the small file in a single PUT, and the large one in at most MAXIMUM_PARTS
+        parts over the most streams
+        """
+
+        tuner = tuning.TransferTuner()
+
+        small = tuner.settings(4096)
+        self.assertGreaterEqual(small.multipart_threshold, tuning.MINIMUM_PART_SIZE)
+        self.assertEqual(small.streams(4096), 1)
+
+        size = 50 * 1024 * 1024 * 1024
+        large = tuner.settings(size)
+        self.assertLessEqual(size / large.part_size, tuning.MAXIMUM_PARTS)
+        self.assertEqual(large.streams(size), tuning.DEFAULT_MAX_CONCURRENCY)
+
+    def test_measurements_and_overrides(self):
+        """
+        Record slow requests and fast transfers, then override every setting in the config.
+
+        Should raise the threshold and part size with the bandwidth-delay product, use
+        overrides as given, and refuse overrides S3 wouldn't accept
+        """
+
+        tuner = tuning.TransferTuner()
+        default = tuner.settings(1024 * 1024 * 1024)
+        for _ in range(20):
+            tuner.record_request(0.5)
+            tuner.record_transfer(256 * 1024 * 1024, 1.5)
+
+        measured = tuner.settings(1024 * 1024 * 1024)
+        self.assertGreater(measured.multipart_threshold, default.multipart_threshold)
+        self.assertGreater(measured.part_size, default.part_size)
+
+        overridden = tuner.settings(1024 * 1024 * 1024, tuning.overrides(
+            { "multipart_threshold": "1024", "part_size": "5242880", "max_concurrency": "3", "bucket": "bucket" }))
+        self.assertEqual((overridden.multipart_threshold, overridden.part_size, overridden.max_concurrency),
+                         (1024, 5242880, 3))
+
+        for invalid in ({ "max_concurrency": "0" }, { "part_size": "1048576" }, { "multipart_threshold": "lots" }):
+            with self.assertRaises(SystemExit):
+                tuning.overrides(invalid)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+Unit tests for the daemon's file watchers
+"""
+
+import unittest
+import os
+import shutil
+import threading
+import time
+import cstash.crypto.filenames_database as filenames
+from cstash.daemon.watcher import InotifyWatcher, inotify_available
+from cstash.daemon.scanner import StatScanner
+
+@unittest.skipUnless(inotify_available(), "inotify is only available on Linux")
+class TestInotifyWatcher(unittest.TestCase):
+    """
+    Test that the inotify watcher reports written, moved in, and new files in stashed directories
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestInotifyWatcher, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.stashed_directory = f"{self.test_files_directory}/stashed"
+        self.stashed_file = f"{self.stashed_directory}/foobar.txt"
+
+    def setUp(self):
+        """ Stash a single file in the test database, and start a watcher in a thread """
+
+        os.makedirs(self.stashed_directory, exist_ok=True)
+        with open(self.stashed_file, "w+") as test_file:
+            test_file.write("Some amazing things, right here")
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        files_db.store_many([self.stashed_file], "python", "default", "s3", "https://s3.amazonaws.com", "bucket")
+
+        self.reported = []
+        self.stop_event = threading.Event()
+        self.watcher = InotifyWatcher(files_db, self.reported.append)
+        self.watcher.refresh_watches()
+        self.thread = threading.Thread(target=self.watcher.run, args=(self.stop_event, 0.05))
+        self.thread.start()
+
+    def tearDown(self):
+        """ Stop the watcher, and delete test fixture files """
+
+        self.stop_event.set()
+        self.thread.join()
+        self.watcher.close()
+        shutil.rmtree(self.test_files_directory)
+
+    def wait_for(self, path):
+        """ Wait up to a couple of seconds for [path] to be reported, and return whether it was """
+
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            if path in self.reported:
+                return True
+            time.sleep(0.02)
+        return False
+
+    def test_reports_changes(self):
+        """
+        Modify the stashed file, write a new file, move a file in, and create a subdirectory
+        with a file in it.
+
+        Should report all of those paths
+        """
+
+        with open(self.stashed_file, "a") as test_file:
+            test_file.write(", and some more")
+        self.assertTrue(self.wait_for(self.stashed_file))
+
+        new_file = f"{self.stashed_directory}/new.txt"
+        with open(new_file, "w") as test_file:
+            test_file.write("new")
+        self.assertTrue(self.wait_for(new_file))
+
+        outside_file = f"{self.test_files_directory}/outside.txt"
+        with open(outside_file, "w") as test_file:
+            test_file.write("moved")
+        os.rename(outside_file, f"{self.stashed_directory}/moved.txt")
+        self.assertTrue(self.wait_for(f"{self.stashed_directory}/moved.txt"))
+        self.assertNotIn(outside_file, self.reported)
+
+        os.makedirs(f"{self.stashed_directory}/sub")
+        time.sleep(0.2)
+        with open(f"{self.stashed_directory}/sub/deep.txt", "w") as test_file:
+            test_file.write("deep")
+        self.assertTrue(self.wait_for(f"{self.stashed_directory}/sub/deep.txt"))
+
+class TestStatScanner(unittest.TestCase):
+    """
+    Test that the stat scanner reports changed and new files in stashed directories, and adapts
+    how often it scans them
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Set the paths to be used """
+
+        super(TestStatScanner, self).__init__(*args, **kwargs)
+        self.test_files_directory = f"{os.getcwd()}/test_files"
+        self.stashed_directory = f"{self.test_files_directory}/stashed"
+        self.stashed_file = f"{self.stashed_directory}/foobar.txt"
+
+    def setUp(self):
+        """ Stash a single file in the test database, and create a scanner for it """
+
+        os.makedirs(self.stashed_directory, exist_ok=True)
+        with open(self.stashed_file, "w+") as test_file:
+            test_file.write("Some amazing things, right here")
+
+        files_db = filenames.FilenamesDatabase(self.test_files_directory)
+        files_db.store_many([self.stashed_file], "python", "default", "s3", "https://s3.amazonaws.com", "bucket")
+
+        self.reported = []
+        self.scanner = StatScanner(files_db, self.reported.append, period=60)
+
+    def tearDown(self):
+        """ Delete test fixture files """
+
+        shutil.rmtree(self.test_files_directory)
+
+    def test_scan_directory(self):
+        """
+        Scan the stashed directory, then change the stashed file and add a new one.
+
+        Should report nothing at first, then both files exactly once, however often the
+        directory is scanned
+        """
+
+        self.scanner.reload()
+        self.assertFalse(self.scanner.scan_directory(self.stashed_directory))
+        self.assertEqual(self.reported, [])
+
+        new_file = f"{self.stashed_directory}/new.txt"
+        with open(new_file, "w+") as test_file:
+            test_file.write("New things")
+        with open(self.stashed_file, "a") as test_file:
+            test_file.write(", and some more")
+
+        self.assertTrue(self.scanner.scan_directory(self.stashed_directory))
+        self.assertFalse(self.scanner.scan_directory(self.stashed_directory))
+        self.assertEqual(sorted(self.reported), sorted([self.stashed_file, new_file]))
+
+    def test_run_adapts_interval(self):
+        """
+        Run the scanner while a stashed file keeps changing.
+
+        Should finish at least one pass, and scan the changing directory more often than
+        once per period
+        """
+
+        stop_event = threading.Event()
+        self.scanner.period = 1
+        self.scanner.minimum_interval = 0.05
+        thread = threading.Thread(target=self.scanner.run, args=(stop_event,))
+        thread.start()
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and self.scanner.last_pass_duration is None:
+            time.sleep(0.05)
+        with open(self.stashed_file, "a") as test_file:
+            test_file.write(", and some more")
+        while time.monotonic() < deadline and self.stashed_file not in self.reported:
+            time.sleep(0.05)
+        stop_event.set()
+        thread.join()
+
+        self.assertIsNotNone(self.scanner.last_pass_duration)
+        self.assertIn(self.stashed_file, self.reported)
+        self.assertLess(self.scanner.intervals[self.stashed_directory], 1)
+
+if __name__ == "__main__":
+    unittest.main()